@@ -7,6 +7,8 @@ from typing import Any
 from urllib.parse import quote
 from zoneinfo import ZoneInfo
 
+from zao_bot.time_utils import get_tz
+
 
 @dataclass(frozen=True)
 class Settings:
@@ -23,7 +25,7 @@ class Settings:
 
     @property
     def tzinfo(self) -> ZoneInfo:
-        return ZoneInfo(self.tz_name)
+        return get_tz(self.tz_name)
 
 
 def _read_toml(path: str) -> dict[str, Any]:
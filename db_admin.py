@@ -10,7 +10,7 @@ from zao_bot import db
 
 def main() -> None:
     settings = load_settings()
-    parser = argparse.ArgumentParser(description="SQLite 管理工具（checkpoint / integrity_check / backup）")
+    parser = argparse.ArgumentParser(description="SQLite 管理工具（checkpoint / integrity_check / optimize / backup）")
     parser.add_argument("--db", default=settings.db_path, help="SQLite 路径（默认取 DB_PATH/config.toml）")
 
     sub = parser.add_subparsers(dest="cmd", required=True)
@@ -20,6 +20,8 @@ def main() -> None:
 
     sub.add_parser("integrity_check", help="执行 PRAGMA integrity_check")
 
+    sub.add_parser("optimize", help="执行 PRAGMA optimize（刷新过期的查询统计信息）")
+
     p_bk = sub.add_parser("backup", help="在线备份数据库到指定文件")
     p_bk.add_argument("--out", default="", help="输出路径（默认 ./data/backup-YYYYmmdd-HHMMSS.sqlite3）")
 
@@ -36,6 +38,11 @@ def main() -> None:
         print("\n".join(res))
         return
 
+    if args.cmd == "optimize":
+        db.optimize(db_path)
+        print("optimize done")
+        return
+
     if args.cmd == "backup":
         out = args.out.strip()
         if not out:
@@ -3,7 +3,7 @@ from __future__ import annotations
 from dataclasses import dataclass
 from datetime import date, timedelta
 
-from zao_bot.storage.base import Storage
+from zao_bot.storage.base import CheckInRecord, Storage
 from zao_bot.time_utils import business_day_key
 
 
@@ -12,14 +12,24 @@ ACH_STREAK_EARLIEST_7 = "streak_earliest_7"
 ACH_ONTIME_8H = "ontime_8h"
 ACH_LONGDAY_12H = "longday_12h"
 
+# 连续最早每满 N 天触发一次
+EARLIEST_STREAK_EVERY = 7
+
 # 成就分类：
 # - 可重复获取：累计次数（获得成就）
 # - 单次成就：只在一个群里首次达成时触发（解锁成就）
-SINGLE_ACHIEVEMENTS: set[str] = {ACH_ONTIME_8H}
+SINGLE_ACHIEVEMENTS: frozenset[str] = frozenset({ACH_ONTIME_8H})
 
 
-def is_single_achievement(key: str) -> bool:
-    return key in SINGLE_ACHIEVEMENTS
+def partition_unlocked(keys: list[str]) -> tuple[list[str], list[str]]:
+    """
+    一次遍历把成就 key 分成 (可累计的“获得成就”, 单次的“解锁成就”)，保持原顺序。
+    """
+    awarded: list[str] = []
+    unlocked: list[str] = []
+    for k in keys:
+        (unlocked if k in SINGLE_ACHIEVEMENTS else awarded).append(k)
+    return awarded, unlocked
 
 
 @dataclass(frozen=True)
@@ -29,51 +39,23 @@ class AchievementResult:
     earliest_streak: int | None = None
 
 
-def on_check_in(
-    *,
-    storage: Storage,
-    chat_id: int,
-    user_id: int,
-    session_id: int,
-    check_in_ts,
-    now_ts,
-) -> AchievementResult:
+def record_check_in(*, storage: Storage, chat_id: int, user_id: int, now_ts) -> CheckInRecord | None:
     """
-    在签到成功后调用。
+    签到并结算签到成就，整个过程是存储层的一个事务（业务日：凌晨 4 点前仍算前一天）。
     1) 每日最早：当日第一次写入 daily_earliest 的人获得（可累计次数）
     2) 连续最早：连续7天都是每日最早，触发一次（可在 7/14/21... 天继续触发）
+    今日已签到（写不进新的 session）时返回 None。
     """
-    unlocked: list[str] = []
-    # 业务日：凌晨 4 点前仍算前一天
-    day = business_day_key(check_in_ts, cutoff_hour=4)
-
-    # 今日最早（只会有一个人写入成功）
-    is_earliest = storage.set_daily_earliest(
+    return storage.record_checkin(
         chat_id=chat_id,
-        day=day,
         user_id=user_id,
-        session_id=session_id,
-        check_in=check_in_ts,
+        ts=now_ts,
         created_at=now_ts,
+        earliest_key=ACH_DAILY_EARLIEST,
+        streak_key="earliest",
+        streak_award_key=ACH_STREAK_EARLIEST_7,
+        streak_award_every=EARLIEST_STREAK_EVERY,
     )
-    earliest_streak: int | None = None
-    if is_earliest:
-        if storage.award_achievement(chat_id=chat_id, user_id=user_id, key=ACH_DAILY_EARLIEST, created_at=now_ts, day=day):
-            unlocked.append(ACH_DAILY_EARLIEST)
-
-        earliest_streak = storage.update_streak(chat_id=chat_id, user_id=user_id, key="earliest", day=day, created_at=now_ts)
-        # 连续7天触发一次（7/14/21...）
-        if earliest_streak > 0 and earliest_streak % 7 == 0:
-            if storage.award_achievement(
-                chat_id=chat_id,
-                user_id=user_id,
-                key=ACH_STREAK_EARLIEST_7,
-                created_at=now_ts,
-                day=day,
-            ):
-                unlocked.append(ACH_STREAK_EARLIEST_7)
-
-    return AchievementResult(unlocked=unlocked, earliest_streak=earliest_streak)
 
 
 def on_check_out(
@@ -91,7 +73,6 @@ def on_check_out(
     3) 8小时准点下班：awake 时间为 8h，误差 1 分钟（±60s）
     4) 辛苦的一天：awake 时间超过 12h
     """
-    unlocked: list[str] = []
     # 统一按“本次 session 的业务日”归档（凌晨 4 点前仍算前一天），避免跨天签退记到次日
     day = business_day_key(check_in_ts, cutoff_hour=4)
     # 仅工作日（周一~周五）触发
@@ -99,32 +80,30 @@ def on_check_out(
         is_weekday = date.fromisoformat(day).weekday() <= 4
     except Exception:
         is_weekday = True
+    if not is_weekday:
+        return AchievementResult(unlocked=[])
 
+    candidates: list[str] = []
     # 8h ± 1min
-    if is_weekday and abs(duration - timedelta(hours=8)) <= timedelta(minutes=1):
+    if abs(duration - timedelta(hours=8)) <= timedelta(minutes=1):
         # 单次成就：每个群里只在首次达成时触发一次（之后不再累计）
         if storage.get_achievement_count(chat_id=chat_id, user_id=user_id, key=ACH_ONTIME_8H) <= 0:
-            if storage.award_achievement(
-                chat_id=chat_id,
-                user_id=user_id,
-                key=ACH_ONTIME_8H,
-                created_at=now_ts,
-                day=day,
-                session_id=session_id,
-            ):
-                unlocked.append(ACH_ONTIME_8H)
+            candidates.append(ACH_ONTIME_8H)
 
     # > 12h
-    if is_weekday and duration > timedelta(hours=12):
-        if storage.award_achievement(
-            chat_id=chat_id,
-            user_id=user_id,
-            key=ACH_LONGDAY_12H,
-            created_at=now_ts,
-            day=day,
-            session_id=session_id,
-        ):
-            unlocked.append(ACH_LONGDAY_12H)
+    if duration > timedelta(hours=12):
+        candidates.append(ACH_LONGDAY_12H)
 
+    if not candidates:
+        return AchievementResult(unlocked=[])
+    # 候选成就一次写入（一个事务）
+    unlocked = storage.award_achievements_bulk(
+        chat_id=chat_id,
+        user_id=user_id,
+        keys=candidates,
+        created_at=now_ts,
+        day=day,
+        session_id=session_id,
+    )
     return AchievementResult(unlocked=unlocked)
 
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import logging
+from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 
 from telegram import BotCommandScopeAllGroupChats, BotCommandScopeAllPrivateChats, BotCommandScopeDefault, Update
@@ -16,17 +18,18 @@ from zao_bot.telegram_commands import default_bot_commands
 
 LOG = logging.getLogger("zao-bot")
 
+_REMINDER_LEASE = timedelta(minutes=5)
+
 
 async def check_wake_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
     """定期检查是否有需要触发的提醒"""
-    from datetime import datetime, timedelta
-
     deps: HandlerDeps = context.bot_data.get("deps")
     if not deps:
         return
 
-    now = datetime.now(tz=deps.settings.tzinfo)
-    reminders = deps.storage.get_pending_reminders(now=now)
+    now = datetime.now(tz=deps.tz)
+    # 先领取再发送：发送中途重启也不会马上重发同一条提醒；发送失败/中断的在租约到期后重试
+    reminders = deps.storage.claim_pending_reminders(now=now, lease_until=now + _REMINDER_LEASE)
 
     for reminder in reminders:
         try:
@@ -53,9 +56,30 @@ async def check_wake_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
             LOG.exception(f"Wake reminder error for reminder_id={reminder.id}: {e}")
 
 
+async def db_wal_checkpoint(context: ContextTypes.DEFAULT_TYPE) -> None:
+    deps: HandlerDeps = context.bot_data.get("deps")
+    if not deps:
+        return
+    try:
+        deps.storage.wal_checkpoint()
+    except Exception:
+        LOG.exception("WAL checkpoint 失败，下次再试")
+
+
+async def db_optimize(context: ContextTypes.DEFAULT_TYPE) -> None:
+    deps: HandlerDeps = context.bot_data.get("deps")
+    if not deps:
+        return
+    try:
+        deps.storage.optimize()
+    except Exception:
+        LOG.exception("PRAGMA optimize 失败，下次再试")
+
+
 def build_app(
     token: str,
     *,
+    deps: HandlerDeps,
     proxy_url: str | None = None,
     auto_register_commands: bool = True,
 ) -> Application:
@@ -81,26 +105,34 @@ def build_app(
         builder = builder.request(request).get_updates_request(request)
 
     app = builder.build()
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_start))
-    app.add_handler(CommandHandler("zao", cmd_zao))
-    app.add_handler(CommandHandler("wan", cmd_wan))
-    app.add_handler(CommandHandler("awake", cmd_awake))
-    app.add_handler(CommandHandler("year", cmd_year))
-    app.add_handler(CommandHandler("rank", cmd_rank))
-    app.add_handler(CommandHandler("ach", cmd_ach))
-    app.add_handler(CommandHandler("achievements", cmd_ach))
-    app.add_handler(CommandHandler("achrank", cmd_achrank))
-    app.add_handler(CommandHandler("heatmap", cmd_heatmap))
-    app.add_handler(CommandHandler("gun", cmd_gun))
-    app.add_handler(CommandHandler("wake", cmd_wake))
-    app.add_handler(CommandHandler("rsp", cmd_rsp))
-    app.add_handler(CallbackQueryHandler(rsp_callback, pattern="^rsp:"))
+    # 定时任务（check_wake_reminders）仍从 bot_data 取 deps
+    app.bot_data["deps"] = deps
+    # deps 启动后不变：注册时直接绑定到 handler，避免每次更新都查 bot_data
+    app.add_handler(CommandHandler("start", partial(cmd_start, deps)))
+    app.add_handler(CommandHandler("help", partial(cmd_start, deps)))
+    app.add_handler(CommandHandler("zao", partial(cmd_zao, deps)))
+    app.add_handler(CommandHandler("wan", partial(cmd_wan, deps)))
+    app.add_handler(CommandHandler("awake", partial(cmd_awake, deps)))
+    app.add_handler(CommandHandler("year", partial(cmd_year, deps)))
+    app.add_handler(CommandHandler("rank", partial(cmd_rank, deps)))
+    app.add_handler(CommandHandler("ach", partial(cmd_ach, deps)))
+    app.add_handler(CommandHandler("achievements", partial(cmd_ach, deps)))
+    app.add_handler(CommandHandler("achrank", partial(cmd_achrank, deps)))
+    app.add_handler(CommandHandler("heatmap", partial(cmd_heatmap, deps)))
+    app.add_handler(CommandHandler("gun", partial(cmd_gun, deps)))
+    app.add_handler(CommandHandler("wake", partial(cmd_wake, deps)))
+    app.add_handler(CommandHandler("rsp", partial(cmd_rsp, deps)))
+    # 按钮回调放到独立任务里跑（block=False）：等 Bot API（answer/getChatMember/编辑消息）时不卡住后续更新；
+    # 同一 chat 内的顺序由 per-chat 锁保证（rsp_callback 与 /rsp 的取消/发起共用），不同 chat 之间并行
+    app.add_handler(CallbackQueryHandler(partial(rsp_callback, deps), pattern="^rsp:", block=False))
 
     # 添加定时任务：每分钟检查一次待触发的提醒
     if app.job_queue:
         app.job_queue.run_repeating(check_wake_reminders, interval=60, first=10)
         LOG.info("已启用 wake 提醒定时任务（每 60 秒检查一次）")
+        # 数据库维护：每 5 分钟 WAL checkpoint（控制 -wal 增长），每小时刷新查询统计信息
+        app.job_queue.run_repeating(db_wal_checkpoint, interval=300, first=300)
+        app.job_queue.run_repeating(db_optimize, interval=3600, first=3600)
     else:
         LOG.warning("JobQueue 未启用，wake 提醒功能将不可用。提示：使用 Application.builder().job_queue(...) 启用")
 
@@ -136,10 +168,10 @@ def run() -> None:
 
     app = build_app(
         settings.bot_token,
+        deps=HandlerDeps(settings=settings, messages=msgs, storage=storage),
         proxy_url=settings.proxy_url,
         auto_register_commands=settings.auto_register_commands,
     )
-    app.bot_data["deps"] = HandlerDeps(settings=settings, messages=msgs, storage=storage)
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
@@ -2,33 +2,90 @@ from __future__ import annotations
 
 import os
 import sqlite3
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator
 
 from zao_bot.time_utils import business_day_key, business_day_range, day_range
 
 
-def connect(db_path: str) -> sqlite3.Connection:
+# sqlite3 按 SQL 文本缓存每个连接上已编译的语句；本模块的 SQL 都是固定字面量（约 50 条），
+# 常驻连接上第二次执行起就不再 parse/prepare，容量留足余量避免被挤出
+_CACHED_STATEMENTS = 256
+
+
+def connect(db_path: str, *, read_only: bool = False) -> sqlite3.Connection:
     # check_same_thread=False 便于在不同线程中使用连接（PTB 默认在 event loop 里，但这里更稳妥）
-    conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+    if read_only:
+        # 只读连接（mode=ro）：拿不到写锁，也不会误写；库的 WAL 等设置由写连接负责
+        conn = sqlite3.connect(
+            f"{Path(db_path).resolve().as_uri()}?mode=ro",
+            timeout=5,
+            check_same_thread=False,
+            cached_statements=_CACHED_STATEMENTS,
+            uri=True,
+        )
+    else:
+        conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
 
-    # --- 并发与可靠性 ---
-    # WAL：读写并发更好；崩溃恢复时会自动回放 -wal 文件
-    conn.execute(f"PRAGMA journal_mode={os.getenv('SQLITE_JOURNAL_MODE', 'WAL')};")
-    # NORMAL：WAL 下常见推荐值，性能/可靠性平衡；需要更强保证可改为 FULL
-    conn.execute(f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')};")
+    if not read_only:
+        # --- 并发与可靠性 ---
+        # WAL：读写并发更好；崩溃恢复时会自动回放 -wal 文件
+        conn.execute(f"PRAGMA journal_mode={os.getenv('SQLITE_JOURNAL_MODE', 'WAL')};")
+        # NORMAL：WAL 下常见推荐值，性能/可靠性平衡；需要更强保证可改为 FULL
+        conn.execute(f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')};")
+        # 自动 checkpoint 频率（单位：page），控制 -wal 增长；另有定时任务做 PASSIVE checkpoint，这里可以放宽些
+        conn.execute(f"PRAGMA wal_autocheckpoint={int(os.getenv('SQLITE_WAL_AUTOCHECKPOINT', '2000'))};")
+        # checkpoint 之后把 -wal 文件截到这个大小以内（字节），避免一次写入高峰后长期占着磁盘
+        conn.execute(f"PRAGMA journal_size_limit={int(os.getenv('SQLITE_JOURNAL_SIZE_LIMIT', '67108864'))};")
+        conn.execute("PRAGMA foreign_keys=ON;")
     # 遇到写锁等待更久，减少 “database is locked”
     conn.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))};")
-    # 自动 checkpoint 频率（单位：page），控制 -wal 增长；可按需调整
-    conn.execute(f"PRAGMA wal_autocheckpoint={int(os.getenv('SQLITE_WAL_AUTOCHECKPOINT', '1000'))};")
+    # 读多写少：mmap 让读走内存映射，减少 read() 系统调用（设为 0 关闭）
+    conn.execute(f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', '268435456'))};")
+    # 页缓存按连接分配，默认只有 2MB；负数表示 KiB
+    conn.execute(f"PRAGMA cache_size={int(os.getenv('SQLITE_CACHE_SIZE', '-65536'))};")
     # 临时表走内存，减少 IO
     conn.execute("PRAGMA temp_store=MEMORY;")
-    conn.execute("PRAGMA foreign_keys=ON;")
     return conn
 
 
-def wal_checkpoint(db_path: str, *, mode: str = "PASSIVE") -> tuple[int, int, int]:
+# 下面的读写函数既接受库路径（临时打开、用完关闭），也接受调用方长期持有的连接（只包一层事务）
+Database = str | sqlite3.Connection
+
+
+@contextmanager
+def _open(db: Database, *, write: bool = False) -> Iterator[sqlite3.Connection]:
+    # write=True：BEGIN IMMEDIATE 一开始就拿写锁（按 busy_timeout 等待），
+    # 避免 DEFERRED 事务先读后写时中途升级锁失败（SQLITE_BUSY）
+    if isinstance(db, sqlite3.Connection):
+        with db:
+            if write:
+                db.execute("BEGIN IMMEDIATE;")
+            yield db
+        return
+    conn = connect(db)
+    try:
+        with conn:
+            if write:
+                conn.execute("BEGIN IMMEDIATE;")
+            yield conn
+    finally:
+        conn.close()
+
+
+def optimize(db: Database) -> None:
+    """
+    PRAGMA optimize：只对统计信息过期的表重新 ANALYZE，开销很小；长期运行时建议定期执行。
+    """
+    with _open(db) as conn:
+        conn.execute("PRAGMA optimize;")
+
+
+def wal_checkpoint(db: Database, *, mode: str = "PASSIVE") -> tuple[int, int, int]:
     """
     手动触发 WAL checkpoint，返回 (busy, log, checkpointed)
     mode: PASSIVE | FULL | RESTART | TRUNCATE
@@ -36,7 +93,7 @@ def wal_checkpoint(db_path: str, *, mode: str = "PASSIVE") -> tuple[int, int, in
     mode_u = mode.upper()
     if mode_u not in {"PASSIVE", "FULL", "RESTART", "TRUNCATE"}:
         mode_u = "PASSIVE"
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         row = conn.execute(f"PRAGMA wal_checkpoint({mode_u});").fetchone()
     if not row:
         return (0, 0, 0)
@@ -47,7 +104,7 @@ def integrity_check(db_path: str) -> list[str]:
     """
     返回 integrity_check 结果；正常情况下是 ["ok"]。
     """
-    with connect(db_path) as conn:
+    with _open(db_path) as conn:
         rows = conn.execute("PRAGMA integrity_check;").fetchall()
     return [str(r[0]) for r in rows] if rows else ["ok"]
 
@@ -67,8 +124,8 @@ def backup_to(db_path: str, *, backup_path: str) -> None:
         src.close()
 
 
-def init_db(db_path: str) -> None:
-    with connect(db_path) as conn:
+def init_db(db: Database) -> None:
+    with _open(db) as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -131,10 +188,19 @@ def init_db(db_path: str) -> None:
             ON sessions(chat_id, check_in);
             """
         )
+        # 榜单按 chat_id（今日榜再加 session_day）定位、按 user_id 聚合 check_in/check_out：
+        # 用到的列都放进索引，聚合只扫索引不回表；按天的索引覆盖了原来的 (chat_id, session_day)
         conn.execute(
             """
-            CREATE INDEX IF NOT EXISTS idx_sessions_chat_day
-            ON sessions(chat_id, session_day);
+            CREATE INDEX IF NOT EXISTS idx_sessions_chat_day_user_times
+            ON sessions(chat_id, session_day, user_id, check_in, check_out);
+            """
+        )
+        conn.execute("DROP INDEX IF EXISTS idx_sessions_chat_day;")
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_sessions_chat_user_times
+            ON sessions(chat_id, user_id, check_in, check_out);
             """
         )
 
@@ -200,6 +266,59 @@ def init_db(db_path: str) -> None:
             );
             """
         )
+        # 跨群成就汇总：随 achievement_stats 同步 +1，全局统计/排行直接点查，不再 SUM/MAX
+        has_global_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='achievement_stats_global';"
+        ).fetchone()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS achievement_stats_global (
+              user_id INTEGER NOT NULL,
+              key TEXT NOT NULL,
+              count INTEGER NOT NULL,
+              last_awarded_at TEXT NOT NULL,
+              PRIMARY KEY(user_id, key),
+              FOREIGN KEY(user_id) REFERENCES users(user_id)
+            );
+            """
+        )
+        if not has_global_stats:
+            # 新建表时按已有的分群计数回填
+            conn.execute(
+                """
+                INSERT INTO achievement_stats_global(user_id, key, count, last_awarded_at)
+                SELECT user_id, key, SUM(count), MAX(last_awarded_at)
+                FROM achievement_stats
+                GROUP BY user_id, key;
+                """
+            )
+
+        # 成就/连续签到排行：按 (chat_id, key) 定位后直接按索引顺序取前 N，免排序
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_ach_stats_chat_key_count
+            ON achievement_stats(chat_id, key, count DESC, user_id);
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_ach_global_key_count
+            ON achievement_stats_global(key, count DESC, user_id);
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_streaks_chat_key_streak
+            ON streaks(chat_id, key, streak DESC, user_id);
+            """
+        )
+        # 个人跨群最佳连续签到：按 (user_id, key) 定位后第一条就是答案
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_streaks_user_key_streak
+            ON streaks(user_id, key, streak DESC, chat_id);
+            """
+        )
 
         # 唯一性约束（用部分索引区分不同成就的“去重维度”）
         conn.execute(
@@ -226,7 +345,7 @@ def init_db(db_path: str) -> None:
 
 
 def upsert_user_and_chat(
-    db_path: str,
+    db: Database,
     *,
     user_id: int,
     username: str | None,
@@ -238,7 +357,7 @@ def upsert_user_and_chat(
     updated_at: datetime,
 ) -> None:
     now = updated_at.isoformat()
-    with connect(db_path) as conn:
+    with _open(db, write=True) as conn:
         conn.execute(
             """
             INSERT INTO users(user_id, username, first_name, last_name, updated_at)
@@ -270,8 +389,16 @@ class OpenSession:
     check_in: datetime
 
 
-def get_open_session(db_path: str, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None:
-    with connect(db_path) as conn:
+@dataclass(frozen=True)
+class CheckInRecord:
+    session_id: int
+    position: int
+    unlocked: list[str]
+    earliest_streak: int | None
+
+
+def get_open_session(db: Database, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None:
+    with _open(db) as conn:
         row = conn.execute(
             """
             SELECT id, check_in
@@ -288,9 +415,9 @@ def get_open_session(db_path: str, *, chat_id: int, user_id: int, day: str | Non
     return OpenSession(session_id=int(row["id"]), check_in=datetime.fromisoformat(row["check_in"]))
 
 
-def check_in(db_path: str, *, chat_id: int, user_id: int, ts: datetime) -> bool:
+def check_in(db: Database, *, chat_id: int, user_id: int, ts: datetime) -> bool:
     try:
-        with connect(db_path) as conn:
+        with _open(db, write=True) as conn:
             sday = business_day_key(ts, cutoff_hour=4)
             conn.execute(
                 "INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out) VALUES(?,?,?,?,NULL);",
@@ -302,22 +429,73 @@ def check_in(db_path: str, *, chat_id: int, user_id: int, ts: datetime) -> bool:
 
 
 def check_out(
-    db_path: str, *, chat_id: int, user_id: int, ts: datetime
+    db: Database, *, chat_id: int, user_id: int, ts: datetime
 ) -> tuple[bool, timedelta | None, datetime | None, int | None]:
     # 按业务日签退，避免跨日续接旧 session
     day = business_day_key(ts, cutoff_hour=4)
-    open_sess = get_open_session(db_path, chat_id=chat_id, user_id=user_id, day=day)
+    open_sess = get_open_session(db, chat_id=chat_id, user_id=user_id, day=day)
     if not open_sess:
         return False, None, None, None
     if ts < open_sess.check_in:
         ts = open_sess.check_in
-    with connect(db_path) as conn:
+    with _open(db, write=True) as conn:
         conn.execute("UPDATE sessions SET check_out=? WHERE id=?;", (ts.isoformat(), open_sess.session_id))
     return True, ts - open_sess.check_in, open_sess.check_in, open_sess.session_id
 
 
+def record_checkin(
+    db: Database,
+    *,
+    chat_id: int,
+    user_id: int,
+    ts: datetime,
+    created_at: datetime,
+    earliest_key: str,
+    streak_key: str,
+    streak_award_key: str,
+    streak_award_every: int = 7,
+) -> CheckInRecord | None:
+    """
+    签到热路径合成一个写事务（BEGIN IMMEDIATE … COMMIT，只刷一次盘）：
+    写 session → 今日名次 → 今日最早（只有当天第一个人能写入）→ 最早成就 + 连续最早 + 每 N 天的连续成就。
+    已有未签退的 session 时返回 None（什么都不写）。
+    """
+    sday = business_day_key(ts, cutoff_hour=4)
+    with _open(db, write=True) as conn:
+        try:
+            cur = conn.execute(
+                "INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out) VALUES(?,?,?,?,NULL);",
+                (chat_id, user_id, sday, ts.isoformat()),
+            )
+        except sqlite3.IntegrityError:
+            return None
+        session_id = int(cur.lastrowid)
+        position = _checkin_position(conn, chat_id=chat_id, session_id=session_id, check_in=ts, day=sday)
+
+        unlocked: list[str] = []
+        earliest_streak: int | None = None
+        cur = conn.execute(
+            """
+            INSERT INTO daily_earliest(chat_id, day, user_id, session_id, check_in, created_at)
+            VALUES(?,?,?,?,?,?)
+            ON CONFLICT(chat_id, day) DO NOTHING;
+            """,
+            (chat_id, sday, user_id, session_id, ts.isoformat(), created_at.isoformat()),
+        )
+        if cur.rowcount == 1:
+            award = {"chat_id": chat_id, "user_id": user_id, "created_at": created_at, "day": sday, "session_id": None}
+            if _award_achievement(conn, key=earliest_key, **award):
+                unlocked.append(earliest_key)
+            earliest_streak = _update_streak(
+                conn, chat_id=chat_id, user_id=user_id, key=streak_key, day=sday, created_at=created_at
+            )
+            if earliest_streak % streak_award_every == 0 and _award_achievement(conn, key=streak_award_key, **award):
+                unlocked.append(streak_award_key)
+    return CheckInRecord(session_id=session_id, position=position, unlocked=unlocked, earliest_streak=earliest_streak)
+
+
 def set_daily_earliest(
-    db_path: str,
+    db: Database,
     *,
     chat_id: int,
     day: str,
@@ -331,7 +509,7 @@ def set_daily_earliest(
     返回 True 表示本次写入成功（即你是当天最早）。
     """
     try:
-        with connect(db_path) as conn:
+        with _open(db, write=True) as conn:
             conn.execute(
                 """
                 INSERT INTO daily_earliest(chat_id, day, user_id, session_id, check_in, created_at)
@@ -345,7 +523,7 @@ def set_daily_earliest(
 
 
 def update_streak(
-    db_path: str,
+    db: Database,
     *,
     chat_id: int,
     user_id: int,
@@ -357,51 +535,55 @@ def update_streak(
     更新连胜，返回更新后的 streak 值。
     规则：如果 day 是 last_day+1，则 streak+1；否则 streak=1。
     """
-    with connect(db_path) as conn:
-        row = conn.execute(
-            "SELECT last_day, streak FROM streaks WHERE chat_id=? AND user_id=? AND key=?;",
-            (chat_id, user_id, key),
-        ).fetchone()
+    with _open(db, write=True) as conn:
+        return _update_streak(conn, chat_id=chat_id, user_id=user_id, key=key, day=day, created_at=created_at)
 
-        if row:
-            last_day = str(row["last_day"])
-            prev = int(row["streak"])
-            # day/last_day 格式均为 YYYY-MM-DD
-            try:
-                last_dt = datetime.fromisoformat(last_day)
-            except Exception:
-                last_dt = None
-            try:
-                cur_dt = datetime.fromisoformat(day)
-            except Exception:
-                cur_dt = None
-
-            new_streak = 1
-            if last_dt and cur_dt and (cur_dt.date() - last_dt.date()).days == 1:
-                new_streak = prev + 1
 
-            conn.execute(
-                """
-                UPDATE streaks
-                SET last_day=?, streak=?, updated_at=?
-                WHERE chat_id=? AND user_id=? AND key=?;
-                """,
-                (day, new_streak, created_at.isoformat(), chat_id, user_id, key),
-            )
-            return new_streak
+def _update_streak(conn: sqlite3.Connection, *, chat_id: int, user_id: int, key: str, day: str, created_at: datetime) -> int:
+    row = conn.execute(
+        "SELECT last_day, streak FROM streaks WHERE chat_id=? AND user_id=? AND key=?;",
+        (chat_id, user_id, key),
+    ).fetchone()
+
+    if row:
+        last_day = str(row["last_day"])
+        prev = int(row["streak"])
+        # day/last_day 格式均为 YYYY-MM-DD
+        try:
+            last_dt = datetime.fromisoformat(last_day)
+        except Exception:
+            last_dt = None
+        try:
+            cur_dt = datetime.fromisoformat(day)
+        except Exception:
+            cur_dt = None
+
+        new_streak = 1
+        if last_dt and cur_dt and (cur_dt.date() - last_dt.date()).days == 1:
+            new_streak = prev + 1
 
         conn.execute(
             """
-            INSERT INTO streaks(chat_id, user_id, key, last_day, streak, updated_at)
-            VALUES(?,?,?,?,?,?);
+            UPDATE streaks
+            SET last_day=?, streak=?, updated_at=?
+            WHERE chat_id=? AND user_id=? AND key=?;
             """,
-            (chat_id, user_id, key, day, 1, created_at.isoformat()),
+            (day, new_streak, created_at.isoformat(), chat_id, user_id, key),
         )
-        return 1
+        return new_streak
+
+    conn.execute(
+        """
+        INSERT INTO streaks(chat_id, user_id, key, last_day, streak, updated_at)
+        VALUES(?,?,?,?,?,?);
+        """,
+        (chat_id, user_id, key, day, 1, created_at.isoformat()),
+    )
+    return 1
 
 
-def get_streak(db_path: str, *, chat_id: int, user_id: int, key: str) -> int:
-    with connect(db_path) as conn:
+def get_streak(db: Database, *, chat_id: int, user_id: int, key: str) -> int:
+    with _open(db) as conn:
         row = conn.execute(
             "SELECT streak FROM streaks WHERE chat_id=? AND user_id=? AND key=?;",
             (chat_id, user_id, key),
@@ -410,7 +592,7 @@ def get_streak(db_path: str, *, chat_id: int, user_id: int, key: str) -> int:
 
 
 def award_achievement(
-    db_path: str,
+    db: Database,
     *,
     chat_id: int,
     user_id: int,
@@ -423,35 +605,84 @@ def award_achievement(
     写入成就事件 + 统计计数（带去重约束）。
     返回 True 表示这次确实“新解锁/新累计”了一次。
     """
-    try:
-        with connect(db_path) as conn:
-            conn.execute(
-                """
-                INSERT INTO achievement_events(chat_id, user_id, key, day, session_id, created_at)
-                VALUES(?,?,?,?,?,?);
-                """,
-                (chat_id, user_id, key, day, session_id, created_at.isoformat()),
-            )
-            conn.execute(
-                """
-                INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
-                VALUES(?,?,?,?,?)
-                ON CONFLICT(chat_id, user_id, key) DO UPDATE SET
-                  count = count + 1,
-                  last_awarded_at = excluded.last_awarded_at;
-                """,
-                (chat_id, user_id, key, 1, created_at.isoformat()),
+    with _open(db, write=True) as conn:
+        return _award_achievement(
+            conn, chat_id=chat_id, user_id=user_id, key=key, created_at=created_at, day=day, session_id=session_id
+        )
+
+
+def award_achievements_bulk(
+    db: Database,
+    *,
+    chat_id: int,
+    user_id: int,
+    keys: list[str],
+    created_at: datetime,
+    day: str | None = None,
+    session_id: int | None = None,
+) -> list[str]:
+    """
+    一个事务里写入多个候选成就，返回实际新写入的 key（按 keys 的顺序）。
+    """
+    with _open(db, write=True) as conn:
+        return [
+            key
+            for key in keys
+            if _award_achievement(
+                conn, chat_id=chat_id, user_id=user_id, key=key, created_at=created_at, day=day, session_id=session_id
             )
-        return True
+        ]
+
+
+def _award_achievement(
+    conn: sqlite3.Connection,
+    *,
+    chat_id: int,
+    user_id: int,
+    key: str,
+    created_at: datetime,
+    day: str | None,
+    session_id: int | None,
+) -> bool:
+    # 去重靠唯一索引：冲突时 SQLite 只回滚这一条语句，外层事务（record_checkin 里的其它写入）不受影响
+    try:
+        conn.execute(
+            """
+            INSERT INTO achievement_events(chat_id, user_id, key, day, session_id, created_at)
+            VALUES(?,?,?,?,?,?);
+            """,
+            (chat_id, user_id, key, day, session_id, created_at.isoformat()),
+        )
     except sqlite3.IntegrityError:
         return False
+    conn.execute(
+        """
+        INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
+        VALUES(?,?,?,?,?)
+        ON CONFLICT(chat_id, user_id, key) DO UPDATE SET
+          count = count + 1,
+          last_awarded_at = excluded.last_awarded_at;
+        """,
+        (chat_id, user_id, key, 1, created_at.isoformat()),
+    )
+    conn.execute(
+        """
+        INSERT INTO achievement_stats_global(user_id, key, count, last_awarded_at)
+        VALUES(?,?,?,?)
+        ON CONFLICT(user_id, key) DO UPDATE SET
+          count = count + 1,
+          last_awarded_at = MAX(last_awarded_at, excluded.last_awarded_at);
+        """,
+        (user_id, key, 1, created_at.isoformat()),
+    )
+    return True
 
 
-def get_achievement_stats(db_path: str, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
+def get_achievement_stats(db: Database, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
     """
     返回 (key, count, last_awarded_at) 列表
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             """
             SELECT key, count, last_awarded_at
@@ -464,17 +695,16 @@ def get_achievement_stats(db_path: str, *, chat_id: int, user_id: int) -> list[t
     return [(str(r["key"]), int(r["count"]), str(r["last_awarded_at"])) for r in rows]
 
 
-def get_achievement_stats_global(db_path: str, *, user_id: int) -> list[tuple[str, int, str]]:
+def get_achievement_stats_global(db: Database, *, user_id: int) -> list[tuple[str, int, str]]:
     """
-    全局（跨所有 chat）统计：返回 (key, count_sum, last_awarded_at_max)
+    全局（跨所有 chat）统计：返回 (key, count_sum, last_awarded_at_max)，读 achievement_stats_global 汇总表
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             """
-            SELECT key, SUM(count) AS count, MAX(last_awarded_at) AS last_awarded_at
-            FROM achievement_stats
+            SELECT key, count, last_awarded_at
+            FROM achievement_stats_global
             WHERE user_id=?
-            GROUP BY key
             ORDER BY count DESC, key ASC;
             """,
             (user_id,),
@@ -482,8 +712,8 @@ def get_achievement_stats_global(db_path: str, *, user_id: int) -> list[tuple[st
     return [(str(r["key"]), int(r["count"]), str(r["last_awarded_at"])) for r in rows]
 
 
-def get_achievement_count(db_path: str, *, chat_id: int, user_id: int, key: str) -> int:
-    with connect(db_path) as conn:
+def get_achievement_count(db: Database, *, chat_id: int, user_id: int, key: str) -> int:
+    with _open(db) as conn:
         row = conn.execute(
             "SELECT count FROM achievement_stats WHERE chat_id=? AND user_id=? AND key=?;",
             (chat_id, user_id, key),
@@ -491,23 +721,23 @@ def get_achievement_count(db_path: str, *, chat_id: int, user_id: int, key: str)
     return int(row["count"]) if row else 0
 
 
-def get_achievement_count_global(db_path: str, *, user_id: int, key: str) -> int:
-    with connect(db_path) as conn:
+def get_achievement_count_global(db: Database, *, user_id: int, key: str) -> int:
+    with _open(db) as conn:
         row = conn.execute(
-            "SELECT COALESCE(SUM(count),0) AS count FROM achievement_stats WHERE user_id=? AND key=?;",
+            "SELECT count FROM achievement_stats_global WHERE user_id=? AND key=?;",
             (user_id, key),
         ).fetchone()
     return int(row["count"]) if row else 0
 
 
 def achievement_rank_by_count(
-    db_path: str, *, chat_id: int, key: str, limit: int = 20
+    db: Database, *, chat_id: int, key: str, limit: int = 20
 ) -> list[tuple[int, str, int]]:
     """
     成就排行榜（按 achievement_stats.count）
     返回 (user_id, display_name, count)
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             """
             SELECT
@@ -531,22 +761,21 @@ def achievement_rank_by_count(
     return out
 
 
-def achievement_rank_by_count_global(db_path: str, *, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
+def achievement_rank_by_count_global(db: Database, *, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
     """
     全局（跨所有 chat）成就排行榜：返回 (user_id, display_name, count_sum)
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             """
             SELECT
               u.user_id AS user_id,
               COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-              SUM(s.count) AS count
-            FROM achievement_stats s
+              s.count AS count
+            FROM achievement_stats_global s
             JOIN users u ON u.user_id = s.user_id
             WHERE s.key=?
-            GROUP BY u.user_id
-            ORDER BY count DESC, u.user_id ASC
+            ORDER BY s.count DESC, u.user_id ASC
             LIMIT ?;
             """,
             (key, limit),
@@ -561,13 +790,13 @@ def achievement_rank_by_count_global(db_path: str, *, key: str, limit: int = 20)
 
 
 def streak_rank(
-    db_path: str, *, chat_id: int, key: str, limit: int = 20
+    db: Database, *, chat_id: int, key: str, limit: int = 20
 ) -> list[tuple[int, str, int]]:
     """
     连胜排行榜（按 streaks.streak）
     返回 (user_id, display_name, streak)
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             """
             SELECT
@@ -592,13 +821,13 @@ def streak_rank(
 
 
 def streak_rank_global(
-    db_path: str, *, key: str, limit: int = 20
+    db: Database, *, key: str, limit: int = 20
 ) -> list[tuple[int, str, int, int | None, str | None]]:
     """
     全局（跨所有 chat）连胜排行榜：取每个用户的最大 streak
     返回 (user_id, display_name, streak, chat_id, chat_title)
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             """
             WITH ranked AS (
@@ -642,11 +871,11 @@ def streak_rank_global(
     return out
 
 
-def get_streak_best_global(db_path: str, *, user_id: int, key: str) -> tuple[int, int | None, str | None]:
+def get_streak_best_global(db: Database, *, user_id: int, key: str) -> tuple[int, int | None, str | None]:
     """
     全局（跨所有 chat）取该用户最大 streak，返回 (streak, chat_id, chat_title)
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         row = conn.execute(
             """
             SELECT st.streak AS streak, st.chat_id AS chat_id, c.title AS chat_title
@@ -667,8 +896,8 @@ def get_streak_best_global(db_path: str, *, user_id: int, key: str) -> tuple[int
     )
 
 
-def session_today_exists(db_path: str, *, chat_id: int, user_id: int, day: str) -> bool:
-    with connect(db_path) as conn:
+def session_today_exists(db: Database, *, chat_id: int, user_id: int, day: str) -> bool:
+    with _open(db) as conn:
         row = conn.execute(
             """
             SELECT 1
@@ -681,8 +910,8 @@ def session_today_exists(db_path: str, *, chat_id: int, user_id: int, day: str)
     return row is not None
 
 
-def session_today_completed(db_path: str, *, chat_id: int, user_id: int, day: str) -> bool:
-    with connect(db_path) as conn:
+def session_today_completed(db: Database, *, chat_id: int, user_id: int, day: str) -> bool:
+    with _open(db) as conn:
         row = conn.execute(
             """
             SELECT 1
@@ -695,30 +924,57 @@ def session_today_completed(db_path: str, *, chat_id: int, user_id: int, day: st
     return row is not None
 
 
-def today_checkin_position(db_path: str, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
+def session_today_status(db: Database, *, chat_id: int, user_id: int, day: str) -> tuple[bool, bool]:
     """
-    返回该 session 在“本群今日签到”中的名次（从 1 开始）。
-    规则：按 check_in 时间升序；同一时间按 id 升序。
+    (当日有 session, 当日已签退)：一次查询拿到两个标记。
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         row = conn.execute(
             """
-            SELECT COUNT(1) AS n
+            SELECT COUNT(1) AS n, COUNT(check_out) AS done
             FROM sessions
-            WHERE chat_id=?
-              AND session_day=?
-              AND (
-                julianday(check_in) < julianday(?)
-                OR (check_in = ? AND id <= ?)
-              );
+            WHERE chat_id=? AND user_id=? AND session_day=?;
             """,
-            (chat_id, day, check_in.isoformat(), check_in.isoformat(), session_id),
+            (chat_id, user_id, day),
         ).fetchone()
+    return int(row["n"]) > 0, int(row["done"]) > 0
+
+
+def today_checkin_position(db: Database, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
+    """
+    返回该 session 在“本群今日签到”中的名次（从 1 开始）。
+    规则：按 check_in 时间升序；同一时间按 id 升序。
+    """
+    with _open(db) as conn:
+        return _checkin_position(conn, chat_id=chat_id, session_id=session_id, check_in=check_in, day=day)
+
+
+def _checkin_position(conn: sqlite3.Connection, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
+    row = conn.execute(
+        """
+        SELECT COUNT(1) AS n
+        FROM sessions
+        WHERE chat_id=?
+          AND session_day=?
+          AND (
+            julianday(check_in) < julianday(?)
+            OR (check_in = ? AND id <= ?)
+          );
+        """,
+        (chat_id, day, check_in.isoformat(), check_in.isoformat(), session_id),
+    ).fetchone()
     n = int(row["n"]) if row else 0
     return n if n > 0 else 1
 
 
-def leaderboard(db_path: str, *, chat_id: int, mode: str, now: datetime) -> list[tuple[int, str, int]]:
+def _sql_limit(limit: int | None) -> int:
+    # SQLite 的 LIMIT 负数表示不限；带 LIMIT N 时排序只保留前 N 行
+    return -1 if limit is None else limit
+
+
+def leaderboard(
+    db: Database, *, chat_id: int, mode: str, now: datetime, limit: int | None = None
+) -> list[tuple[int, str, int]]:
     where = ""
     params: list[object] = [chat_id]
     if mode == "today":
@@ -726,7 +982,7 @@ def leaderboard(db_path: str, *, chat_id: int, mode: str, now: datetime) -> list
         where = "AND s.session_day = ?"
         params.append(day)
 
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             f"""
             SELECT
@@ -745,9 +1001,10 @@ def leaderboard(db_path: str, *, chat_id: int, mode: str, now: datetime) -> list
             WHERE s.chat_id = ?
             {where}
             GROUP BY u.user_id
-            ORDER BY seconds DESC;
+            ORDER BY seconds DESC
+            LIMIT ?;
             """,
-            (now.isoformat(), *params),
+            (now.isoformat(), *params, _sql_limit(limit)),
         ).fetchall()
 
     out: list[tuple[int, str, int]] = []
@@ -760,7 +1017,7 @@ def leaderboard(db_path: str, *, chat_id: int, mode: str, now: datetime) -> list
     return out
 
 
-def leaderboard_global(db_path: str, *, mode: str, now: datetime) -> list[tuple[int, str, int]]:
+def leaderboard_global(db: Database, *, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
     """
     全局（跨所有 chat）清醒时长排行榜
     返回 (user_id, display_name, seconds)
@@ -772,7 +1029,7 @@ def leaderboard_global(db_path: str, *, mode: str, now: datetime) -> list[tuple[
         where = "AND s.session_day = ?"
         params.append(day)
 
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         rows = conn.execute(
             f"""
             SELECT
@@ -791,9 +1048,10 @@ def leaderboard_global(db_path: str, *, mode: str, now: datetime) -> list[tuple[
             WHERE 1=1
             {where}
             GROUP BY u.user_id
-            ORDER BY seconds DESC;
+            ORDER BY seconds DESC
+            LIMIT ?;
             """,
-            (now.isoformat(), *params),
+            (now.isoformat(), *params, _sql_limit(limit)),
         ).fetchall()
 
     out: list[tuple[int, str, int]] = []
@@ -806,12 +1064,12 @@ def leaderboard_global(db_path: str, *, mode: str, now: datetime) -> list[tuple[
     return out
 
 
-def open_user_ids(db_path: str, *, chat_id: int, day: str | None = None) -> set[int]:
+def open_user_ids(db: Database, *, chat_id: int, day: str | None = None) -> set[int]:
     """
     返回某个 chat 中当前“未签退”的用户集合（sessions.check_out IS NULL）。
     用于榜单/状态展示，避免在 handlers 层逐个 user_id 查询。
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         if day:
             rows = conn.execute(
                 """
@@ -833,11 +1091,11 @@ def open_user_ids(db_path: str, *, chat_id: int, day: str | None = None) -> set[
     return {int(r["user_id"]) for r in rows}
 
 
-def open_user_ids_global(db_path: str, day: str | None = None) -> set[int]:
+def open_user_ids_global(db: Database, day: str | None = None) -> set[int]:
     """
     返回全局（跨所有 chat）当前“未签退”的用户集合。
     """
-    with connect(db_path) as conn:
+    with _open(db) as conn:
         if day:
             rows = conn.execute(
                 """
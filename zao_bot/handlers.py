@@ -1,19 +1,24 @@
 from __future__ import annotations
 
+import asyncio
 import calendar
 import random
-from dataclasses import dataclass
+import re
+import weakref
+from dataclasses import dataclass, field
 from datetime import date, datetime, timezone
 from datetime import timedelta
+from zoneinfo import ZoneInfo
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, User
+from telegram import Bot, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Update, User
 from telegram.ext import ContextTypes
 
 from config import Settings
 from zao_bot import achievements
 from zao_bot.messages import MessageCatalog
-from zao_bot.time_utils import business_day_key, fmt_dt, fmt_td, now as tz_now
+from zao_bot.time_utils import business_day_key, fmt_dt, fmt_secs, fmt_td, now as tz_now
 from zao_bot.storage.base import Storage
+from zao_bot.ttl_cache import TTLCache
 
 
 def display_name(u: User) -> str:
@@ -30,14 +35,40 @@ def target_user(update: Update) -> User | None:
     return update.effective_user
 
 
+class MemberNameCache:
+    """
+    进程内 (chat_id, user_id) -> 展示名 的 TTL + LRU 缓存。
+    用于石头剪刀布等场景渲染双方名字，命中时省掉 get_chat_member 的网络往返。
+    """
+
+    def __init__(self, *, maxsize: int = 10_000, ttl: float = 3600.0) -> None:
+        self._cache: TTLCache[tuple[int, int], str] = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, chat_id: int, user_id: int) -> str | None:
+        return self._cache.get((chat_id, user_id))
+
+    def put(self, chat_id: int, user_id: int, name: str) -> None:
+        self._cache.put((chat_id, user_id), name)
+
+
 @dataclass(frozen=True)
 class HandlerDeps:
     settings: Settings
     messages: MessageCatalog
     storage: Storage
+    member_names: MemberNameCache = field(default_factory=MemberNameCache)
+    # 按 chat 串行化的锁（不同 chat 之间互不阻塞；无人持有时自动回收）
+    chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = field(default_factory=weakref.WeakValueDictionary)
+    # 石头剪刀布：game_id -> 尚未发出的“进度”消息编辑（去抖）
+    rsp_progress_edits: dict[int, asyncio.TimerHandle] = field(default_factory=dict)
+    # 时区启动时解析一次，各 handler 直接复用这个实例（不必每条更新都经 settings.tzinfo 查缓存）
+    tz: ZoneInfo = field(init=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "tz", self.settings.tzinfo)
 
 
-def event_time(update: Update, deps: HandlerDeps) -> datetime:
+def event_time(update: Update, tz: ZoneInfo) -> datetime:
     """
     统一使用“用户消息发出时间”作为事件时间（而不是 bot 收到/处理时间）。
     Telegram 的 message.date 通常是 UTC 时间；这里会转换到配置的 TZ。
@@ -47,8 +78,8 @@ def event_time(update: Update, deps: HandlerDeps) -> datetime:
         dt: datetime = msg.date
         if dt.tzinfo is None:
             dt = dt.replace(tzinfo=timezone.utc)
-        return dt.astimezone(deps.settings.tzinfo)
-    return tz_now(deps.settings.tzinfo)
+        return dt.astimezone(tz)
+    return tz_now(tz)
 
 
 def _upsert(update: Update, deps: HandlerDeps) -> None:
@@ -56,6 +87,7 @@ def _upsert(update: Update, deps: HandlerDeps) -> None:
         return
     u = update.effective_user
     c = update.effective_chat
+    deps.member_names.put(c.id, u.id, display_name(u))
     deps.storage.upsert_user_and_chat(
         user_id=u.id,
         username=u.username,
@@ -64,26 +96,87 @@ def _upsert(update: Update, deps: HandlerDeps) -> None:
         chat_id=c.id,
         chat_title=getattr(c, "title", None),
         chat_type=c.type,
-        updated_at=tz_now(deps.settings.tzinfo),
+        updated_at=tz_now(deps.tz),
     )
 
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+def _chat_lock(deps: HandlerDeps, chat_id: int) -> asyncio.Lock:
+    lock = deps.chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        deps.chat_locks[chat_id] = lock
+    return lock
+
+
+async def _member_name(deps: HandlerDeps, bot: Bot, chat_id: int, user_id: int) -> str:
+    """
+    群成员展示名：优先查进程内缓存，未命中再调 get_chat_member；失败时退回 user_id。
+    """
+    name = deps.member_names.get(chat_id, user_id)
+    if name is not None:
+        return name
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+    except Exception:
+        return str(user_id)
+    name = display_name(member.user)
+    deps.member_names.put(chat_id, user_id, name)
+    return name
+
+
+# Telegram 单条消息文本上限（按 UTF-16 code unit 计）
+_TG_TEXT_LIMIT = 4096
+
+
+def _achievement_lines(deps: HandlerDeps, keys: list[str]) -> list[str]:
+    if not keys:
+        return []
+    awarded, unlocked = achievements.partition_unlocked(keys)
+    lines: list[str] = []
+    if awarded:
+        names = [deps.messages.render(f"ach_name_{k}") for k in awarded]
+        lines.append(deps.messages.render(deps.messages.awarded_tpl, achievements="、".join(names)))
+    if unlocked:
+        names = [deps.messages.render(f"ach_name_{k}") for k in unlocked]
+        lines.append(deps.messages.render("ach_unlocked", achievements="、".join(names)))
+    return lines
+
+
+async def _reply_with_extra(update: Update, text: str, extra: list[str]) -> None:
+    """
+    主回复 + 附加行（如成就提示）合并成一条消息，少一次 Bot API 调用；
+    合并后超过 Telegram 长度上限时退回分两条发送。
+    """
+    if not extra:
+        await update.effective_message.reply_text(text)
+        return
+    tail = "\n".join(extra)
+    combined = f"{text}\n\n{tail}"
+    if len(combined.encode("utf-16-le")) // 2 <= _TG_TEXT_LIMIT:
+        await update.effective_message.reply_text(combined)
+        return
+    await update.effective_message.reply_text(text)
+    await update.effective_message.reply_text(tail)
+
+
+async def cmd_start(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     _upsert(update, deps)
     await update.effective_message.reply_text(deps.messages.render("help"))
 
 
-async def cmd_year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# /year 的进度条长度参数（1~2 位数字，范围另行校验）
+_BAR_RE = re.compile(r"^(\d{1,2})$")
+
+
+async def cmd_year(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     /year：返回当前年度的日期进度条（今年总天数 vs 今天是第几天）。
     """
-    deps: HandlerDeps = context.bot_data["deps"]
     _upsert(update, deps)
     if not update.effective_message:
         return
 
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     today = now.date()
     y = today.year
 
@@ -102,13 +195,11 @@ async def cmd_year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # 允许通过参数调更细：/year 48  (默认 20：更适配手机屏幕；范围限制避免太容易换行)
     bar_len = 20
     args = [a.strip() for a in (context.args or []) if a.strip()]
-    if args:
-        try:
-            n = int(args[0])
-            if 8 <= n <= 60:
-                bar_len = n
-        except ValueError:
-            pass
+    m = _BAR_RE.match(args[0]) if args else None
+    if m:
+        n = int(m.group(1))
+        if 8 <= n <= 60:
+            bar_len = n
 
     # 更细粒度的字符进度：每格 1/8（▏▎▍▌▋▊▉ + 满格用█）
     partial = ["", "▏", "▎", "▍", "▌", "▋", "▊", "▉"]
@@ -134,12 +225,11 @@ async def cmd_year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_message.reply_text(text)
 
 
-async def cmd_zao(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+async def cmd_zao(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat or not update.effective_user:
         return
     _upsert(update, deps)
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     today_key = business_day_key(now, cutoff_hour=4)
 
     if deps.storage.session_today_completed(chat_id=update.effective_chat.id, user_id=update.effective_user.id, day=today_key):
@@ -148,52 +238,22 @@ async def cmd_zao(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    ok = deps.storage.check_in(chat_id=update.effective_chat.id, user_id=update.effective_user.id, ts=now)
-    if ok:
-        # 签到成功 + 今日第N个签到
-        open_sess = deps.storage.get_open_session(chat_id=update.effective_chat.id, user_id=update.effective_user.id, day=today_key)
-        if open_sess:
-            n = deps.storage.today_checkin_position(
-                chat_id=update.effective_chat.id,
-                session_id=open_sess.session_id,
-                check_in=open_sess.check_in,
-                day=today_key,
-            )
-            await update.effective_message.reply_text(
-                deps.messages.render(
-                    "checkin_ok_with_order",
-                    name=display_name(update.effective_user),
-                    time=fmt_dt(now),
-                    n=n,
-                )
-            )
-
-            # 成就：今日最早 / 连续最早（可单独发送）
-            res = achievements.on_check_in(
-                storage=deps.storage,
-                chat_id=update.effective_chat.id,
-                user_id=update.effective_user.id,
-                session_id=open_sess.session_id,
-                check_in_ts=open_sess.check_in,
-                now_ts=now,
-            )
-            if res.unlocked:
-                awarded = [k for k in res.unlocked if not achievements.is_single_achievement(k)]
-                unlocked = [k for k in res.unlocked if achievements.is_single_achievement(k)]
-                lines: list[str] = []
-                if awarded:
-                    names = [deps.messages.render(f"ach_name_{k}") for k in awarded]
-                    # 兼容旧 messages.toml：没定义 ach_awarded 时退回 ach_unlocked
-                    tpl = "ach_awarded" if "ach_awarded" in deps.messages.messages else "ach_unlocked"
-                    lines.append(deps.messages.render(tpl, achievements="、".join(names)))
-                if unlocked:
-                    names = [deps.messages.render(f"ach_name_{k}") for k in unlocked]
-                    lines.append(deps.messages.render("ach_unlocked", achievements="、".join(names)))
-                await update.effective_message.reply_text("\n".join(lines))
-        else:
-            await update.effective_message.reply_text(
-                deps.messages.render("checkin_ok", name=display_name(update.effective_user), time=fmt_dt(now))
-            )
+    # 签到 + 今日第N个 + 今日最早/连续最早：一次调用、一个事务
+    rec = achievements.record_check_in(
+        storage=deps.storage, chat_id=update.effective_chat.id, user_id=update.effective_user.id, now_ts=now
+    )
+    if rec is not None:
+        # 成就与签到结果合并成一条消息
+        await _reply_with_extra(
+            update,
+            deps.messages.render(
+                "checkin_ok_with_order",
+                name=display_name(update.effective_user),
+                time=fmt_dt(now),
+                n=rec.position,
+            ),
+            _achievement_lines(deps, rec.unlocked),
+        )
         return
 
     open_sess = deps.storage.get_open_session(chat_id=update.effective_chat.id, user_id=update.effective_user.id, day=today_key)
@@ -211,12 +271,11 @@ async def cmd_zao(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
-async def cmd_wan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+async def cmd_wan(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat or not update.effective_user:
         return
     _upsert(update, deps)
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     today_key = business_day_key(now, cutoff_hour=4)
 
     ok, dur, check_in_ts, session_id = deps.storage.check_out(
@@ -248,17 +307,7 @@ async def cmd_wan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    await update.effective_message.reply_text(
-        deps.messages.render(
-            "checkout_ok",
-            name=display_name(update.effective_user),
-            time=fmt_dt(now),
-            awake=fmt_td(dur),
-            check_in=fmt_dt(check_in_ts),
-        )
-    )
-
-    # 成就：准点下班 / 辛苦的一天
+    # 成就：准点下班 / 辛苦的一天（与签退结果合并成一条消息）
     res = achievements.on_check_out(
         storage=deps.storage,
         chat_id=update.effective_chat.id,
@@ -268,22 +317,20 @@ async def cmd_wan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         duration=dur,
         now_ts=now,
     )
-    if res.unlocked:
-        awarded = [k for k in res.unlocked if not achievements.is_single_achievement(k)]
-        unlocked = [k for k in res.unlocked if achievements.is_single_achievement(k)]
-        lines: list[str] = []
-        if awarded:
-            names = [deps.messages.render(f"ach_name_{k}") for k in awarded]
-            tpl = "ach_awarded" if "ach_awarded" in deps.messages.messages else "ach_unlocked"
-            lines.append(deps.messages.render(tpl, achievements="、".join(names)))
-        if unlocked:
-            names = [deps.messages.render(f"ach_name_{k}") for k in unlocked]
-            lines.append(deps.messages.render("ach_unlocked", achievements="、".join(names)))
-        await update.effective_message.reply_text("\n".join(lines))
-
-
-async def cmd_awake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+    await _reply_with_extra(
+        update,
+        deps.messages.render(
+            "checkout_ok",
+            name=display_name(update.effective_user),
+            time=fmt_dt(now),
+            awake=fmt_td(dur),
+            check_in=fmt_dt(check_in_ts),
+        ),
+        _achievement_lines(deps, res.unlocked),
+    )
+
+
+async def cmd_awake(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat:
         return
     _upsert(update, deps)
@@ -291,7 +338,7 @@ async def cmd_awake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     u = target_user(update)
     if not u:
         return
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     today_key = business_day_key(now, cutoff_hour=4)
     open_sess = deps.storage.get_open_session(chat_id=update.effective_chat.id, user_id=u.id, day=today_key)
     if open_sess:
@@ -307,8 +354,13 @@ async def cmd_awake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_message.reply_text(deps.messages.render("awake_none", name=display_name(u)))
 
 
-async def cmd_rank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+# 榜单状态标记：按 is_open 取值（False=💤 已签退，True=🔥 未签退）
+_RANK_EMOJI = ("💤", "🔥")
+# /rank 展示的名次数
+_RANK_LIMIT = 20
+
+
+async def cmd_rank(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat:
         return
     _upsert(update, deps)
@@ -326,18 +378,16 @@ async def cmd_rank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         elif arg in {"today", "day", "daily"}:
             mode = "today"
 
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     today_key = business_day_key(now, cutoff_hour=4)
-    rows = (
-        deps.storage.leaderboard_global(mode=mode, now=now)
-        if is_global
-        else deps.storage.leaderboard(chat_id=update.effective_chat.id, mode=mode, now=now)
-    )
     # 🔥/💤 标记也按业务日过滤，避免历史遗留未签退影响“今日”展示
-    open_ids = (
-        deps.storage.open_user_ids_global(day=today_key)
+    # 只展示前 20 名：截断放进 SQL，不必取回全部再切片
+    rows = (
+        deps.storage.leaderboard_global_with_open(mode=mode, now=now, day=today_key, limit=_RANK_LIMIT)
         if is_global
-        else deps.storage.open_user_ids(chat_id=update.effective_chat.id, day=today_key)
+        else deps.storage.leaderboard_with_open(
+            chat_id=update.effective_chat.id, mode=mode, now=now, day=today_key, limit=_RANK_LIMIT
+        )
     )
     if is_global:
         title = deps.messages.render("rank_title_today_global") if mode == "today" else deps.messages.render("rank_title_all_global")
@@ -348,16 +398,14 @@ async def cmd_rank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     lines: list[str] = [deps.messages.render("rank_header", title=title, time=fmt_dt(now))]
-    for i, (uid, name, sec) in enumerate(rows[:20], start=1):
-        emoji = "🔥" if uid in open_ids else "💤"
+    for i, (_uid, name, sec, is_open) in enumerate(rows, start=1):
         lines.append(
-            deps.messages.render("rank_line", idx=i, name=name, awake=fmt_td(timedelta(seconds=sec)), emoji=emoji)
+            deps.messages.render("rank_line", idx=i, name=name, awake=fmt_secs(sec), emoji=_RANK_EMOJI[is_open])
         )
     await update.effective_message.reply_text("\n".join(lines))
 
 
-async def cmd_ach(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+async def cmd_ach(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat:
         return
     _upsert(update, deps)
@@ -405,8 +453,20 @@ async def cmd_ach(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_message.reply_text("\n".join(lines))
 
 
-async def cmd_achrank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    deps: HandlerDeps = context.bot_data["deps"]
+# /achrank 计数类榜单：参数（含别名） -> (成就 key, 标题模板 key；全局版追加 _global)
+_ACHRANK_COUNT: dict[str, tuple[str, str]] = {
+    "daily": (achievements.ACH_DAILY_EARLIEST, "ach_rank_title_daily"),
+    "earliest": (achievements.ACH_DAILY_EARLIEST, "ach_rank_title_daily"),
+    "ontime": (achievements.ACH_ONTIME_8H, "ach_rank_title_ontime"),
+    "8h": (achievements.ACH_ONTIME_8H, "ach_rank_title_ontime"),
+    "8": (achievements.ACH_ONTIME_8H, "ach_rank_title_ontime"),
+    "longday": (achievements.ACH_LONGDAY_12H, "ach_rank_title_longday"),
+    "12h": (achievements.ACH_LONGDAY_12H, "ach_rank_title_longday"),
+    "12": (achievements.ACH_LONGDAY_12H, "ach_rank_title_longday"),
+}
+
+
+async def cmd_achrank(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat:
         return
     _upsert(update, deps)
@@ -418,12 +478,14 @@ async def cmd_achrank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     is_global = ("global" in args) or ("g" in args)
     args = [a for a in args if a not in {"global", "g"}]
     kind = (args[0] if args else "daily")
-    if kind in {"daily", "earliest"}:
-        title = deps.messages.render("ach_rank_title_daily_global") if is_global else deps.messages.render("ach_rank_title_daily")
+    spec = _ACHRANK_COUNT.get(kind)
+    if spec:
+        key, title_key = spec
+        title = deps.messages.render(f"{title_key}_global" if is_global else title_key)
         rows = (
-            deps.storage.achievement_rank_by_count_global(key=achievements.ACH_DAILY_EARLIEST)
+            deps.storage.achievement_rank_by_count_global(key=key)
             if is_global
-            else deps.storage.achievement_rank_by_count(chat_id=update.effective_chat.id, key=achievements.ACH_DAILY_EARLIEST)
+            else deps.storage.achievement_rank_by_count(chat_id=update.effective_chat.id, key=key)
         )
         lines = [title]
         for i, (_uid, name, count) in enumerate(rows, start=1):
@@ -448,32 +510,6 @@ async def cmd_achrank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.effective_message.reply_text("\n".join(lines) if rows else deps.messages.render("ach_rank_empty"))
         return
 
-    if kind in {"ontime", "8h", "8"}:
-        title = deps.messages.render("ach_rank_title_ontime_global") if is_global else deps.messages.render("ach_rank_title_ontime")
-        rows = (
-            deps.storage.achievement_rank_by_count_global(key=achievements.ACH_ONTIME_8H)
-            if is_global
-            else deps.storage.achievement_rank_by_count(chat_id=update.effective_chat.id, key=achievements.ACH_ONTIME_8H)
-        )
-        lines = [title]
-        for i, (_uid, name, count) in enumerate(rows, start=1):
-            lines.append(deps.messages.render("ach_rank_line_count", idx=i, name=name, count=count))
-        await update.effective_message.reply_text("\n".join(lines) if rows else deps.messages.render("ach_rank_empty"))
-        return
-
-    if kind in {"longday", "12h", "12"}:
-        title = deps.messages.render("ach_rank_title_longday_global") if is_global else deps.messages.render("ach_rank_title_longday")
-        rows = (
-            deps.storage.achievement_rank_by_count_global(key=achievements.ACH_LONGDAY_12H)
-            if is_global
-            else deps.storage.achievement_rank_by_count(chat_id=update.effective_chat.id, key=achievements.ACH_LONGDAY_12H)
-        )
-        lines = [title]
-        for i, (_uid, name, count) in enumerate(rows, start=1):
-            lines.append(deps.messages.render("ach_rank_line_count", idx=i, name=name, count=count))
-        await update.effective_message.reply_text("\n".join(lines) if rows else deps.messages.render("ach_rank_empty"))
-        return
-
     await update.effective_message.reply_text(deps.messages.render("ach_rank_help"))
 
 
@@ -544,9 +580,8 @@ def generate_heatmap(storage: Storage, user_id: int, year: int, month: int, tz:
     return "\n".join(lines)
 
 
-async def cmd_heatmap(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def cmd_heatmap(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """显示用户的签到热力图"""
-    deps: HandlerDeps = context.bot_data["deps"]
     if not update.effective_message or not update.effective_user:
         return
 
@@ -557,7 +592,7 @@ async def cmd_heatmap(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     # 解析参数（可选：指定月份）
     args = context.args or []
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     year, month = now.year, now.month
 
     if args and len(args[0]) >= 7:  # YYYY-MM
@@ -579,16 +614,15 @@ async def cmd_heatmap(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         user_id=target.id,
         year=year,
         month=month,
-        tz=deps.settings.tzinfo,
+        tz=deps.tz,
     )
 
     # 使用代码块格式确保等宽字体对齐
     await update.effective_message.reply_text(f"```\n{heatmap_text}\n```", parse_mode="Markdown")
 
 
-async def cmd_gun(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def cmd_gun(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """俄罗斯轮盘游戏"""
-    deps: HandlerDeps = context.bot_data["deps"]
     if not update.effective_chat or not update.effective_user or not update.effective_message:
         return
 
@@ -623,7 +657,7 @@ async def cmd_gun(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             chambers=chambers,
             bullet_position=bullet_position,
             created_by=user_id,
-            created_at=event_time(update, deps),
+            created_at=event_time(update, deps.tz),
         )
 
         await update.effective_message.reply_text(
@@ -644,18 +678,17 @@ async def cmd_gun(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     new_position = game.current_position + 1
     is_shot = new_position == game.bullet_position
 
-    # 记录尝试
-    deps.storage.record_roulette_attempt(
+    # 记录尝试；中枪则结束游戏，否则推进位置（同一个事务）
+    deps.storage.pull_roulette_trigger(
         chat_id=chat_id,
         user_id=user_id,
         position=new_position,
-        result="shot" if is_shot else "safe",
-        created_at=event_time(update, deps),
+        shot=is_shot,
+        created_at=event_time(update, deps.tz),
     )
 
     if is_shot:
         # 中枪！游戏结束
-        deps.storage.delete_roulette(chat_id=chat_id)
         await update.effective_message.reply_text(
             f"💥 BANG! {display_name(update.effective_user)} 中枪了！\n" f"游戏结束，使用 /gun n 重新开始"
         )
@@ -664,16 +697,13 @@ async def cmd_gun(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         remaining = game.chambers - new_position
         probability = f"1/{remaining}" if remaining > 0 else "?"
 
-        deps.storage.update_roulette_position(chat_id=chat_id, position=new_position)
-
         await update.effective_message.reply_text(
             f"🔫 咔哒~ {display_name(update.effective_user)} 安全！\n" f"剩余弹槽: {remaining}发（{probability} 概率中枪）"
         )
 
 
-async def cmd_wake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def cmd_wake(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """设置叫醒提醒"""
-    deps: HandlerDeps = context.bot_data["deps"]
     if not update.effective_chat or not update.effective_user or not update.effective_message:
         return
 
@@ -715,7 +745,7 @@ async def cmd_wake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     # 计算下次触发时间（明天的这个时间）
-    now = event_time(update, deps)
+    now = event_time(update, deps.tz)
     next_trigger = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
     if next_trigger <= now:
         next_trigger += timedelta(days=1)
@@ -733,9 +763,22 @@ async def cmd_wake(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_message.reply_text(f"⏰ 叫醒提醒已设置！\n明天 {time_str} 我会在这里@你~")
 
 
-async def cmd_rsp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# 石头剪刀布：callback_data 里的选择 -> 整数编码（数据库仍存字符串）
+_RSP_INDEX: dict[str, int] = {"rock": 0, "paper": 1, "scissors": 2}
+_RSP_LABELS = ("✊ 石头", "✋ 布", "✌️ 剪刀")
+_RSP_OUTCOMES = ("draw", "challenger", "opponent")
+# 选择按钮（发起挑战和进度更新共用同一个对象；PTB 的 TelegramObject 创建后不可变）
+RSP_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(_RSP_LABELS[i], callback_data=f"rsp:{choice}") for choice, i in _RSP_INDEX.items()]]
+)
+# 进度消息的去抖窗口（秒）
+_RSP_PROGRESS_DEBOUNCE_SECONDS = 0.3
+# 对局消息的公共开头；后面再拼接进度/提示
+_RSP_CHALLENGE_TPL = "🎮 {challenger} 向 {opponent} 发起了石头剪刀布挑战！\n\n"
+
+
+async def cmd_rsp(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """石头剪刀布游戏"""
-    deps: HandlerDeps = context.bot_data["deps"]
     if not update.effective_chat or not update.effective_user or not update.effective_message:
         return
 
@@ -778,122 +821,115 @@ async def cmd_rsp(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     # /rsp ca/cancel - 取消当前游戏
+    # 与按钮回调（独立任务）共用 per-chat 锁：不会在回调结算对局的中途把对局删掉/把结果消息改成“已取消”
     if args and args[0] in {"ca", "cancel"}:
-        pending = deps.storage.get_pending_rsp_game(
-            chat_id=update.effective_chat.id,
-            user_id=update.effective_user.id
-        )
-        if not pending:
-            await update.effective_message.reply_text("你没有待处理的游戏")
-            return
+        async with _chat_lock(deps, update.effective_chat.id):
+            pending = deps.storage.get_pending_rsp_game(
+                chat_id=update.effective_chat.id,
+                user_id=update.effective_user.id
+            )
+            if not pending:
+                await update.effective_message.reply_text("你没有待处理的游戏")
+                return
 
-        # 获取双方用户名
-        try:
-            challenger = await context.bot.get_chat_member(pending.chat_id, pending.challenger_id)
-            opponent = await context.bot.get_chat_member(pending.chat_id, pending.opponent_id)
-            challenger_name = display_name(challenger.user)
-            opponent_name = display_name(opponent.user)
-        except Exception:
-            challenger_name = str(pending.challenger_id)
-            opponent_name = str(pending.opponent_id)
-
-        # 删除游戏
-        deps.storage.delete_rsp_game(game_id=pending.id)
-
-        # 更新原消息
-        if pending.message_id:
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=pending.chat_id,
-                    message_id=pending.message_id,
-                    text=f"🚫 游戏已取消\n\n{challenger_name} vs {opponent_name}\n\n由 {display_name(update.effective_user)} 取消"
-                )
-            except Exception:
-                pass  # 消息可能已被删除
+            # 删除游戏，并丢掉尚未发出的进度编辑（否则它会把“已取消”改回进度）
+            deps.storage.delete_rsp_game(game_id=pending.id)
+            pending_edit = deps.rsp_progress_edits.pop(pending.id, None)
+            if pending_edit is not None:
+                pending_edit.cancel()
+
+            # 获取双方用户名
+            challenger_name = await _member_name(deps, context.bot, pending.chat_id, pending.challenger_id)
+            opponent_name = await _member_name(deps, context.bot, pending.chat_id, pending.opponent_id)
+
+            # 更新原消息
+            if pending.message_id:
+                try:
+                    await context.bot.edit_message_text(
+                        chat_id=pending.chat_id,
+                        message_id=pending.message_id,
+                        text=f"🚫 游戏已取消\n\n{challenger_name} vs {opponent_name}\n\n由 {display_name(update.effective_user)} 取消"
+                    )
+                except Exception:
+                    pass  # 消息可能已被删除
 
         await update.effective_message.reply_text("游戏已取消")
         return
 
-    # 检查是否有待处理的游戏
-    pending = deps.storage.get_pending_rsp_game(
-        chat_id=update.effective_chat.id,
-        user_id=update.effective_user.id
-    )
-    if pending:
-        await update.effective_message.reply_text(
-            "你还有一局未完成的游戏！请先完成当前游戏。"
+    # 发起新对局同样持有本 chat 的锁：检查“未完成的对局”到写入新对局之间不会被按钮回调插入
+    async with _chat_lock(deps, update.effective_chat.id):
+        # 检查是否有待处理的游戏
+        pending = deps.storage.get_pending_rsp_game(
+            chat_id=update.effective_chat.id,
+            user_id=update.effective_user.id
         )
-        return
-
-    # 获取对手（必须 @ 某人或回复某人的消息）
-    opponent = None
-    if update.effective_message.reply_to_message and update.effective_message.reply_to_message.from_user:
-        opponent = update.effective_message.reply_to_message.from_user
-    elif update.effective_message.entities:
-        # 检查是否有 @mention
-        for entity in update.effective_message.entities:
-            if entity.type == "mention":
-                # 无法直接获取 user_id，需要用户回复消息方式
-                pass
-            elif entity.type == "text_mention" and entity.user:
-                opponent = entity.user
-                break
+        if pending:
+            await update.effective_message.reply_text(
+                "你还有一局未完成的游戏！请先完成当前游戏。"
+            )
+            return
 
-    if not opponent:
-        await update.effective_message.reply_text(
-            "请回复某人的消息或 @某人 来发起挑战！\n用法: /rsp @用户名"
-        )
-        return
+        # 获取对手（必须 @ 某人或回复某人的消息）
+        opponent = None
+        if update.effective_message.reply_to_message and update.effective_message.reply_to_message.from_user:
+            opponent = update.effective_message.reply_to_message.from_user
+        elif update.effective_message.entities:
+            # 检查是否有 @mention
+            for entity in update.effective_message.entities:
+                if entity.type == "mention":
+                    # 无法直接获取 user_id，需要用户回复消息方式
+                    pass
+                elif entity.type == "text_mention" and entity.user:
+                    opponent = entity.user
+                    break
+
+        if not opponent:
+            await update.effective_message.reply_text(
+                "请回复某人的消息或 @某人 来发起挑战！\n用法: /rsp @用户名"
+            )
+            return
 
-    if opponent.id == update.effective_user.id:
-        await update.effective_message.reply_text("不能和自己玩！")
-        return
+        if opponent.id == update.effective_user.id:
+            await update.effective_message.reply_text("不能和自己玩！")
+            return
 
-    if opponent.is_bot:
-        await update.effective_message.reply_text("不能和机器人玩！")
-        return
+        if opponent.is_bot:
+            await update.effective_message.reply_text("不能和机器人玩！")
+            return
 
-    # 检查对手是否有待处理的游戏
-    opponent_pending = deps.storage.get_pending_rsp_game(
-        chat_id=update.effective_chat.id,
-        user_id=opponent.id
-    )
-    if opponent_pending:
-        await update.effective_message.reply_text(
-            f"{display_name(opponent)} 还有一局未完成的游戏！"
+        # 检查对手是否有待处理的游戏
+        opponent_pending = deps.storage.get_pending_rsp_game(
+            chat_id=update.effective_chat.id,
+            user_id=opponent.id
         )
-        return
+        if opponent_pending:
+            await update.effective_message.reply_text(
+                f"{display_name(opponent)} 还有一局未完成的游戏！"
+            )
+            return
 
-    # 创建游戏按钮
-    keyboard = [
-        [
-            InlineKeyboardButton("✊ 石头", callback_data="rsp:rock"),
-            InlineKeyboardButton("✋ 布", callback_data="rsp:paper"),
-            InlineKeyboardButton("✌️ 剪刀", callback_data="rsp:scissors"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        # 记住对手名字，按钮回调里直接命中缓存
+        deps.member_names.put(update.effective_chat.id, opponent.id, display_name(opponent))
 
-    # 发送游戏消息
-    msg = await update.effective_message.reply_text(
-        f"🎮 {display_name(update.effective_user)} 向 {display_name(opponent)} 发起了石头剪刀布挑战！\n\n"
-        f"请双方点击下方按钮选择：",
-        reply_markup=reply_markup
-    )
+        # 发送游戏消息
+        msg = await update.effective_message.reply_text(
+            _RSP_CHALLENGE_TPL.format(challenger=display_name(update.effective_user), opponent=display_name(opponent))
+            + "请双方点击下方按钮选择：",
+            reply_markup=RSP_KEYBOARD
+        )
 
-    # 创建游戏记录
-    deps.storage.create_rsp_game(
-        chat_id=update.effective_chat.id,
-        challenger_id=update.effective_user.id,
-        opponent_id=opponent.id,
-        message_id=msg.message_id,
-        created_at=event_time(update, deps)
-    )
+        # 创建游戏记录
+        deps.storage.create_rsp_game(
+            chat_id=update.effective_chat.id,
+            challenger_id=update.effective_user.id,
+            opponent_id=opponent.id,
+            message_id=msg.message_id,
+            created_at=event_time(update, deps.tz)
+        )
 
 
-async def rsp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def rsp_callback(deps: HandlerDeps, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理石头剪刀布按钮点击"""
-    deps: HandlerDeps = context.bot_data["deps"]
     query = update.callback_query
     if not query or not query.data or not query.message or not query.from_user:
         return
@@ -905,146 +941,131 @@ async def rsp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     choice = parts[1]  # "rock", "paper", "scissors"
-    if choice not in {"rock", "paper", "scissors"}:
+    if choice not in _RSP_INDEX:
         await query.answer()
         return
 
-    # 查找游戏
-    game = deps.storage.get_pending_rsp_game(
-        chat_id=query.message.chat.id,
-        user_id=query.from_user.id
-    )
+    storage = deps.storage
+    apply_choice = storage.apply_rsp_choice
 
-    if not game:
-        await query.answer("找不到你的游戏记录！", show_alert=False)
-        return
+    # 同一 chat 内串行处理：双方同时点击时不会交错写库/重复编辑同一条消息
+    async with _chat_lock(deps, query.message.chat.id):
+        # 查找进行中的游戏并写入选择（一次条件更新；同一用户连点只会生效一次）
+        reason, game = apply_choice(query.message.chat.id, query.from_user.id, choice)
+        if reason == "no_game":
+            await query.answer("找不到你的游戏记录！", show_alert=False)
+            return
+        if reason == "already_chosen":
+            await query.answer("你已经做过选择了！", show_alert=False)
+            return
 
-    # 检查是否是游戏参与者
-    if query.from_user.id not in {game.challenger_id, game.opponent_id}:
-        await query.answer("这不是你的游戏！", show_alert=False)
-        return
+        # 双方都已选择：先在库里结束对局（在任何 Bot API 等待之前），随后的 /rsp 不会再看到这局
+        result = None
+        if game and game.challenger_choice and game.opponent_choice:
+            c = _RSP_INDEX[game.challenger_choice]
+            o = _RSP_INDEX[game.opponent_choice]
+            result = _determine_rsp_winner(c, o)
+            winner_id = None
+            if result == "challenger":
+                winner_id = game.challenger_id
+            elif result == "opponent":
+                winner_id = game.opponent_id
+            # 按钮回调的 message.date 是挑战消息的发出时间，这里用处理时间作为结束时间
+            storage.complete_rsp_game(game_id=game.id, winner_id=winner_id, completed_at=tz_now(deps.tz))
+
+        # 立即给用户反馈
+        await query.answer("你的选择已记录！", show_alert=False)
+        if not game:
+            return
 
-    # 检查是否已经选择过
-    is_challenger = query.from_user.id == game.challenger_id
-    if is_challenger and game.challenger_choice:
-        await query.answer("你已经做过选择了！", show_alert=False)
-        return
-    if not is_challenger and game.opponent_choice:
-        await query.answer("你已经做过选择了！", show_alert=False)
-        return
+        # 获取用户信息（发起挑战时已写入缓存，通常无需请求 Bot API）
+        challenger_name = await _member_name(deps, context.bot, game.chat_id, game.challenger_id)
+        opponent_name = await _member_name(deps, context.bot, game.chat_id, game.opponent_id)
 
-    # 保存选择
-    deps.storage.update_rsp_choice(
-        game_id=game.id,
-        user_id=query.from_user.id,
-        choice=choice
-    )
+        if result is not None:
+            # 构建结果消息
+            if result == "challenger":
+                result_text = f"🎉 {challenger_name} 获胜！"
+            elif result == "opponent":
+                result_text = f"🎉 {opponent_name} 获胜！"
+            else:
+                result_text = "🤝 平局！"
 
-    # 立即给用户反馈
-    await query.answer("你的选择已记录！", show_alert=False)
+            result_msg = (
+                f"🎮 石头剪刀布结果：\n\n"
+                f"{challenger_name}: {_RSP_LABELS[c]}\n"
+                f"{opponent_name}: {_RSP_LABELS[o]}\n\n"
+                f"{result_text}"
+            )
 
-    # 重新获取游戏状态
-    game = deps.storage.get_rsp_game(game_id=game.id)
-    if not game:
-        return
+            # 取消尚未发出的进度编辑，避免它覆盖结果
+            pending_edit = deps.rsp_progress_edits.pop(game.id, None)
+            if pending_edit is not None:
+                pending_edit.cancel()
 
-    # 获取用户信息
-    try:
-        challenger = await context.bot.get_chat_member(game.chat_id, game.challenger_id)
-        opponent = await context.bot.get_chat_member(game.chat_id, game.opponent_id)
-        challenger_name = display_name(challenger.user)
-        opponent_name = display_name(opponent.user)
-    except Exception:
-        challenger_name = str(game.challenger_id)
-        opponent_name = str(game.opponent_id)
-
-    # 检查是否双方都已选择
-    if game.challenger_choice and game.opponent_choice:
-        # 游戏结束，计算结果
-        result = _determine_rsp_winner(game.challenger_choice, game.opponent_choice)
-
-        # 格式化选择
-        choice_emoji = {
-            "rock": "✊ 石头",
-            "paper": "✋ 布",
-            "scissors": "✌️ 剪刀"
-        }
-
-        # 构建结果消息
-        winner_id = None
-        if result == "challenger":
-            result_text = f"🎉 {challenger_name} 获胜！"
-            winner_id = game.challenger_id
-        elif result == "opponent":
-            result_text = f"🎉 {opponent_name} 获胜！"
-            winner_id = game.opponent_id
+            # 更新消息（显式移除按钮）
+            try:
+                await query.edit_message_text(result_msg, reply_markup=None)
+            except Exception:
+                # 如果编辑失败（消息可能被删除），尝试发送新消息
+                try:
+                    await context.bot.send_message(
+                        chat_id=game.chat_id,
+                        text=result_msg
+                    )
+                except Exception:
+                    pass
         else:
-            result_text = "🤝 平局！"
-            winner_id = None
+            # 还在等待另一方选择 - 更新消息显示进度
+            waiting_msg = _RSP_CHALLENGE_TPL.format(challenger=challenger_name, opponent=opponent_name)
+            if game.challenger_choice and not game.opponent_choice:
+                waiting_msg += f"✅ {challenger_name} 已选择\n⏳ 等待 {opponent_name} 选择..."
+            elif not game.challenger_choice and game.opponent_choice:
+                waiting_msg += f"⏳ 等待 {challenger_name} 选择...\n✅ {opponent_name} 已选择"
+            else:
+                waiting_msg += "请双方点击下方按钮选择："
 
-        result_msg = (
-            f"🎮 石头剪刀布结果：\n\n"
-            f"{challenger_name}: {choice_emoji[game.challenger_choice]}\n"
-            f"{opponent_name}: {choice_emoji[game.opponent_choice]}\n\n"
-            f"{result_text}"
-        )
+            # 保留按钮，更新文本（稍后再发：对方紧接着点击时直接出结果，省掉这次编辑）
+            _schedule_rsp_progress_edit(deps, context, query, game.id, game.chat_id, waiting_msg)
 
-        # 更新消息（显式移除按钮）
-        try:
-            await query.edit_message_text(result_msg, reply_markup=None)
-        except Exception:
-            # 如果编辑失败（消息可能被删除），尝试发送新消息
+
+def _schedule_rsp_progress_edit(
+    deps: HandlerDeps,
+    context: ContextTypes.DEFAULT_TYPE,
+    query: CallbackQuery,
+    game_id: int,
+    chat_id: int,
+    text: str,
+) -> None:
+    """
+    去抖发送对局进度：Telegram 对同一条消息大约 1 次/秒的编辑限制，
+    双方几乎同时点击时，第二次点击会直接把消息编辑成最终结果并取消这里的编辑。
+    """
+    old = deps.rsp_progress_edits.pop(game_id, None)
+    if old is not None:
+        old.cancel()
+
+    async def _flush() -> None:
+        # 与 rsp_callback 用同一把锁：结果分支已取消/替换本次编辑时不再发送
+        async with _chat_lock(deps, chat_id):
+            if deps.rsp_progress_edits.get(game_id) is not handle:
+                return
+            del deps.rsp_progress_edits[game_id]
             try:
-                await context.bot.send_message(
-                    chat_id=game.chat_id,
-                    text=result_msg
-                )
+                await query.edit_message_text(text, reply_markup=RSP_KEYBOARD)
             except Exception:
+                # 编辑失败，忽略
                 pass
 
-        # 标记游戏完成并记录获胜者
-        deps.storage.complete_rsp_game(game_id=game.id, winner_id=winner_id)
-    else:
-        # 还在等待另一方选择 - 更新消息显示进度
-        if game.challenger_choice and not game.opponent_choice:
-            waiting_msg = f"🎮 {challenger_name} 向 {opponent_name} 发起了石头剪刀布挑战！\n\n✅ {challenger_name} 已选择\n⏳ 等待 {opponent_name} 选择..."
-        elif not game.challenger_choice and game.opponent_choice:
-            waiting_msg = f"🎮 {challenger_name} 向 {opponent_name} 发起了石头剪刀布挑战！\n\n⏳ 等待 {challenger_name} 选择...\n✅ {opponent_name} 已选择"
-        else:
-            waiting_msg = f"🎮 {challenger_name} 向 {opponent_name} 发起了石头剪刀布挑战！\n\n请双方点击下方按钮选择："
-
-        # 保留按钮，更新文本
-        keyboard = [
-            [
-                InlineKeyboardButton("✊ 石头", callback_data="rsp:rock"),
-                InlineKeyboardButton("✋ 布", callback_data="rsp:paper"),
-                InlineKeyboardButton("✌️ 剪刀", callback_data="rsp:scissors"),
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        try:
-            await query.edit_message_text(waiting_msg, reply_markup=reply_markup)
-        except Exception:
-            # 编辑失败，忽略
-            pass
+    handle = asyncio.get_running_loop().call_later(
+        _RSP_PROGRESS_DEBOUNCE_SECONDS, lambda: context.application.create_task(_flush())
+    )
+    deps.rsp_progress_edits[game_id] = handle
 
 
-def _determine_rsp_winner(challenger_choice: str, opponent_choice: str) -> str:
-    """判断胜负
+def _determine_rsp_winner(challenger: int, opponent: int) -> str:
+    """判断胜负（参数为 _RSP_INDEX 编码：石头=0、布=1、剪刀=2）
+    每个选择都赢它的前一个（布赢石头、剪刀赢布、石头赢剪刀），所以 (c - o) % 3：0 平局，1 挑战者胜，2 对手胜。
     Returns: "challenger", "opponent", or "draw"
     """
-    if challenger_choice == opponent_choice:
-        return "draw"
-
-    win_conditions = {
-        "rock": "scissors",     # 石头赢剪刀
-        "paper": "rock",        # 布赢石头
-        "scissors": "paper"     # 剪刀赢布
-    }
-
-    if win_conditions.get(challenger_choice) == opponent_choice:
-        return "challenger"
-    return "opponent"
-
-
+    return _RSP_OUTCOMES[(challenger - opponent) % 3]
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from string import Formatter
+from types import MappingProxyType
+from typing import Any, Mapping
+
+from config import _read_toml
 
 
 DEFAULT_MESSAGES: dict[str, str] = {
@@ -55,31 +60,41 @@ DEFAULT_MESSAGES: dict[str, str] = {
 }
 
 
-def _read_toml(path: str) -> dict[str, Any]:
-    try:
-        import tomllib  # py>=3.11
-    except Exception:
-        return {}
-
+def _static_text(tpl: str) -> str | None:
+    """
+    没有占位符的模板（纯文本或只有 {{ }} 转义）预先算好结果，render 时不必每次 format。
+    有占位符或语法有误时返回 None，交给 render 按原逻辑处理。
+    """
+    if "{" not in tpl and "}" not in tpl:
+        return tpl
     try:
-        with open(path, "rb") as f:
-            data = tomllib.load(f)
-    except FileNotFoundError:
-        return {}
-    except Exception:
-        return {}
-
-    if isinstance(data, dict):
-        return data
-    return {}
+        if any(field_name is not None for _, field_name, _, _ in Formatter().parse(tpl)):
+            return None
+        return tpl.format()
+    except ValueError:
+        return None
 
 
 @dataclass(frozen=True)
 class MessageCatalog:
-    messages: dict[str, str]
+    messages: Mapping[str, str]
     path: str | None = None
+    # 成就提示模板 key（启动后不变，构造时算好）
+    awarded_tpl: str = field(init=False)
+    # key -> (最终模板, 无占位符时的渲染结果)；构造时解析好回退链，render 只查一次 dict
+    _templates: Mapping[str, tuple[str, str | None]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # 兼容旧 messages.toml：没定义 ach_awarded 时退回 ach_unlocked
+        object.__setattr__(self, "awarded_tpl", "ach_awarded" if "ach_awarded" in self.messages else "ach_unlocked")
+        templates: dict[str, tuple[str, str | None]] = {}
+        for key in {*DEFAULT_MESSAGES, *self.messages}:
+            tpl = self.messages.get(key) or DEFAULT_MESSAGES.get(key) or key
+            templates[key] = (tpl, _static_text(tpl))
+        object.__setattr__(self, "_templates", templates)
 
     @staticmethod
+    @lru_cache(maxsize=1)
     def load() -> "MessageCatalog":
         """
         优先级：ZAO_MESSAGES 指定的 toml > ./messages.toml > 默认文案
@@ -87,6 +102,8 @@ class MessageCatalog:
         messages.toml 为扁平 key-value，例如：
         help = "..."
         checkin_ok = "{name} ✅ 签到成功：{time}"
+
+        结果按进程缓存（文件只读一次）；修改文案后需重启，或调用 MessageCatalog.load.cache_clear()。
         """
         default_path = str(Path.cwd() / "messages.toml")
         path = os.getenv("ZAO_MESSAGES", default_path)
@@ -101,10 +118,16 @@ class MessageCatalog:
         if path and (os.path.exists(path) or os.getenv("ZAO_MESSAGES")):
             effective_path = path
 
-        return MessageCatalog(messages=merged, path=effective_path)
+        # load() 的结果按进程共享，给只读视图，避免某处改动文案影响全局
+        return MessageCatalog(messages=MappingProxyType(merged), path=effective_path)
 
     def render(self, key: str, **kwargs: Any) -> str:
-        tpl = self.messages.get(key) or DEFAULT_MESSAGES.get(key) or key
+        entry = self._templates.get(key)
+        if entry is None:
+            entry = (key, _static_text(key))
+        tpl, static = entry
+        if static is not None:
+            return static
         try:
             return tpl.format(**kwargs)
         except Exception:
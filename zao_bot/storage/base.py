@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Protocol
+from typing import Literal, Protocol
 
 
 @dataclass(frozen=True)
@@ -11,6 +11,17 @@ class OpenSession:
     check_in: datetime
 
 
+@dataclass(frozen=True)
+class CheckInRecord:
+    session_id: int
+    # 本群今日第几个签到（从 1 开始）
+    position: int
+    # 本次新获得的成就 key（今日最早 / 连续最早）
+    unlocked: list[str]
+    # 仅当本次是今日最早时才有
+    earliest_streak: int | None = None
+
+
 @dataclass(frozen=True)
 class RouletteGame:
     chat_id: int
@@ -40,15 +51,22 @@ class RSPGame:
     opponent_id: int
     challenger_choice: str | None
     opponent_choice: str | None
-    status: str  # 'pending', 'completed'
+    completed_at: datetime | None  # NULL 表示进行中
     winner_id: int | None  # NULL for draw
     message_id: int | None
     created_at: datetime
 
 
+# apply_rsp_choice 的结果：写入成功 / 没有进行中的对局 / 已经选过
+RSPChoiceReason = Literal["ok", "no_game", "already_chosen"]
+
+
 class Storage(Protocol):
     # --- lifecycle ---
     def init_db(self) -> None: ...
+    # 定期维护（SQLite：WAL checkpoint / 刷新查询统计信息；其它后端为空操作）
+    def wal_checkpoint(self) -> None: ...
+    def optimize(self) -> None: ...
 
     # --- users/chats ---
     def upsert_user_and_chat(
@@ -67,15 +85,39 @@ class Storage(Protocol):
     # --- sessions ---
     def get_open_session(self, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None: ...
     def check_in(self, *, chat_id: int, user_id: int, ts: datetime) -> bool: ...
+    # 签到热路径合成一个事务：写 session + 今日名次 + 今日最早/连续最早及对应成就；今日已签到返回 None
+    # 成就 key 与“每 N 天”由调用方（achievements）传入，规则不放在存储层
+    def record_checkin(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        ts: datetime,
+        created_at: datetime,
+        earliest_key: str,
+        streak_key: str,
+        streak_award_key: str,
+        streak_award_every: int = 7,
+    ) -> CheckInRecord | None: ...
     def check_out(self, *, chat_id: int, user_id: int, ts: datetime) -> tuple[bool, timedelta | None, datetime | None, int | None]: ...
     def session_today_exists(self, *, chat_id: int, user_id: int, day: str) -> bool: ...
     def session_today_completed(self, *, chat_id: int, user_id: int, day: str) -> bool: ...
+    # 同时需要两个标记时用这个：(当日有 session, 当日已签退)，一次查询
+    def session_today_status(self, *, chat_id: int, user_id: int, day: str) -> tuple[bool, bool]: ...
     def today_checkin_position(self, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int: ...
     def get_user_checkin_days(self, *, user_id: int, start_date: str, end_date: str) -> set[str]: ...
 
     # --- leaderboard ---
-    def leaderboard(self, *, chat_id: int, mode: str, now: datetime) -> list[tuple[int, str, int]]: ...
-    def leaderboard_global(self, *, mode: str, now: datetime) -> list[tuple[int, str, int]]: ...
+    # limit：只取前 N 名（在 SQL 里截断）；None 为全部
+    def leaderboard(self, *, chat_id: int, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]: ...
+    def leaderboard_global(self, *, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]: ...
+    # 榜单 + 该业务日是否“未签退”（一次查询，返回 (user_id, name, seconds, is_open)）
+    def leaderboard_with_open(
+        self, *, chat_id: int, mode: str, now: datetime, day: str, limit: int | None = None
+    ) -> list[tuple[int, str, int, bool]]: ...
+    def leaderboard_global_with_open(
+        self, *, mode: str, now: datetime, day: str, limit: int | None = None
+    ) -> list[tuple[int, str, int, bool]]: ...
     # 当前“未签退”的用户集合（用于榜单标记：🔥=未签退，💤=已签退）
     def open_user_ids(self, *, chat_id: int, day: str | None = None) -> set[int]: ...
     def open_user_ids_global(self, day: str | None = None) -> set[int]: ...
@@ -105,6 +147,17 @@ class Storage(Protocol):
         day: str | None = None,
         session_id: int | None = None,
     ) -> bool: ...
+    # 一次写入多个候选成就（同一个事务），返回实际新写入的 key（按 keys 的顺序）
+    def award_achievements_bulk(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        keys: list[str],
+        created_at: datetime,
+        day: str | None = None,
+        session_id: int | None = None,
+    ) -> list[str]: ...
 
     def get_achievement_stats(self, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]: ...
     def get_achievement_stats_global(self, *, user_id: int) -> list[tuple[str, int, str]]: ...
@@ -125,25 +178,32 @@ class Storage(Protocol):
     def record_roulette_attempt(
         self, *, chat_id: int, user_id: int, position: int, result: str, created_at: datetime
     ) -> None: ...
+    # 一次扣扳机：记录尝试 + 中枪删局/未中推进位置，在同一个事务里完成
+    def pull_roulette_trigger(
+        self, *, chat_id: int, user_id: int, position: int, shot: bool, created_at: datetime
+    ) -> None: ...
 
     # --- wake reminders ---
     def create_reminder(
         self, *, chat_id: int, user_id: int, wake_time: str, next_trigger: datetime, repeat: bool, created_at: datetime
     ) -> int: ...
     def get_pending_reminders(self, *, now: datetime) -> list[WakeReminder]: ...
+    def claim_pending_reminders(self, *, now: datetime, lease_until: datetime, limit: int = 100) -> list[WakeReminder]: ...
     def get_user_reminders(self, *, chat_id: int, user_id: int) -> list[WakeReminder]: ...
     def update_reminder_next_trigger(self, *, reminder_id: int, next_trigger: datetime) -> None: ...
     def delete_reminder(self, *, reminder_id: int) -> None: ...
     def delete_user_reminders(self, *, chat_id: int, user_id: int) -> None: ...
 
     # --- rock paper scissors ---
+    # 按钮回调热路径上的几个方法允许位置参数调用
     def create_rsp_game(
         self, *, chat_id: int, challenger_id: int, opponent_id: int, message_id: int | None, created_at: datetime
     ) -> int: ...
-    def get_rsp_game(self, *, game_id: int) -> RSPGame | None: ...
-    def get_pending_rsp_game(self, *, chat_id: int, user_id: int) -> RSPGame | None: ...
-    def update_rsp_choice(self, *, game_id: int, user_id: int, choice: str) -> None: ...
-    def complete_rsp_game(self, *, game_id: int, winner_id: int | None) -> None: ...
+    def get_rsp_game(self, game_id: int) -> RSPGame | None: ...
+    def get_pending_rsp_game(self, chat_id: int, user_id: int) -> RSPGame | None: ...
+    # 原子地写入“进行中对局”里该用户的选择（仅当尚未选择），返回原因 + 写入后的对局
+    def apply_rsp_choice(self, chat_id: int, user_id: int, choice: str) -> tuple[RSPChoiceReason, RSPGame | None]: ...
+    def complete_rsp_game(self, *, game_id: int, winner_id: int | None, completed_at: datetime) -> None: ...
     def delete_rsp_game(self, *, game_id: int) -> None: ...
     def get_rsp_stats(self, *, chat_id: int, user_id: int) -> tuple[int, int, int, int]: ...  # (total, wins, losses, draws)
     def get_rsp_stats_global(self, *, user_id: int) -> tuple[int, int, int, int]: ...  # (total, wins, losses, draws)
@@ -0,0 +1,452 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from zao_bot.storage.base import CheckInRecord, OpenSession, RouletteGame, RSPChoiceReason, RSPGame, Storage, WakeReminder
+from zao_bot.storage.sqlalchemy_storage import SQLAlchemyStorage
+from zao_bot.time_utils import business_day_key
+from zao_bot.ttl_cache import TTLCache
+
+
+_MISSING = object()
+
+
+@dataclass(frozen=True)
+class CachedStorage(Storage):
+    """
+    进程内读缓存：包在 SQLAlchemyStorage 外面，只缓存读多写少的查询，写操作时主动失效。
+
+    - 榜单（leaderboard*）：今日榜按分钟分桶，最多缓存 leaderboard_ttl 秒；本 chat 签到/签退时失效
+    - 进行中的石头剪刀布（get_pending_rsp_game）：创建/选择/结束/取消时失效
+    - 未签退用户（open_user_ids*）：本 chat 签到/签退时失效，最多缓存 open_users_ttl 秒
+    - 某人某业务日的签到状态（session_today_*）：签到/签退时直接改写，最多缓存 day_state_ttl 秒
+    - 用户/群信息（upsert_user_and_chat）：资料没变时在 upsert_ttl 内跳过重复写入
+
+    前提：同一个 token 只跑一个 bot 进程（polling 本身也只允许一个消费者），进程内失效即可保证一致；
+    多进程/多机共用一个库时各进程的缓存会互相看不到对方的写入。
+    不缓存的方法逐个显式转发给 inner：继承 Storage，签名由类型检查器对着 Protocol 核对。
+    """
+
+    # 具体类型：bulk_insert_sessions 不在 Storage 协议里，也要能经缓存层转发
+    inner: SQLAlchemyStorage
+    leaderboard_ttl: float = 60.0
+    rsp_ttl: float = 600.0
+    upsert_ttl: float = 3600.0
+    open_users_ttl: float = 300.0
+    day_state_ttl: float = 3600.0
+    _leaderboards: TTLCache[tuple, list] = field(init=False, repr=False, compare=False)
+    _pending_rsp: TTLCache[tuple[int, int], RSPGame | None] = field(init=False, repr=False, compare=False)
+    _upserted: TTLCache[tuple[int, int], tuple] = field(init=False, repr=False, compare=False)
+    _open_users: TTLCache[tuple[int | None, str | None], frozenset[int]] = field(init=False, repr=False, compare=False)
+    # (chat_id, user_id, day) -> (当日有 session, 当日已签退)；day 在 key 里，跨业务日自然换 key，旧条目靠 LRU/TTL 淘汰
+    _day_state: TTLCache[tuple[int, int, str], tuple[bool, bool]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_leaderboards", TTLCache(maxsize=512, ttl=self.leaderboard_ttl))
+        object.__setattr__(self, "_pending_rsp", TTLCache(maxsize=10_000, ttl=self.rsp_ttl))
+        object.__setattr__(self, "_upserted", TTLCache(maxsize=10_000, ttl=self.upsert_ttl))
+        object.__setattr__(self, "_open_users", TTLCache(maxsize=1024, ttl=self.open_users_ttl))
+        object.__setattr__(self, "_day_state", TTLCache(maxsize=10_000, ttl=self.day_state_ttl))
+
+    # --- lifecycle ---
+    def init_db(self) -> None:
+        self.inner.init_db()
+
+    def wal_checkpoint(self) -> None:
+        self.inner.wal_checkpoint()
+
+    def optimize(self) -> None:
+        self.inner.optimize()
+
+    # --- users/chats ---
+    def upsert_user_and_chat(
+        self,
+        *,
+        user_id: int,
+        username: str | None,
+        first_name: str | None,
+        last_name: str | None,
+        chat_id: int,
+        chat_title: str | None,
+        chat_type: str,
+        updated_at: datetime,
+    ) -> None:
+        # 每条更新都会调用；资料没变就不必再写库（updated_at 只是“最近出现”，允许滞后 upsert_ttl）
+        # 注意：首次写入必须同步完成，sessions 等表对 users/chats 有外键
+        key = (chat_id, user_id)
+        profile = (username, first_name, last_name, chat_title, chat_type)
+        if self._upserted.get(key) == profile:
+            return
+        self.inner.upsert_user_and_chat(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            chat_id=chat_id,
+            chat_title=chat_title,
+            chat_type=chat_type,
+            updated_at=updated_at,
+        )
+        self._upserted.put(key, profile)
+
+    # --- leaderboard ---
+    def _cached_leaderboard(self, key: tuple, load) -> list:
+        rows = self._leaderboards.get(key, _MISSING)
+        if rows is _MISSING:
+            rows = load()
+            self._leaderboards.put(key, rows)
+        return list(rows)
+
+    def _invalidate_leaderboards(self, chat_id: int) -> None:
+        # key[1] 为 chat_id；全局榜为 None，任何 chat 的变更都会影响
+        self._leaderboards.discard_where(lambda k, _v: k[1] is None or k[1] == chat_id)
+
+    @staticmethod
+    def _time_bucket(mode: str, now: datetime) -> int | None:
+        # 今日榜含未签退的人、时长随 now 增长，按分钟分桶；总榜只算已签退的 session，与 now 无关，
+        # 只靠签到/签退失效 + TTL 过期，不必每分钟换 key 重算
+        if mode != "today":
+            return None
+        return int(now.timestamp()) // 60
+
+    def leaderboard(self, *, chat_id: int, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
+        key = ("lb", chat_id, mode, self._time_bucket(mode, now), limit)
+        return self._cached_leaderboard(
+            key, lambda: self.inner.leaderboard(chat_id=chat_id, mode=mode, now=now, limit=limit)
+        )
+
+    def leaderboard_global(self, *, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
+        key = ("lb", None, mode, self._time_bucket(mode, now), limit)
+        return self._cached_leaderboard(key, lambda: self.inner.leaderboard_global(mode=mode, now=now, limit=limit))
+
+    def leaderboard_with_open(
+        self, *, chat_id: int, mode: str, now: datetime, day: str, limit: int | None = None
+    ) -> list[tuple[int, str, int, bool]]:
+        key = ("lb_open", chat_id, mode, self._time_bucket(mode, now), day, limit)
+        return self._cached_leaderboard(
+            key, lambda: self.inner.leaderboard_with_open(chat_id=chat_id, mode=mode, now=now, day=day, limit=limit)
+        )
+
+    def leaderboard_global_with_open(
+        self, *, mode: str, now: datetime, day: str, limit: int | None = None
+    ) -> list[tuple[int, str, int, bool]]:
+        key = ("lb_open", None, mode, self._time_bucket(mode, now), day, limit)
+        return self._cached_leaderboard(
+            key, lambda: self.inner.leaderboard_global_with_open(mode=mode, now=now, day=day, limit=limit)
+        )
+
+    # --- open sessions ---
+    def _invalidate_open_users(self, chat_id: int) -> None:
+        # key[0] 为 chat_id；全局为 None
+        self._open_users.discard_where(lambda k, _v: k[0] is None or k[0] == chat_id)
+
+    def open_user_ids(self, *, chat_id: int, day: str | None = None) -> set[int]:
+        key = (chat_id, day)
+        uids = self._open_users.get(key)
+        if uids is None:
+            uids = frozenset(self.inner.open_user_ids(chat_id=chat_id, day=day))
+            self._open_users.put(key, uids)
+        return set(uids)
+
+    def open_user_ids_global(self, day: str | None = None) -> set[int]:
+        key = (None, day)
+        uids = self._open_users.get(key)
+        if uids is None:
+            uids = frozenset(self.inner.open_user_ids_global(day=day))
+            self._open_users.put(key, uids)
+        return set(uids)
+
+    # --- today's session state ---
+    def session_today_status(self, *, chat_id: int, user_id: int, day: str) -> tuple[bool, bool]:
+        key = (chat_id, user_id, day)
+        state = self._day_state.get(key)
+        if state is None:
+            state = self.inner.session_today_status(chat_id=chat_id, user_id=user_id, day=day)
+            self._day_state.put(key, state)
+        return state
+
+    def session_today_exists(self, *, chat_id: int, user_id: int, day: str) -> bool:
+        return self.session_today_status(chat_id=chat_id, user_id=user_id, day=day)[0]
+
+    def session_today_completed(self, *, chat_id: int, user_id: int, day: str) -> bool:
+        return self.session_today_status(chat_id=chat_id, user_id=user_id, day=day)[1]
+
+    def _mark_checked_in(self, chat_id: int, user_id: int, ts: datetime) -> None:
+        # 签到成功：当日一定有 session；“已签退”只有缓存里有旧状态时才能沿用，否则丢掉等下次查询
+        key = (chat_id, user_id, business_day_key(ts, cutoff_hour=4))
+        state = self._day_state.get(key)
+        if state is None:
+            return
+        self._day_state.put(key, (True, state[1]))
+
+    def _on_sessions_changed(self, chat_id: int) -> None:
+        self._invalidate_leaderboards(chat_id)
+        self._invalidate_open_users(chat_id)
+
+    def check_in(self, *, chat_id: int, user_id: int, ts: datetime) -> bool:
+        ok = self.inner.check_in(chat_id=chat_id, user_id=user_id, ts=ts)
+        if ok:
+            self._on_sessions_changed(chat_id)
+            self._mark_checked_in(chat_id, user_id, ts)
+        return ok
+
+    def record_checkin(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        ts: datetime,
+        created_at: datetime,
+        earliest_key: str,
+        streak_key: str,
+        streak_award_key: str,
+        streak_award_every: int = 7,
+    ) -> CheckInRecord | None:
+        rec = self.inner.record_checkin(
+            chat_id=chat_id,
+            user_id=user_id,
+            ts=ts,
+            created_at=created_at,
+            earliest_key=earliest_key,
+            streak_key=streak_key,
+            streak_award_key=streak_award_key,
+            streak_award_every=streak_award_every,
+        )
+        if rec is not None:
+            self._on_sessions_changed(chat_id)
+            self._mark_checked_in(chat_id, user_id, ts)
+        return rec
+
+    def check_out(self, *, chat_id: int, user_id: int, ts: datetime) -> tuple[bool, timedelta | None, datetime | None, int | None]:
+        res = self.inner.check_out(chat_id=chat_id, user_id=user_id, ts=ts)
+        if res[0]:
+            self._on_sessions_changed(chat_id)
+            # 签退按签退时刻的业务日定位 session：该业务日既有 session 也已签退
+            self._day_state.put((chat_id, user_id, business_day_key(ts, cutoff_hour=4)), (True, True))
+        return res
+
+    def bulk_insert_sessions(self, *, sessions: list[tuple[int, int, datetime, datetime | None]]) -> None:
+        # 批量导入（迁移/补数据）不常用：涉及的 chat 和日期都可能很多，整体清空
+        self.inner.bulk_insert_sessions(sessions=sessions)
+        self._leaderboards.clear()
+        self._open_users.clear()
+        self._day_state.clear()
+
+    # --- sessions ---
+    def get_open_session(self, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None:
+        return self.inner.get_open_session(chat_id=chat_id, user_id=user_id, day=day)
+
+    def today_checkin_position(self, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
+        return self.inner.today_checkin_position(chat_id=chat_id, session_id=session_id, check_in=check_in, day=day)
+
+    def get_user_checkin_days(self, *, user_id: int, start_date: str, end_date: str) -> set[str]:
+        return self.inner.get_user_checkin_days(user_id=user_id, start_date=start_date, end_date=end_date)
+
+    # --- achievements ---
+    def set_daily_earliest(
+        self,
+        *,
+        chat_id: int,
+        day: str,
+        user_id: int,
+        session_id: int,
+        check_in: datetime,
+        created_at: datetime,
+    ) -> bool:
+        return self.inner.set_daily_earliest(
+            chat_id=chat_id,
+            day=day,
+            user_id=user_id,
+            session_id=session_id,
+            check_in=check_in,
+            created_at=created_at,
+        )
+
+    def update_streak(self, *, chat_id: int, user_id: int, key: str, day: str, created_at: datetime) -> int:
+        return self.inner.update_streak(chat_id=chat_id, user_id=user_id, key=key, day=day, created_at=created_at)
+
+    def get_streak(self, *, chat_id: int, user_id: int, key: str) -> int:
+        return self.inner.get_streak(chat_id=chat_id, user_id=user_id, key=key)
+
+    def get_streak_best_global(self, *, user_id: int, key: str) -> tuple[int, int | None, str | None]:
+        return self.inner.get_streak_best_global(user_id=user_id, key=key)
+
+    def award_achievement(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        key: str,
+        created_at: datetime,
+        day: str | None = None,
+        session_id: int | None = None,
+    ) -> bool:
+        return self.inner.award_achievement(
+            chat_id=chat_id,
+            user_id=user_id,
+            key=key,
+            created_at=created_at,
+            day=day,
+            session_id=session_id,
+        )
+
+    def award_achievements_bulk(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        keys: list[str],
+        created_at: datetime,
+        day: str | None = None,
+        session_id: int | None = None,
+    ) -> list[str]:
+        return self.inner.award_achievements_bulk(
+            chat_id=chat_id,
+            user_id=user_id,
+            keys=keys,
+            created_at=created_at,
+            day=day,
+            session_id=session_id,
+        )
+
+    def get_achievement_stats(self, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
+        return self.inner.get_achievement_stats(chat_id=chat_id, user_id=user_id)
+
+    def get_achievement_stats_global(self, *, user_id: int) -> list[tuple[str, int, str]]:
+        return self.inner.get_achievement_stats_global(user_id=user_id)
+
+    def get_achievement_count(self, *, chat_id: int, user_id: int, key: str) -> int:
+        return self.inner.get_achievement_count(chat_id=chat_id, user_id=user_id, key=key)
+
+    def get_achievement_count_global(self, *, user_id: int, key: str) -> int:
+        return self.inner.get_achievement_count_global(user_id=user_id, key=key)
+
+    def achievement_rank_by_count(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
+        return self.inner.achievement_rank_by_count(chat_id=chat_id, key=key, limit=limit)
+
+    def achievement_rank_by_count_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
+        return self.inner.achievement_rank_by_count_global(key=key, limit=limit)
+
+    def streak_rank(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
+        return self.inner.streak_rank(chat_id=chat_id, key=key, limit=limit)
+
+    def streak_rank_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int, int | None, str | None]]:
+        return self.inner.streak_rank_global(key=key, limit=limit)
+
+    # --- russian roulette ---
+    def get_active_roulette(self, *, chat_id: int) -> RouletteGame | None:
+        return self.inner.get_active_roulette(chat_id=chat_id)
+
+    def create_roulette(
+        self, *, chat_id: int, chambers: int, bullet_position: int, created_by: int, created_at: datetime
+    ) -> None:
+        self.inner.create_roulette(
+            chat_id=chat_id,
+            chambers=chambers,
+            bullet_position=bullet_position,
+            created_by=created_by,
+            created_at=created_at,
+        )
+
+    def update_roulette_position(self, *, chat_id: int, position: int) -> None:
+        self.inner.update_roulette_position(chat_id=chat_id, position=position)
+
+    def delete_roulette(self, *, chat_id: int) -> None:
+        self.inner.delete_roulette(chat_id=chat_id)
+
+    def record_roulette_attempt(
+        self, *, chat_id: int, user_id: int, position: int, result: str, created_at: datetime
+    ) -> None:
+        self.inner.record_roulette_attempt(
+            chat_id=chat_id,
+            user_id=user_id,
+            position=position,
+            result=result,
+            created_at=created_at,
+        )
+
+    def pull_roulette_trigger(
+        self, *, chat_id: int, user_id: int, position: int, shot: bool, created_at: datetime
+    ) -> None:
+        self.inner.pull_roulette_trigger(chat_id=chat_id, user_id=user_id, position=position, shot=shot, created_at=created_at)
+
+    # --- wake reminders ---
+    def create_reminder(
+        self, *, chat_id: int, user_id: int, wake_time: str, next_trigger: datetime, repeat: bool, created_at: datetime
+    ) -> int:
+        return self.inner.create_reminder(
+            chat_id=chat_id,
+            user_id=user_id,
+            wake_time=wake_time,
+            next_trigger=next_trigger,
+            repeat=repeat,
+            created_at=created_at,
+        )
+
+    def get_pending_reminders(self, *, now: datetime) -> list[WakeReminder]:
+        return self.inner.get_pending_reminders(now=now)
+
+    def claim_pending_reminders(self, *, now: datetime, lease_until: datetime, limit: int = 100) -> list[WakeReminder]:
+        return self.inner.claim_pending_reminders(now=now, lease_until=lease_until, limit=limit)
+
+    def get_user_reminders(self, *, chat_id: int, user_id: int) -> list[WakeReminder]:
+        return self.inner.get_user_reminders(chat_id=chat_id, user_id=user_id)
+
+    def update_reminder_next_trigger(self, *, reminder_id: int, next_trigger: datetime) -> None:
+        self.inner.update_reminder_next_trigger(reminder_id=reminder_id, next_trigger=next_trigger)
+
+    def delete_reminder(self, *, reminder_id: int) -> None:
+        self.inner.delete_reminder(reminder_id=reminder_id)
+
+    def delete_user_reminders(self, *, chat_id: int, user_id: int) -> None:
+        self.inner.delete_user_reminders(chat_id=chat_id, user_id=user_id)
+
+    # --- rock paper scissors ---
+    def _invalidate_rsp_game(self, game_id: int) -> None:
+        self._pending_rsp.discard_where(lambda _k, g: g is not None and g.id == game_id)
+
+    def get_pending_rsp_game(self, chat_id: int, user_id: int) -> RSPGame | None:
+        key = (chat_id, user_id)
+        game = self._pending_rsp.get(key, _MISSING)
+        if game is _MISSING:
+            game = self.inner.get_pending_rsp_game(chat_id, user_id)
+            self._pending_rsp.put(key, game)
+        return game
+
+    def create_rsp_game(
+        self, *, chat_id: int, challenger_id: int, opponent_id: int, message_id: int | None, created_at: datetime
+    ) -> int:
+        game_id = self.inner.create_rsp_game(
+            chat_id=chat_id,
+            challenger_id=challenger_id,
+            opponent_id=opponent_id,
+            message_id=message_id,
+            created_at=created_at,
+        )
+        self._pending_rsp.pop((chat_id, challenger_id))
+        self._pending_rsp.pop((chat_id, opponent_id))
+        return game_id
+
+    def apply_rsp_choice(self, chat_id: int, user_id: int, choice: str) -> tuple[RSPChoiceReason, RSPGame | None]:
+        reason, game = self.inner.apply_rsp_choice(chat_id, user_id, choice)
+        if game is not None:
+            self._invalidate_rsp_game(game.id)
+        return reason, game
+
+    def complete_rsp_game(self, *, game_id: int, winner_id: int | None, completed_at: datetime) -> None:
+        self._invalidate_rsp_game(game_id)
+        self.inner.complete_rsp_game(game_id=game_id, winner_id=winner_id, completed_at=completed_at)
+
+    def delete_rsp_game(self, *, game_id: int) -> None:
+        self._invalidate_rsp_game(game_id)
+        self.inner.delete_rsp_game(game_id=game_id)
+
+    def get_rsp_game(self, game_id: int) -> RSPGame | None:
+        return self.inner.get_rsp_game(game_id)
+
+    def get_rsp_stats(self, *, chat_id: int, user_id: int) -> tuple[int, int, int, int]:
+        return self.inner.get_rsp_stats(chat_id=chat_id, user_id=user_id)
+
+    def get_rsp_stats_global(self, *, user_id: int) -> tuple[int, int, int, int]:
+        return self.inner.get_rsp_stats_global(user_id=user_id)
@@ -4,6 +4,7 @@ from pathlib import Path
 
 from config import Settings
 from zao_bot.storage.base import Storage
+from zao_bot.storage.cached_storage import CachedStorage
 from zao_bot.storage.sqlalchemy_storage import SQLAlchemyStorage
 
 
@@ -15,12 +16,12 @@ def get_storage(settings: Settings) -> Storage:
             url = "postgresql://" + url[len("postgres://") :]
         if url.startswith("postgresql://") and "postgresql+" not in url:
             url = "postgresql+psycopg://" + url[len("postgresql://") :]
-        return SQLAlchemyStorage(url=url)
+        return CachedStorage(inner=SQLAlchemyStorage(url=url))
 
     p = Path(settings.db_path).expanduser()
     if not p.is_absolute():
         p = (Path.cwd() / p).resolve()
     sqlite_url = f"sqlite+pysqlite:///{p.as_posix()}"
-    return SQLAlchemyStorage(url=sqlite_url)
+    return CachedStorage(inner=SQLAlchemyStorage(url=sqlite_url))
 
 
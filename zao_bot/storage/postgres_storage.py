@@ -1,33 +1,203 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
 from typing import Any
 
 import psycopg
 from psycopg.errors import UniqueViolation
+from psycopg_pool import ConnectionPool
 
-from zao_bot.storage.base import OpenSession, Storage
+from zao_bot.storage.base import CheckInRecord, OpenSession, Storage
 from zao_bot.time_utils import business_day_key
 
 
 def _display_name_from_row(name: str | None, user_id: int) -> str:
-    nm = (name or str(user_id)).strip()
+    if not name:
+        # 没有名字时显示纯数字 id，不加 @
+        return str(user_id)
+    nm = name.strip()
     if nm and " " not in nm and not nm.isdigit() and not nm.startswith("@"):
         nm = f"@{nm}"
     return nm
 
 
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# 签到/签退热路径 SQL
+_OPEN_SESSION_SQL = """
+    SELECT id, check_in
+    FROM sessions
+    WHERE chat_id=%s AND user_id=%s AND check_out IS NULL
+      AND (%s::text IS NULL OR session_day = %s)
+    ORDER BY id DESC
+    LIMIT 1;
+"""
+_CHECK_IN_SQL = """
+    INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out)
+    VALUES(%s,%s,%s,%s,NULL);
+"""
+# idx_open_session 保证每人最多一条未签退记录；签退时间早于签到时间（时钟误差）时按签到时间记
+_CHECK_OUT_SQL = """
+    UPDATE sessions SET check_out = GREATEST(%s, check_in)
+    WHERE chat_id=%s AND user_id=%s AND check_out IS NULL AND session_day=%s
+    RETURNING id, check_in, check_out;
+"""
+_SESSION_DAY_EXISTS_SQL = "SELECT 1 FROM sessions WHERE chat_id=%s AND user_id=%s AND session_day=%s LIMIT 1;"
+_SESSION_DAY_COMPLETED_SQL = (
+    "SELECT 1 FROM sessions WHERE chat_id=%s AND user_id=%s AND session_day=%s AND check_out IS NOT NULL LIMIT 1;"
+)
+_SESSION_DAY_STATUS_SQL = "SELECT COUNT(1), COUNT(check_out) FROM sessions WHERE chat_id=%s AND user_id=%s AND session_day=%s;"
+_CHECKIN_POSITION_SQL = """
+    SELECT COUNT(1) AS n
+    FROM sessions
+    WHERE chat_id=%s
+      AND session_day=%s
+      AND (check_in, id) <= (%s, %s);
+"""
+
+# 签到热路径（record_checkin）：同一事务里出错会让整个事务作废，所以去重一律 ON CONFLICT DO NOTHING，
+# 靠 RETURNING 有没有行判断是否写入，而不是捕获 UniqueViolation
+_RECORD_CHECK_IN_SQL = """
+    INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out)
+    VALUES(%s,%s,%s,%s,NULL)
+    RETURNING id;
+"""
+_INSERT_DAILY_EARLIEST_SQL = """
+    INSERT INTO daily_earliest(chat_id, day, user_id, session_id, check_in, created_at)
+    VALUES(%s,%s,%s,%s,%s,%s)
+    ON CONFLICT (chat_id, day) DO NOTHING
+    RETURNING chat_id;
+"""
+_INSERT_ACHIEVEMENT_EVENT_SQL = """
+    INSERT INTO achievement_events(chat_id, user_id, key, day, session_id, created_at)
+    VALUES(%s,%s,%s,%s,%s,%s)
+    ON CONFLICT DO NOTHING
+    RETURNING id;
+"""
+_BUMP_ACHIEVEMENT_STATS_SQL = """
+    INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
+    VALUES(%s,%s,%s,1,%s)
+    ON CONFLICT (chat_id, user_id, key) DO UPDATE SET
+      count = achievement_stats.count + 1,
+      last_awarded_at = EXCLUDED.last_awarded_at;
+"""
+# 跨群汇总随每次发放在同一事务里 +1，全局统计/排行不再按 user_id 或 key 做 SUM/MAX
+_BUMP_ACHIEVEMENT_STATS_GLOBAL_SQL = """
+    INSERT INTO achievement_stats_global(user_id, key, count, last_awarded_at)
+    VALUES(%s,%s,1,%s)
+    ON CONFLICT (user_id, key) DO UPDATE SET
+      count = achievement_stats_global.count + 1,
+      last_awarded_at = GREATEST(achievement_stats_global.last_awarded_at, EXCLUDED.last_awarded_at);
+"""
+# 一条 UPSERT：与上次相差一天则 +1，否则从 1 重新计；同一用户并发签到也不会读到旧值
+_UPSERT_STREAK_SQL = """
+    INSERT INTO streaks(chat_id, user_id, key, last_day, last_day_epoch, streak, updated_at)
+    VALUES(%s,%s,%s,%s,%s,1,%s)
+    ON CONFLICT (chat_id, user_id, key) DO UPDATE SET
+      streak = CASE
+        WHEN EXCLUDED.last_day_epoch - streaks.last_day_epoch = 1 THEN streaks.streak + 1
+        ELSE 1
+      END,
+      last_day = EXCLUDED.last_day,
+      last_day_epoch = EXCLUDED.last_day_epoch,
+      updated_at = EXCLUDED.updated_at
+    RETURNING streak;
+"""
+
+_UPSERT_USER_SQL = """
+    INSERT INTO users(user_id, username, first_name, last_name, updated_at)
+    VALUES(%s,%s,%s,%s,%s)
+    ON CONFLICT (user_id) DO UPDATE SET
+      username=EXCLUDED.username,
+      first_name=EXCLUDED.first_name,
+      last_name=EXCLUDED.last_name,
+      updated_at=EXCLUDED.updated_at;
+"""
+_UPSERT_CHAT_SQL = """
+    INSERT INTO chats(chat_id, title, chat_type, updated_at)
+    VALUES(%s,%s,%s,%s)
+    ON CONFLICT (chat_id) DO UPDATE SET
+      title=EXCLUDED.title,
+      chat_type=EXCLUDED.chat_type,
+      updated_at=EXCLUDED.updated_at;
+"""
+
+# 榜单 SQL：今日/总榜各一份固定文本，psycopg 按 SQL 文本缓存 prepared statement，拼接 where 会让两种口径互相挤占
+_LEADERBOARD_SELECT = """
+    SELECT
+      u.user_id AS user_id,
+      u.display_name AS name,
+      SUM(COALESCE(s.duration_seconds, EXTRACT(EPOCH FROM (%s - s.check_in))::bigint))::bigint AS seconds
+    FROM sessions s
+    JOIN users u ON u.user_id = s.user_id
+"""
+# psycopg 按列类型直接解码（bigint/integer -> int，text -> str），读出的行无需再 int()/str()；SUM 结果显式转 bigint，避免得到 Decimal
+# 不带分号：这些 SQL 会放进服务端游标（DECLARE ... CURSOR FOR）里执行
+# LIMIT %s 传 None 即 LIMIT ALL（不限）；只要前 N 名时排序只保留 N 行
+_LEADERBOARD_GROUP = """
+    GROUP BY u.user_id
+    ORDER BY seconds DESC
+    LIMIT %s
+"""
+_LEADERBOARD_TODAY_SQL = _LEADERBOARD_SELECT + "WHERE s.chat_id = %s AND s.session_day = %s" + _LEADERBOARD_GROUP
+_LEADERBOARD_ALL_SQL = _LEADERBOARD_SELECT + "WHERE s.chat_id = %s" + _LEADERBOARD_GROUP
+_LEADERBOARD_GLOBAL_TODAY_SQL = _LEADERBOARD_SELECT + "WHERE s.session_day = %s" + _LEADERBOARD_GROUP
+_LEADERBOARD_GLOBAL_ALL_SQL = _LEADERBOARD_SELECT + _LEADERBOARD_GROUP
+
+
+@dataclass(frozen=True)
+class ChatSnapshot:
+    open_user_ids: set[int]
+    achievement_stats: list[tuple[str, int, str]]
+    streak_rank: list[tuple[int, str, int]]
+
+
 @dataclass(frozen=True)
 class PostgresStorage(Storage):
     dsn: str
+    pool_min_size: int = 2
+    pool_max_size: int = 10
+    _pool: ConnectionPool[psycopg.Connection[Any]] = field(init=False, repr=False, compare=False)
 
-    def _connect(self) -> psycopg.Connection[Any]:
+    def __post_init__(self) -> None:
+        # 每次 psycopg.connect 都要重新握手（TCP/TLS/认证），比查询本身还慢；改为复用连接池
         # autocommit=False：显式事务更安全（with 会自动提交/回滚）
-        return psycopg.connect(self.dsn, autocommit=False)
+        # prepare_threshold：热路径 SQL 文本固定，连接又是复用的，首次执行就服务端 prepare（与 SQLAlchemyStorage 同一个开关）
+        threshold = os.getenv("PG_PREPARE_THRESHOLD", "0").strip()
+        pool = ConnectionPool(
+            self.dsn,
+            min_size=self.pool_min_size,
+            max_size=self.pool_max_size,
+            kwargs={"autocommit": False, "prepare_threshold": int(threshold) if threshold else None},
+            open=True,
+        )
+        object.__setattr__(self, "_pool", pool)
+
+    @contextmanager
+    def _connect(self) -> Iterator[psycopg.Connection[Any]]:
+        # 退出时与 psycopg.connect 的 with 语义一致：正常则提交、异常则回滚，然后把连接还给池
+        with self._pool.connection() as conn:
+            yield conn
+
+    def close(self) -> None:
+        self._pool.close()
+
+    def _stream(self, query: str, params: tuple[Any, ...], *, itersize: int = 500) -> Iterator[tuple[Any, ...]]:
+        # 服务端游标：按批（itersize 行）取回，大群的榜单不必一次把整个结果集读进内存
+        # 游标依赖事务（autocommit=False），取完后随连接一起提交并归还连接池
+        # binary：数值/时间列按二进制格式传输，省掉服务端格式化与客户端解析文本
+        with self._connect() as conn, conn.cursor(name="lb", binary=True) as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            yield from cur
 
     def init_db(self) -> None:
-        with self._connect() as conn, conn.cursor() as cur:
+        # 建表/建索引语句互不依赖返回结果：放进 pipeline 一次发出，启动时不必逐条往返
+        with self._connect() as conn, conn.pipeline(), conn.cursor() as cur:
             # 基础表
             cur.execute(
                 """
@@ -40,6 +210,17 @@ class PostgresStorage(Storage):
                 );
                 """
             )
+            # 榜单展示名：存成生成列，各榜单查询直接取列，不必逐行拼接
+            # CONCAT_WS 不是 IMMUTABLE，生成列里只能用 || 拼接；全空时为 NULL，由 _display_name_from_row 退回 user_id
+            cur.execute(
+                """
+                ALTER TABLE users ADD COLUMN IF NOT EXISTS display_name TEXT
+                GENERATED ALWAYS AS (
+                  COALESCE(username, NULLIF(TRIM(COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')), ''))
+                ) STORED;
+                """
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_users_pk_display ON users(user_id) INCLUDE (display_name);")
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS chats (
@@ -68,6 +249,27 @@ class PostgresStorage(Storage):
             cur.execute(
                 "CREATE INDEX IF NOT EXISTS idx_sessions_chat_day ON sessions(chat_id, session_day);"
             )
+            # 已签退的时长不会再变：存成生成列，榜单只对未签退的记录现算
+            cur.execute(
+                """
+                ALTER TABLE sessions ADD COLUMN IF NOT EXISTS duration_seconds BIGINT
+                GENERATED ALWAYS AS ((EXTRACT(EPOCH FROM (check_out - check_in)))::bigint) STORED;
+                """
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_chat_day_dur ON sessions(chat_id, session_day) INCLUDE (user_id, duration_seconds);"
+            )
+            # 按人按天的点查（session_today_exists/completed、get_open_session 的 day 过滤）：带上 check_out 可以只扫索引
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_sessions_chat_user_day
+                ON sessions(chat_id, user_id, session_day) INCLUDE (check_out);
+                """
+            )
+            # 今日签到名次：(check_in, id) 行比较直接走这条索引的范围扫描
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_chat_day_checkin_id ON sessions(chat_id, session_day, check_in, id);"
+            )
             cur.execute(
                 """
                 CREATE UNIQUE INDEX IF NOT EXISTS idx_open_session
@@ -103,6 +305,12 @@ class PostgresStorage(Storage):
                 );
                 """
             )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_streaks_key_user_streak ON streaks(key, user_id, streak DESC, chat_id);"
+            )
+            # last_day 的整数形式（距 1970-01-01 的天数），连续判断直接比整数；旧数据一次性回填
+            cur.execute("ALTER TABLE streaks ADD COLUMN IF NOT EXISTS last_day_epoch INTEGER;")
+            cur.execute("UPDATE streaks SET last_day_epoch = last_day::date - DATE '1970-01-01' WHERE last_day_epoch IS NULL;")
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS achievement_events (
@@ -128,6 +336,32 @@ class PostgresStorage(Storage):
                 );
                 """
             )
+            cur.execute("SELECT to_regclass('achievement_stats_global');")
+            has_global_stats = cur.fetchone()[0] is not None
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS achievement_stats_global (
+                  user_id BIGINT NOT NULL REFERENCES users(user_id),
+                  key TEXT NOT NULL,
+                  count INTEGER NOT NULL,
+                  last_awarded_at TIMESTAMPTZ NOT NULL,
+                  PRIMARY KEY(user_id, key)
+                );
+                """
+            )
+            if not has_global_stats:
+                # 新建表时按已有的分群计数回填
+                cur.execute(
+                    """
+                    INSERT INTO achievement_stats_global(user_id, key, count, last_awarded_at)
+                    SELECT user_id, key, SUM(count), MAX(last_awarded_at)
+                    FROM achievement_stats
+                    GROUP BY user_id, key;
+                    """
+                )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_ach_global_key_count ON achievement_stats_global(key, count DESC, user_id);"
+            )
             # 去重约束（partial unique）
             cur.execute(
                 """
@@ -165,44 +399,33 @@ class PostgresStorage(Storage):
         updated_at: datetime,
     ) -> None:
         with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO users(user_id, username, first_name, last_name, updated_at)
-                VALUES(%s,%s,%s,%s,%s)
-                ON CONFLICT (user_id) DO UPDATE SET
-                  username=EXCLUDED.username,
-                  first_name=EXCLUDED.first_name,
-                  last_name=EXCLUDED.last_name,
-                  updated_at=EXCLUDED.updated_at;
-                """,
-                (user_id, username, first_name, last_name, updated_at),
-            )
-            cur.execute(
-                """
-                INSERT INTO chats(chat_id, title, chat_type, updated_at)
-                VALUES(%s,%s,%s,%s)
-                ON CONFLICT (chat_id) DO UPDATE SET
-                  title=EXCLUDED.title,
-                  chat_type=EXCLUDED.chat_type,
-                  updated_at=EXCLUDED.updated_at;
-                """,
-                (chat_id, chat_title, chat_type, updated_at),
-            )
+            cur.execute(_UPSERT_USER_SQL, (user_id, username, first_name, last_name, updated_at))
+            cur.execute(_UPSERT_CHAT_SQL, (chat_id, chat_title, chat_type, updated_at))
+            conn.commit()
+
+    def bulk_upsert_users_and_chats(
+        self,
+        *,
+        users: list[tuple[int, str | None, str | None, str | None, datetime]],
+        chats: list[tuple[int, str | None, str, datetime]],
+    ) -> None:
+        """
+        批量版 upsert_user_and_chat：users 为 (user_id, username, first_name, last_name, updated_at)，
+        chats 为 (chat_id, title, chat_type, updated_at)。executemany 在 psycopg3 里走 pipeline，整批只需一次往返。
+        两张表在同一事务里提交。
+        """
+        if not users and not chats:
+            return
+        with self._connect() as conn, conn.cursor() as cur:
+            if chats:
+                cur.executemany(_UPSERT_CHAT_SQL, chats)
+            if users:
+                cur.executemany(_UPSERT_USER_SQL, users)
             conn.commit()
 
     def get_open_session(self, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None:
         with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT id, check_in
-                FROM sessions
-                WHERE chat_id=%s AND user_id=%s AND check_out IS NULL
-                  AND (%s IS NULL OR session_day = %s)
-                ORDER BY id DESC
-                LIMIT 1;
-                """,
-                (chat_id, user_id, day, day),
-            )
+            cur.execute(_OPEN_SESSION_SQL, (chat_id, user_id, day, day))
             row = cur.fetchone()
         if not row:
             return None
@@ -213,126 +436,171 @@ class PostgresStorage(Storage):
         session_day = business_day_key(ts, cutoff_hour=4)
         try:
             with self._connect() as conn, conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out)
-                    VALUES(%s,%s,%s,%s,NULL);
-                    """,
-                    (chat_id, user_id, session_day, ts),
-                )
+                cur.execute(_CHECK_IN_SQL, (chat_id, user_id, session_day, ts))
                 conn.commit()
             return True
         except UniqueViolation:
             return False
 
+    def record_checkin(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        ts: datetime,
+        created_at: datetime,
+        earliest_key: str,
+        streak_key: str,
+        streak_award_key: str,
+        streak_award_every: int = 7,
+    ) -> CheckInRecord | None:
+        # 签到 + 名次 + 今日最早及其成就：同一个连接、一次提交
+        session_day = business_day_key(ts, cutoff_hour=4)
+        unlocked: list[str] = []
+        earliest_streak: int | None = None
+        try:
+            with self._connect() as conn, conn.cursor() as cur:
+                cur.execute(_RECORD_CHECK_IN_SQL, (chat_id, user_id, session_day, ts))
+                session_id = int(cur.fetchone()[0])
+                cur.execute(_CHECKIN_POSITION_SQL, (chat_id, session_day, ts, session_id))
+                position = int(cur.fetchone()[0]) or 1
+                cur.execute(_INSERT_DAILY_EARLIEST_SQL, (chat_id, session_day, user_id, session_id, ts, created_at))
+                if cur.fetchone() is not None:
+                    if self._award_in(cur, chat_id=chat_id, user_id=user_id, key=earliest_key, day=session_day, created_at=created_at):
+                        unlocked.append(earliest_key)
+                    day_epoch = date.fromisoformat(session_day).toordinal() - _EPOCH_ORDINAL
+                    cur.execute(_UPSERT_STREAK_SQL, (chat_id, user_id, streak_key, session_day, day_epoch, created_at))
+                    earliest_streak = int(cur.fetchone()[0])
+                    if earliest_streak % streak_award_every == 0 and self._award_in(
+                        cur, chat_id=chat_id, user_id=user_id, key=streak_award_key, day=session_day, created_at=created_at
+                    ):
+                        unlocked.append(streak_award_key)
+                conn.commit()
+        except UniqueViolation:
+            # 已有未签退的 session（idx_open_session）
+            return None
+        return CheckInRecord(session_id=session_id, position=position, unlocked=unlocked, earliest_streak=earliest_streak)
+
+    @staticmethod
+    def _award_in(
+        cur: psycopg.Cursor[Any],
+        *,
+        chat_id: int,
+        user_id: int,
+        key: str,
+        day: str | None,
+        created_at: datetime,
+        session_id: int | None = None,
+    ) -> bool:
+        cur.execute(_INSERT_ACHIEVEMENT_EVENT_SQL, (chat_id, user_id, key, day, session_id, created_at))
+        if cur.fetchone() is None:
+            return False
+        cur.execute(_BUMP_ACHIEVEMENT_STATS_SQL, (chat_id, user_id, key, created_at))
+        cur.execute(_BUMP_ACHIEVEMENT_STATS_GLOBAL_SQL, (user_id, key, created_at))
+        return True
+
     def check_out(self, *, chat_id: int, user_id: int, ts: datetime) -> tuple[bool, timedelta | None, datetime | None, int | None]:
         day = business_day_key(ts, cutoff_hour=4)
-        osess = self.get_open_session(chat_id=chat_id, user_id=user_id, day=day)
-        if not osess:
-            return False, None, None, None
-        check_in_ts = osess.check_in
-        if ts < check_in_ts:
-            ts = check_in_ts
+        # 查找 + 签退合成一条 UPDATE ... RETURNING：少一次往返，并发签退时也只有一条能命中
         with self._connect() as conn, conn.cursor() as cur:
-            cur.execute("UPDATE sessions SET check_out=%s WHERE id=%s;", (ts, osess.session_id))
+            cur.execute(_CHECK_OUT_SQL, (ts, chat_id, user_id, day))
+            row = cur.fetchone()
             conn.commit()
-        return True, ts - check_in_ts, check_in_ts, osess.session_id
+        if not row:
+            return False, None, None, None
+        session_id, check_in_ts, check_out_ts = int(row[0]), row[1], row[2]
+        return True, check_out_ts - check_in_ts, check_in_ts, session_id
 
     def session_today_exists(self, *, chat_id: int, user_id: int, day: str) -> bool:
         with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                "SELECT 1 FROM sessions WHERE chat_id=%s AND user_id=%s AND session_day=%s LIMIT 1;",
-                (chat_id, user_id, day),
-            )
+            cur.execute(_SESSION_DAY_EXISTS_SQL, (chat_id, user_id, day))
             return cur.fetchone() is not None
 
     def session_today_completed(self, *, chat_id: int, user_id: int, day: str) -> bool:
         with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                "SELECT 1 FROM sessions WHERE chat_id=%s AND user_id=%s AND session_day=%s AND check_out IS NOT NULL LIMIT 1;",
-                (chat_id, user_id, day),
-            )
+            cur.execute(_SESSION_DAY_COMPLETED_SQL, (chat_id, user_id, day))
             return cur.fetchone() is not None
 
+    def session_today_status(self, *, chat_id: int, user_id: int, day: str) -> tuple[bool, bool]:
+        with self._connect() as conn, conn.cursor() as cur:
+            cur.execute(_SESSION_DAY_STATUS_SQL, (chat_id, user_id, day))
+            n, done = cur.fetchone()
+        return n > 0, done > 0
+
     def today_checkin_position(self, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
         with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT COUNT(1) AS n
-                FROM sessions
-                WHERE chat_id=%s
-                  AND session_day=%s
-                  AND (check_in < %s OR (check_in=%s AND id <= %s));
-                """,
-                (chat_id, day, check_in, check_in, session_id),
-            )
+            cur.execute(_CHECKIN_POSITION_SQL, (chat_id, day, check_in, session_id))
             row = cur.fetchone()
         n = int(row[0]) if row else 0
         return n if n > 0 else 1
 
-    def leaderboard(self, *, chat_id: int, mode: str, now: datetime) -> list[tuple[int, str, int]]:
-        params: list[Any] = [now, chat_id]
-        where = ""
+    def leaderboard(self, *, chat_id: int, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
         if mode == "today":
             # 与 SQLite 口径一致：业务日（凌晨 4 点切换）
-            where = "AND s.session_day = %s"
-            params.append(business_day_key(now, cutoff_hour=4))
-        with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT
-                  u.user_id AS user_id,
-                  COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
-                  SUM(EXTRACT(EPOCH FROM (COALESCE(s.check_out, %s) - s.check_in)))::bigint AS seconds
-                FROM sessions s
-                JOIN users u ON u.user_id = s.user_id
-                WHERE s.chat_id = %s
-                {where}
-                GROUP BY u.user_id
-                ORDER BY seconds DESC;
-                """,
-                tuple(params),
-            )
-            rows = cur.fetchall()
-        out: list[tuple[int, str, int]] = []
-        for user_id, name, seconds in rows:
-            out.append((int(user_id), _display_name_from_row(name, int(user_id)), int(seconds or 0)))
-        return out
-
-    def leaderboard_global(self, *, mode: str, now: datetime) -> list[tuple[int, str, int]]:
-        params: list[Any] = [now]
-        where = ""
+            rows = self._stream(_LEADERBOARD_TODAY_SQL, (now, chat_id, business_day_key(now, cutoff_hour=4), limit))
+        else:
+            rows = self._stream(_LEADERBOARD_ALL_SQL, (now, chat_id, limit))
+        return [(uid, _display_name_from_row(name, uid), seconds or 0) for (uid, name, seconds) in rows]
+
+    def leaderboard_global(self, *, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
         if mode == "today":
-            where = "AND s.session_day = %s"
-            params.append(business_day_key(now, cutoff_hour=4))
-        with self._connect() as conn, conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT
-                  u.user_id AS user_id,
-                  COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
-                  SUM(EXTRACT(EPOCH FROM (COALESCE(s.check_out, %s) - s.check_in)))::bigint AS seconds
-                FROM sessions s
-                JOIN users u ON u.user_id = s.user_id
-                WHERE 1=1
-                {where}
-                GROUP BY u.user_id
-                ORDER BY seconds DESC;
-                """,
-                tuple(params),
-            )
-            rows = cur.fetchall()
-        out: list[tuple[int, str, int]] = []
-        for user_id, name, seconds in rows:
-            out.append((int(user_id), _display_name_from_row(name, int(user_id)), int(seconds or 0)))
-        return out
+            rows = self._stream(_LEADERBOARD_GLOBAL_TODAY_SQL, (now, business_day_key(now, cutoff_hour=4), limit))
+        else:
+            rows = self._stream(_LEADERBOARD_GLOBAL_ALL_SQL, (now, limit))
+        return [(uid, _display_name_from_row(name, uid), seconds or 0) for (uid, name, seconds) in rows]
+
+    def snapshot(
+        self, *, chat_id: int, user_id: int, day: str, streak_key: str = "earliest", limit: int = 20
+    ) -> ChatSnapshot:
+        """
+        一次往返取回一个 chat 的常用状态：当天未签退的人、某用户的成就统计、连续榜。
+        三条 SELECT 在 pipeline 里一起发出；pipeline 不会串行等待，结果要等 with 块结束（同步）后再读。
+        """
+        with self._connect() as conn:
+            with conn.pipeline():
+                open_cur = conn.execute(
+                    "SELECT DISTINCT user_id FROM sessions WHERE chat_id=%s AND check_out IS NULL AND session_day=%s;",
+                    (chat_id, day),
+                )
+                stats_cur = conn.execute(
+                    """
+                    SELECT key, count, last_awarded_at
+                    FROM achievement_stats
+                    WHERE chat_id=%s AND user_id=%s
+                    ORDER BY count DESC, key ASC;
+                    """,
+                    (chat_id, user_id),
+                )
+                rank_cur = conn.execute(
+                    """
+                    SELECT
+                      u.user_id AS user_id,
+                      u.display_name AS name,
+                      st.streak AS streak
+                    FROM streaks st
+                    JOIN users u ON u.user_id = st.user_id
+                    WHERE st.chat_id=%s AND st.key=%s
+                    ORDER BY st.streak DESC, u.user_id ASC
+                    LIMIT %s;
+                    """,
+                    (chat_id, streak_key, limit),
+                )
+            open_rows = open_cur.fetchall()
+            stats_rows = stats_cur.fetchall()
+            rank_rows = rank_cur.fetchall()
+        return ChatSnapshot(
+            open_user_ids={r[0] for r in open_rows},
+            achievement_stats=[(k, c, str(t)) for (k, c, t) in stats_rows],
+            streak_rank=[(uid, _display_name_from_row(name, uid), st) for (uid, name, st) in rank_rows],
+        )
 
     def open_user_ids(self, *, chat_id: int, day: str | None = None) -> set[int]:
+        # array_agg 聚成一行 int[] 返回：一条消息代替 N 行，psycopg 直接解码成 list
         with self._connect() as conn, conn.cursor() as cur:
             if day:
                 cur.execute(
                     """
-                    SELECT DISTINCT user_id
+                    SELECT COALESCE(array_agg(DISTINCT user_id), '{}')
                     FROM sessions
                     WHERE chat_id=%s AND check_out IS NULL AND session_day=%s;
                     """,
@@ -341,21 +609,21 @@ class PostgresStorage(Storage):
             else:
                 cur.execute(
                     """
-                    SELECT DISTINCT user_id
+                    SELECT COALESCE(array_agg(DISTINCT user_id), '{}')
                     FROM sessions
                     WHERE chat_id=%s AND check_out IS NULL;
                     """,
                     (chat_id,),
                 )
-            rows = cur.fetchall()
-        return {int(r[0]) for r in rows}
+            row = cur.fetchone()
+        return set(row[0]) if row else set()
 
     def open_user_ids_global(self, day: str | None = None) -> set[int]:
         with self._connect() as conn, conn.cursor() as cur:
             if day:
                 cur.execute(
                     """
-                    SELECT DISTINCT user_id
+                    SELECT COALESCE(array_agg(DISTINCT user_id), '{}')
                     FROM sessions
                     WHERE check_out IS NULL AND session_day=%s;
                     """,
@@ -364,13 +632,13 @@ class PostgresStorage(Storage):
             else:
                 cur.execute(
                     """
-                    SELECT DISTINCT user_id
+                    SELECT COALESCE(array_agg(DISTINCT user_id), '{}')
                     FROM sessions
                     WHERE check_out IS NULL;
                     """
                 )
-            rows = cur.fetchall()
-        return {int(r[0]) for r in rows}
+            row = cur.fetchone()
+        return set(row[0]) if row else set()
 
     def set_daily_earliest(
         self,
@@ -397,37 +665,15 @@ class PostgresStorage(Storage):
             return False
 
     def update_streak(self, *, chat_id: int, user_id: int, key: str, day: str, created_at: datetime) -> int:
+        day_epoch = date.fromisoformat(day).toordinal() - _EPOCH_ORDINAL
         with self._connect() as conn, conn.cursor() as cur:
             cur.execute(
-                "SELECT last_day, streak FROM streaks WHERE chat_id=%s AND user_id=%s AND key=%s;",
-                (chat_id, user_id, key),
+                _UPSERT_STREAK_SQL,
+                (chat_id, user_id, key, day, day_epoch, created_at),
             )
             row = cur.fetchone()
-            if row:
-                last_day, prev = str(row[0]), int(row[1])
-                try:
-                    new_streak = prev + 1 if (date.fromisoformat(day) - date.fromisoformat(last_day)).days == 1 else 1
-                except Exception:
-                    new_streak = 1
-                cur.execute(
-                    """
-                    UPDATE streaks
-                    SET last_day=%s, streak=%s, updated_at=%s
-                    WHERE chat_id=%s AND user_id=%s AND key=%s;
-                    """,
-                    (day, new_streak, created_at, chat_id, user_id, key),
-                )
-                conn.commit()
-                return new_streak
-            cur.execute(
-                """
-                INSERT INTO streaks(chat_id, user_id, key, last_day, streak, updated_at)
-                VALUES(%s,%s,%s,%s,%s,%s);
-                """,
-                (chat_id, user_id, key, day, 1, created_at),
-            )
             conn.commit()
-            return 1
+        return int(row[0]) if row else 1
 
     def get_streak(self, *, chat_id: int, user_id: int, key: str) -> int:
         with self._connect() as conn, conn.cursor() as cur:
@@ -464,7 +710,8 @@ class PostgresStorage(Storage):
         session_id: int | None = None,
     ) -> bool:
         try:
-            with self._connect() as conn, conn.cursor() as cur:
+            # 三条 INSERT 走 pipeline 一次发出：成就事件 + 分群计数 + 跨群计数，省往返；唯一约束冲突在 pipeline 同步时抛出
+            with self._connect() as conn, conn.pipeline(), conn.cursor() as cur:
                 cur.execute(
                     """
                     INSERT INTO achievement_events(chat_id, user_id, key, day, session_id, created_at)
@@ -473,22 +720,39 @@ class PostgresStorage(Storage):
                     (chat_id, user_id, key, day, session_id, created_at),
                 )
                 cur.execute(
-                    """
-                    INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
-                    VALUES(%s,%s,%s,1,%s)
-                    ON CONFLICT (chat_id, user_id, key) DO UPDATE SET
-                      count = achievement_stats.count + 1,
-                      last_awarded_at = EXCLUDED.last_awarded_at;
-                    """,
+                    _BUMP_ACHIEVEMENT_STATS_SQL,
                     (chat_id, user_id, key, created_at),
                 )
+                cur.execute(_BUMP_ACHIEVEMENT_STATS_GLOBAL_SQL, (user_id, key, created_at))
                 conn.commit()
             return True
         except UniqueViolation:
             return False
 
-    def get_achievement_stats(self, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
+    def award_achievements_bulk(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        keys: list[str],
+        created_at: datetime,
+        day: str | None = None,
+        session_id: int | None = None,
+    ) -> list[str]:
+        # 同一个连接、一次提交；去重走 ON CONFLICT DO NOTHING，冲突不会让整个事务作废
         with self._connect() as conn, conn.cursor() as cur:
+            awarded = [
+                key
+                for key in keys
+                if self._award_in(
+                    cur, chat_id=chat_id, user_id=user_id, key=key, day=day, created_at=created_at, session_id=session_id
+                )
+            ]
+            conn.commit()
+        return awarded
+
+    def get_achievement_stats(self, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
+        with self._connect() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
                 SELECT key, count, last_awarded_at
@@ -499,22 +763,21 @@ class PostgresStorage(Storage):
                 (chat_id, user_id),
             )
             rows = cur.fetchall()
-        return [(str(k), int(c), str(t)) for (k, c, t) in rows]
+        return [(k, c, str(t)) for (k, c, t) in rows]
 
     def get_achievement_stats_global(self, *, user_id: int) -> list[tuple[str, int, str]]:
-        with self._connect() as conn, conn.cursor() as cur:
+        with self._connect() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
-                SELECT key, SUM(count) AS count, MAX(last_awarded_at) AS last_awarded_at
-                FROM achievement_stats
+                SELECT key, count, last_awarded_at
+                FROM achievement_stats_global
                 WHERE user_id=%s
-                GROUP BY key
                 ORDER BY count DESC, key ASC;
                 """,
                 (user_id,),
             )
             rows = cur.fetchall()
-        return [(str(k), int(c), str(t)) for (k, c, t) in rows]
+        return [(k, c, str(t)) for (k, c, t) in rows]
 
     def get_achievement_count(self, *, chat_id: int, user_id: int, key: str) -> int:
         with self._connect() as conn, conn.cursor() as cur:
@@ -528,19 +791,19 @@ class PostgresStorage(Storage):
     def get_achievement_count_global(self, *, user_id: int, key: str) -> int:
         with self._connect() as conn, conn.cursor() as cur:
             cur.execute(
-                "SELECT COALESCE(SUM(count),0) FROM achievement_stats WHERE user_id=%s AND key=%s;",
+                "SELECT count FROM achievement_stats_global WHERE user_id=%s AND key=%s;",
                 (user_id, key),
             )
             row = cur.fetchone()
         return int(row[0]) if row else 0
 
     def achievement_rank_by_count(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        with self._connect() as conn, conn.cursor() as cur:
+        with self._connect() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
                 SELECT
                   u.user_id AS user_id,
-                  COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
+                  u.display_name AS name,
                   s.count AS count
                 FROM achievement_stats s
                 JOIN users u ON u.user_id = s.user_id
@@ -551,35 +814,34 @@ class PostgresStorage(Storage):
                 (chat_id, key, limit),
             )
             rows = cur.fetchall()
-        return [(int(uid), _display_name_from_row(name, int(uid)), int(cnt)) for (uid, name, cnt) in rows]
+        return [(uid, _display_name_from_row(name, uid), cnt) for (uid, name, cnt) in rows]
 
     def achievement_rank_by_count_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        with self._connect() as conn, conn.cursor() as cur:
+        with self._connect() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
                 SELECT
                   u.user_id AS user_id,
-                  COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
-                  SUM(s.count) AS count
-                FROM achievement_stats s
+                  u.display_name AS name,
+                  s.count AS count
+                FROM achievement_stats_global s
                 JOIN users u ON u.user_id = s.user_id
                 WHERE s.key=%s
-                GROUP BY u.user_id
-                ORDER BY count DESC, u.user_id ASC
+                ORDER BY s.count DESC, u.user_id ASC
                 LIMIT %s;
                 """,
                 (key, limit),
             )
             rows = cur.fetchall()
-        return [(int(uid), _display_name_from_row(name, int(uid)), int(cnt)) for (uid, name, cnt) in rows]
+        return [(uid, _display_name_from_row(name, uid), cnt) for (uid, name, cnt) in rows]
 
     def streak_rank(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        with self._connect() as conn, conn.cursor() as cur:
+        with self._connect() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
                 SELECT
                   u.user_id AS user_id,
-                  COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
+                  u.display_name AS name,
                   st.streak AS streak
                 FROM streaks st
                 JOIN users u ON u.user_id = st.user_id
@@ -590,40 +852,33 @@ class PostgresStorage(Storage):
                 (chat_id, key, limit),
             )
             rows = cur.fetchall()
-        return [(int(uid), _display_name_from_row(name, int(uid)), int(st)) for (uid, name, st) in rows]
+        return [(uid, _display_name_from_row(name, uid), st) for (uid, name, st) in rows]
 
     def streak_rank_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int, int | None, str | None]]:
-        with self._connect() as conn, conn.cursor() as cur:
+        with self._connect() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
-                WITH ranked AS (
-                  SELECT
-                    st.user_id,
-                    st.chat_id,
-                    st.streak,
-                    ROW_NUMBER() OVER (PARTITION BY st.user_id ORDER BY st.streak DESC, st.chat_id ASC) AS rn
-                  FROM streaks st
-                  WHERE st.key=%s
-                )
                 SELECT
                   u.user_id AS user_id,
-                  COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
+                  u.display_name AS name,
                   r.streak AS streak,
                   r.chat_id AS chat_id,
                   c.title AS chat_title
-                FROM ranked r
+                FROM (
+                  -- 每人取最好的一个群：DISTINCT ON 可直接沿 idx_streaks_key_user_streak 取每组第一行
+                  SELECT DISTINCT ON (st.user_id) st.user_id, st.chat_id, st.streak
+                  FROM streaks st
+                  WHERE st.key=%s
+                  ORDER BY st.user_id, st.streak DESC, st.chat_id ASC
+                ) r
                 JOIN users u ON u.user_id = r.user_id
                 LEFT JOIN chats c ON c.chat_id = r.chat_id
-                WHERE r.rn=1
                 ORDER BY r.streak DESC, u.user_id ASC
                 LIMIT %s;
                 """,
                 (key, limit),
             )
             rows = cur.fetchall()
-        out: list[tuple[int, str, int, int | None, str | None]] = []
-        for uid, name, streak, cid, ctitle in rows:
-            out.append((int(uid), _display_name_from_row(name, int(uid)), int(streak), int(cid) if cid is not None else None, str(ctitle) if ctitle is not None else None))
-        return out
+        return [(uid, _display_name_from_row(name, uid), streak, cid, ctitle) for (uid, name, streak, cid, ctitle) in rows]
 
 
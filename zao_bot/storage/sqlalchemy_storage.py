@@ -1,47 +1,969 @@
 from __future__ import annotations
 
 import os
-from dataclasses import dataclass
+import sqlite3
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta, timezone
-from typing import Any
+from typing import Any, Callable
 
-from sqlalchemy import create_engine, event, text
-from sqlalchemy.engine import Engine
+from sqlalchemy import bindparam, create_engine, event, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql.elements import TextClause
 from sqlalchemy.exc import IntegrityError
 
-from zao_bot.storage.base import OpenSession, Storage
+from zao_bot.storage.base import CheckInRecord, OpenSession, RSPChoiceReason, Storage, WakeReminder
 from zao_bot.time_utils import business_day_key
 
 
-def _display_name(name: str | None, user_id: int) -> str:
-    nm = (name or str(user_id)).strip()
+def _display_name(user_id: int, username: str | None, first_name: str | None, last_name: str | None) -> str:
+    # 查询只取原始列，名字在这里拼：有 username 用 username，否则 "first last"，都没有用 user_id
+    nm = (username or " ".join(p for p in (first_name, last_name) if p) or str(user_id)).strip()
     if nm and " " not in nm and not nm.isdigit() and not nm.startswith("@"):
         nm = f"@{nm}"
     return nm
 
 
+def _identity(v: Any) -> Any:
+    return v
+
+
+# SQLite 3.38+ 有 unixepoch()：按整数秒直接相减，不必经 julianday 的浮点换算（也没有舍入误差）
+_SQLITE_HAS_UNIXEPOCH = sqlite3.sqlite_version_info >= (3, 38, 0)
+
+
+def _sqlite_seconds_between(start: str, end: str) -> str:
+    """SQLite 表达式：end - start 的整秒数（两者为 isoformat 文本列/参数）。"""
+    if _SQLITE_HAS_UNIXEPOCH:
+        return f"(unixepoch({end}) - unixepoch({start}))"
+    return f"CAST((julianday({end}) - julianday({start})) * 86400 AS INTEGER)"
+
+
+# schema 版本：init_db 里的建表/迁移有改动时 +1。库已是该版本时，启动只做一次探测，跳过整段 DDL
+_SCHEMA_VERSION = 7
+_SQL_SCHEMA_VERSION_TABLE = text(
+    """
+    CREATE TABLE IF NOT EXISTS schema_version (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      version INTEGER NOT NULL
+    );
+    """
+)
+_SQL_SET_SCHEMA_VERSION = text(
+    "INSERT INTO schema_version(id, version) VALUES(1, :v) ON CONFLICT (id) DO UPDATE SET version=EXCLUDED.version;"
+)
+
+# 编译缓存：默认 500 条，榜单变体 + 各方法语句加起来不多，放宽一些保证常驻不被挤出
+_QUERY_CACHE_SIZE = 1200
+
+# 热路径 SQL：模块级构造一次，SQLAlchemy 的编译缓存按同一对象命中，省掉每次调用构造 TextClause
+# ON CONFLICT ... DO UPDATE 在 Postgres 与 SQLite（3.24+）写法相同，两种方言共用
+_SQL_UPSERT_USER = text(
+    """
+    INSERT INTO users(user_id, username, first_name, last_name, updated_at)
+    VALUES(:uid,:un,:fn,:ln,:ua)
+    ON CONFLICT (user_id) DO UPDATE SET
+      username=EXCLUDED.username,
+      first_name=EXCLUDED.first_name,
+      last_name=EXCLUDED.last_name,
+      updated_at=EXCLUDED.updated_at;
+    """
+)
+_SQL_UPSERT_CHAT = text(
+    """
+    INSERT INTO chats(chat_id, title, chat_type, updated_at)
+    VALUES(:cid,:t,:ct,:ua)
+    ON CONFLICT (chat_id) DO UPDATE SET
+      title=EXCLUDED.title,
+      chat_type=EXCLUDED.chat_type,
+      updated_at=EXCLUDED.updated_at;
+    """
+)
+# Postgres：两条 upsert 合成一条语句（数据修改型 CTE 即使不被引用也会执行），一次往返
+_SQL_UPSERT_USER_AND_CHAT_PG = text(
+    """
+    WITH upsert_user AS (
+      INSERT INTO users(user_id, username, first_name, last_name, updated_at)
+      VALUES(:uid,:un,:fn,:ln,:ua)
+      ON CONFLICT (user_id) DO UPDATE SET
+        username=EXCLUDED.username,
+        first_name=EXCLUDED.first_name,
+        last_name=EXCLUDED.last_name,
+        updated_at=EXCLUDED.updated_at
+    )
+    INSERT INTO chats(chat_id, title, chat_type, updated_at)
+    VALUES(:cid,:t,:ct,:ua)
+    ON CONFLICT (chat_id) DO UPDATE SET
+      title=EXCLUDED.title,
+      chat_type=EXCLUDED.chat_type,
+      updated_at=EXCLUDED.updated_at;
+    """
+)
+# 同一业务日重复签到由 idx_sessions_user_day 兜住：DO NOTHING 时不返回行，不必走异常 + 回滚
+# daily_rank：本群当日第几个签到，插入时定下来，/zao 回显名次只需按主键取
+# MAX+1 要求同一 (chat_id, session_day) 的签到串行：SQLite 靠 BEGIN IMMEDIATE，PG 先拿 _SQL_CHECKIN_RANK_LOCK_PG
+# （SELECT 带 WHERE，SQLite 才不会把 ON CONFLICT 解析成 JOIN 的 ON）
+_SQL_CHECK_IN = text(
+    """
+    INSERT INTO sessions(chat_id, user_id, session_day, check_in, daily_rank)
+    SELECT :cid, :uid, :day, :ci, COALESCE(MAX(daily_rank), 0) + 1
+    FROM sessions
+    WHERE chat_id=:cid AND session_day=:day
+    ON CONFLICT (chat_id, user_id, session_day) DO NOTHING
+    RETURNING id, daily_rank;
+    """
+)
+# PG 默认 READ COMMITTED 下两个并发签到会读到同一个 MAX：按 (chat_id, session_day) 取事务级 advisory lock，提交/回滚时自动释放
+_SQL_CHECKIN_RANK_LOCK_PG = text(
+    "SELECT pg_advisory_xact_lock(hashtextextended(CAST(:cid AS text) || ':' || :day, 0));"
+)
+# 按 (check_in, id) 重排含未定名次行的那些群日：旧库升级、批量导入后都走这一条，保证 MAX(daily_rank) 不漏数
+# （UPDATE ... FROM 两种方言通用，SQLite 需 3.33+）
+_SQL_BACKFILL_DAILY_RANK = text(
+    """
+    UPDATE sessions
+    SET daily_rank = r.rn
+    FROM (
+      SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id, session_day ORDER BY check_in, id) AS rn
+      FROM sessions
+      WHERE (chat_id, session_day) IN (
+        SELECT chat_id, session_day FROM sessions WHERE daily_rank IS NULL AND session_day IS NOT NULL
+      )
+    ) AS r
+    WHERE sessions.id = r.id;
+    """
+)
+# 签退：一条 UPDATE ... RETURNING 同时定位当日 open session 并写入（每日唯一索引保证至多一行），
+# 签退时间早于签到时间时夹到 check_in（时钟回拨等）
+_SQL_CHECK_OUT_PG = text(
+    """
+    UPDATE sessions
+    SET check_out = GREATEST(:co, check_in),
+        duration_sec = GREATEST(EXTRACT(EPOCH FROM (:co - check_in)), 0)::bigint
+    WHERE chat_id=:cid AND user_id=:uid AND session_day=:d AND check_out IS NULL
+    RETURNING id, check_in;
+    """
+)
+_SQL_CHECK_OUT_SQLITE = text(
+    f"""
+    UPDATE sessions
+    SET check_out = CASE WHEN julianday(:co) < julianday(check_in) THEN check_in ELSE :co END,
+        duration_sec = MAX({_sqlite_seconds_between("check_in", ":co")}, 0)
+    WHERE chat_id=:cid AND user_id=:uid AND session_day=:d AND check_out IS NULL
+    RETURNING id, check_in;
+    """
+)
+# 批量导入历史 session：executemany 一批一个事务（psycopg3 的 executemany 走 pipeline，一批一次往返）
+_SQL_IMPORT_SESSION = text(
+    """
+    INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out, duration_sec)
+    VALUES(:cid,:uid,:day,:ci,:co,:dur)
+    ON CONFLICT (chat_id, user_id, session_day) DO NOTHING;
+    """
+)
+_SESSION_IMPORT_BATCH = {"postgresql": 10_000, "sqlite": 1_000}
+# 指定业务日：每日唯一索引保证至多一行，不需要排序
+_SQL_OPEN_SESSION_DAY = text(
+    "SELECT id, check_in FROM sessions WHERE chat_id=:cid AND user_id=:uid AND session_day=:day AND check_out IS NULL;"
+)
+# 不限业务日（找跨日遗留的未签退记录）：走 idx_sessions_open 部分索引，取最近一条
+_SQL_OPEN_SESSION_ANY = text(
+    """
+    SELECT id, check_in
+    FROM sessions
+    WHERE chat_id=:cid AND user_id=:uid AND check_out IS NULL
+    ORDER BY id DESC
+    LIMIT 1;
+    """
+)
+# 当日是否有 session / 是否已签退：一次聚合同时拿到两个标记
+_SQL_SESSION_DAY_STATUS = text(
+    "SELECT COUNT(1), COUNT(check_out) FROM sessions WHERE chat_id=:cid AND user_id=:uid AND session_day=:d;"
+)
+_SQL_USER_CHECKIN_DAYS = text(
+    "SELECT DISTINCT session_day FROM sessions WHERE user_id=:uid AND session_day BETWEEN :start AND :end;"
+)
+# 没有 daily_rank 的行（批量导入等）退回按 (check_in, id) 现数
+_SQL_CHECKIN_POSITION = text(
+    """
+    SELECT COALESCE(
+      s.daily_rank,
+      (
+        SELECT COUNT(1)
+        FROM sessions o
+        WHERE o.chat_id = s.chat_id
+          AND o.session_day = s.session_day
+          AND (o.check_in < s.check_in OR (o.check_in = s.check_in AND o.id <= s.id))
+      )
+    )
+    FROM sessions s
+    WHERE s.id=:id;
+    """
+)
+# 签到/签退后的成就写入（record_checkin 的签到事务与 achievements.on_check_out 每次都会走）
+# 去重写入不靠抛 IntegrityError：冲突时 DO NOTHING，由 RETURNING 是否有行判断是否写入
+# （每个群每天只有第一个签到的人能写进 daily_earliest，其余签到都会冲突）
+_SQL_INSERT_DAILY_EARLIEST = text(
+    """
+    INSERT INTO daily_earliest(chat_id, day, user_id, session_id, check_in, created_at)
+    VALUES(:cid,:d,:uid,:sid,:ci,:ca)
+    ON CONFLICT (chat_id, day) DO NOTHING
+    RETURNING chat_id;
+    """
+)
+# 一条 UPSERT：上次记录的正好是前一天则 +1，否则从 1 重新计（前一天由调用方算好传入 :prev，两种方言通用）
+_SQL_UPSERT_STREAK = text(
+    """
+    INSERT INTO streaks(chat_id, user_id, key, last_day, streak, updated_at)
+    VALUES(:cid,:uid,:k,:d,1,:ua)
+    ON CONFLICT (chat_id, user_id, key) DO UPDATE SET
+      streak = CASE WHEN streaks.last_day = :prev THEN streaks.streak + 1 ELSE 1 END,
+      last_day = excluded.last_day,
+      updated_at = excluded.updated_at
+    RETURNING streak;
+    """
+)
+_SQL_GET_STREAK = text("SELECT streak FROM streaks WHERE chat_id=:cid AND user_id=:uid AND key=:k;")
+# 不写冲突目标：命中任意一个成就去重的部分唯一索引都跳过
+_SQL_INSERT_ACHIEVEMENT_EVENT = text(
+    """
+    INSERT INTO achievement_events(chat_id, user_id, key, day, session_id, created_at)
+    VALUES(:cid,:uid,:k,:d,:sid,:ca)
+    ON CONFLICT DO NOTHING
+    RETURNING id;
+    """
+)
+_SQL_BUMP_ACHIEVEMENT_STATS = text(
+    """
+    INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
+    VALUES(:cid,:uid,:k,1,:ca)
+    ON CONFLICT (chat_id, user_id, key) DO UPDATE SET
+      count = achievement_stats.count + 1,
+      last_awarded_at = EXCLUDED.last_awarded_at;
+    """
+)
+# 跨群汇总计数随每次发放在同一事务里 +1，读全局统计时不再按 user_id 扫所有群的行做 SUM/MAX
+_SQL_BUMP_ACHIEVEMENT_STATS_GLOBAL = text(
+    """
+    INSERT INTO achievement_stats_global(user_id, key, count, last_awarded_at)
+    VALUES(:uid,:k,1,:ca)
+    ON CONFLICT (user_id, key) DO UPDATE SET
+      count = achievement_stats_global.count + 1,
+      last_awarded_at = CASE
+        WHEN EXCLUDED.last_awarded_at > achievement_stats_global.last_awarded_at THEN EXCLUDED.last_awarded_at
+        ELSE achievement_stats_global.last_awarded_at
+      END;
+    """
+)
+# 建表/升级时从 achievement_stats 重算一遍（幂等）；WHERE true 避免 SQLite 把 ON CONFLICT 解析成 JOIN 的一部分
+_SQL_BACKFILL_ACHIEVEMENT_STATS_GLOBAL = text(
+    """
+    INSERT INTO achievement_stats_global(user_id, key, count, last_awarded_at)
+    SELECT user_id, key, SUM(count), MAX(last_awarded_at)
+    FROM achievement_stats
+    WHERE true
+    GROUP BY user_id, key
+    ON CONFLICT (user_id, key) DO UPDATE SET
+      count = EXCLUDED.count,
+      last_awarded_at = EXCLUDED.last_awarded_at;
+    """
+)
+_SQL_RSP_GAME_BY_ID = text(
+    """
+    SELECT id, chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, completed_at, winner_id, message_id, created_at
+    FROM rsp_games
+    WHERE id=:gid;
+    """
+)
+_SQL_RSP_PENDING_ID = text(
+    """
+    SELECT id FROM rsp_games
+    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid) AND completed_at IS NULL
+    ORDER BY created_at DESC
+    LIMIT 1;
+    """
+)
+# 条件写入：只填本人那一格，且仅当还没选（compare-and-set）；PG 一条语句定位 pending 对局并 RETURNING
+_SQL_RSP_APPLY_CHOICE_PG = text(
+    """
+    UPDATE rsp_games SET
+      challenger_choice = CASE WHEN challenger_id=:uid AND challenger_choice IS NULL THEN :choice ELSE challenger_choice END,
+      opponent_choice = CASE WHEN opponent_id=:uid AND opponent_choice IS NULL THEN :choice ELSE opponent_choice END
+    WHERE id = (
+      SELECT id FROM rsp_games
+      WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid) AND completed_at IS NULL
+      ORDER BY created_at DESC
+      LIMIT 1
+    )
+      AND ((challenger_id=:uid AND challenger_choice IS NULL) OR (opponent_id=:uid AND opponent_choice IS NULL))
+    RETURNING id, chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, completed_at, winner_id, message_id, created_at;
+    """
+)
+_SQL_RSP_APPLY_CHOICE_SQLITE = text(
+    """
+    UPDATE rsp_games SET
+      challenger_choice = CASE WHEN challenger_id=:uid AND challenger_choice IS NULL THEN :choice ELSE challenger_choice END,
+      opponent_choice = CASE WHEN opponent_id=:uid AND opponent_choice IS NULL THEN :choice ELSE opponent_choice END
+    WHERE id=:gid
+      AND ((challenger_id=:uid AND challenger_choice IS NULL) OR (opponent_id=:uid AND opponent_choice IS NULL));
+    """
+)
+# 进行中的对局很少：部分索引只收 completed_at IS NULL 的行，体积小、查 pending 快
+_SQL_RSP_OPEN_INDEX = text(
+    "CREATE INDEX IF NOT EXISTS idx_rsp_open ON rsp_games(chat_id, challenger_id, opponent_id) WHERE completed_at IS NULL;"
+)
+_SQL_RSP_STATS_INDEX = text(
+    "CREATE INDEX IF NOT EXISTS idx_rsp_done ON rsp_games(chat_id, challenger_id, opponent_id) WHERE completed_at IS NOT NULL;"
+)
+_SQL_PENDING_RSP_GAME = text(
+    """
+    SELECT id, chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, completed_at, winner_id, message_id, created_at
+    FROM rsp_games
+    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid) AND completed_at IS NULL
+    ORDER BY created_at DESC
+    LIMIT 1;
+    """
+)
+
+
+# --- 成就 / 连续签到 / 榜单 ---
+_SQL_OPEN_USERS_DAY = text(
+    """
+    SELECT DISTINCT user_id
+    FROM sessions
+    WHERE chat_id=:cid AND check_out IS NULL AND session_day=:d;
+    """
+)
+_SQL_OPEN_USERS = text("SELECT DISTINCT user_id FROM sessions WHERE chat_id=:cid AND check_out IS NULL;")
+_SQL_OPEN_USERS_GLOBAL_DAY = text("SELECT DISTINCT user_id FROM sessions WHERE check_out IS NULL AND session_day=:d;")
+_SQL_OPEN_USERS_GLOBAL = text("SELECT DISTINCT user_id FROM sessions WHERE check_out IS NULL;")
+_SQL_STREAK_BEST_GLOBAL = text(
+    """
+    SELECT st.streak AS streak, st.chat_id AS chat_id, c.title AS chat_title
+    FROM streaks st
+    LEFT JOIN chats c ON c.chat_id = st.chat_id
+    WHERE st.user_id=:uid AND st.key=:k
+    ORDER BY st.streak DESC, st.chat_id ASC
+    LIMIT 1;
+    """
+)
+_SQL_ACHIEVEMENT_STATS = text(
+    """
+    SELECT key, count, last_awarded_at
+    FROM achievement_stats
+    WHERE chat_id=:cid AND user_id=:uid
+    ORDER BY count DESC, key ASC;
+    """
+)
+_SQL_ACHIEVEMENT_STATS_GLOBAL = text(
+    """
+    SELECT key, count, last_awarded_at
+    FROM achievement_stats_global
+    WHERE user_id=:uid
+    ORDER BY count DESC, key ASC;
+    """
+)
+_SQL_ACHIEVEMENT_COUNT = text("SELECT count FROM achievement_stats WHERE chat_id=:cid AND user_id=:uid AND key=:k;")
+_SQL_ACHIEVEMENT_COUNT_GLOBAL = text("SELECT count FROM achievement_stats_global WHERE user_id=:uid AND key=:k;")
+_SQL_ACHIEVEMENT_RANK = text(
+    """
+    SELECT
+      u.user_id AS user_id,
+      u.username, u.first_name, u.last_name,
+      s.count AS count
+    FROM achievement_stats s
+    JOIN users u ON u.user_id = s.user_id
+    WHERE s.chat_id=:cid AND s.key=:k
+    ORDER BY s.count DESC, s.user_id ASC
+    LIMIT :lim;
+    """
+)
+_SQL_ACHIEVEMENT_RANK_GLOBAL = text(
+    """
+    SELECT
+      u.user_id AS user_id,
+      u.username, u.first_name, u.last_name,
+      s.count AS count
+    FROM achievement_stats_global s
+    JOIN users u ON u.user_id = s.user_id
+    WHERE s.key=:k
+    ORDER BY s.count DESC, s.user_id ASC
+    LIMIT :lim;
+    """
+)
+_SQL_STREAK_RANK = text(
+    """
+    SELECT
+      u.user_id AS user_id,
+      u.username, u.first_name, u.last_name,
+      st.streak AS streak
+    FROM streaks st
+    JOIN users u ON u.user_id = st.user_id
+    WHERE st.chat_id=:cid AND st.key=:k
+    ORDER BY st.streak DESC, st.user_id ASC
+    LIMIT :lim;
+    """
+)
+_SQL_STREAK_RANK_GLOBAL_SQLITE = text(
+    """
+    SELECT
+      u.user_id AS user_id,
+      u.username, u.first_name, u.last_name,
+      MAX(st.streak) AS streak
+    FROM streaks st
+    JOIN users u ON u.user_id = st.user_id
+    WHERE st.key=:k
+    GROUP BY u.user_id
+    ORDER BY streak DESC, u.user_id ASC
+    LIMIT :lim;
+    """
+)
+# 先在 streaks 上取出前 :lim 名（每人只留最高的一条），再只对这几行 JOIN users/chats 取名字和群名
+_SQL_STREAK_RANK_GLOBAL_PG = text(
+    """
+    WITH ranked AS (
+      SELECT
+        st.user_id,
+        st.chat_id,
+        st.streak,
+        ROW_NUMBER() OVER (PARTITION BY st.user_id ORDER BY st.streak DESC, st.chat_id ASC) AS rn
+      FROM streaks st
+      WHERE st.key=:k
+    ),
+    top AS (
+      SELECT user_id, chat_id, streak
+      FROM ranked
+      WHERE rn=1
+      ORDER BY streak DESC, user_id ASC
+      LIMIT :lim
+    )
+    SELECT
+      u.user_id AS user_id,
+      u.username, u.first_name, u.last_name,
+      t.streak AS streak,
+      t.chat_id AS chat_id,
+      c.title AS chat_title
+    FROM top t
+    JOIN users u ON u.user_id = t.user_id
+    LEFT JOIN chats c ON c.chat_id = t.chat_id
+    ORDER BY t.streak DESC, t.user_id ASC;
+    """
+)
+
+# --- 俄罗斯轮盘 ---
+_SQL_ACTIVE_ROULETTE = text(
+    """
+    SELECT chat_id, chambers, bullet_position, current_position, created_by, created_at
+    FROM russian_roulette
+    WHERE chat_id=:cid;
+    """
+)
+_SQL_CREATE_ROULETTE = text(
+    """
+    INSERT INTO russian_roulette(chat_id, chambers, bullet_position, current_position, created_by, created_at)
+    VALUES(:cid,:ch,:bp,0,:cb,:ca);
+    """
+)
+_SQL_UPDATE_ROULETTE_POSITION = text("UPDATE russian_roulette SET current_position=:pos WHERE chat_id=:cid;")
+_SQL_DELETE_ROULETTE = text("DELETE FROM russian_roulette WHERE chat_id=:cid;")
+_SQL_RECORD_ROULETTE_ATTEMPT = text(
+    """
+    INSERT INTO roulette_attempts(chat_id, user_id, position, result, created_at)
+    VALUES(:cid,:uid,:pos,:res,:ca);
+    """
+)
+
+# --- 起床提醒 ---
+# enabled/repeat 直接绑 Python bool：psycopg 映射为 boolean，sqlite3 存为 1/0；两种方言都用 RETURNING 取 id
+_SQL_CREATE_REMINDER = text(
+    """
+    INSERT INTO wake_reminders(chat_id, user_id, wake_time, next_trigger, repeat, enabled, created_at)
+    VALUES(:cid,:uid,:wt,:nt,:rep,:en,:ca)
+    RETURNING id;
+    """
+)
+_SQL_PENDING_REMINDERS = text(
+    """
+    SELECT id, chat_id, user_id, wake_time, next_trigger, repeat, enabled
+    FROM wake_reminders
+    WHERE enabled=:enabled AND next_trigger <= :now
+    ORDER BY next_trigger;
+    """
+)
+_SQL_CLAIM_REMINDERS_PG = text(
+    """
+    SELECT id, chat_id, user_id, wake_time, next_trigger, repeat, enabled
+    FROM wake_reminders
+    WHERE enabled=true AND next_trigger <= :now
+    ORDER BY next_trigger
+    LIMIT :lim
+    FOR UPDATE SKIP LOCKED;
+    """
+)
+_SQL_LEASE_REMINDERS_PG = text("UPDATE wake_reminders SET next_trigger=:lease WHERE id IN :ids;").bindparams(bindparam("ids", expanding=True))
+_SQL_CLAIM_REMINDERS_SQLITE = text(
+    """
+    SELECT id, chat_id, user_id, wake_time, next_trigger, repeat, enabled
+    FROM wake_reminders
+    WHERE enabled=1 AND next_trigger <= :now
+    ORDER BY next_trigger
+    LIMIT :lim;
+    """
+)
+_SQL_LEASE_REMINDER_SQLITE = text("UPDATE wake_reminders SET next_trigger=:lease WHERE id=:id AND next_trigger=:old;")
+_SQL_USER_REMINDERS = text(
+    """
+    SELECT id, chat_id, user_id, wake_time, next_trigger, repeat, enabled
+    FROM wake_reminders
+    WHERE chat_id=:cid AND user_id=:uid AND enabled=:enabled
+    ORDER BY wake_time;
+    """
+)
+_SQL_UPDATE_REMINDER_TRIGGER = text("UPDATE wake_reminders SET next_trigger=:nt WHERE id=:id;")
+_SQL_DELETE_REMINDER = text("DELETE FROM wake_reminders WHERE id=:id;")
+_SQL_DELETE_USER_REMINDERS = text("DELETE FROM wake_reminders WHERE chat_id=:cid AND user_id=:uid;")
+
+# --- 石头剪刀布 ---
+_SQL_CREATE_RSP_GAME = text(
+    """
+    INSERT INTO rsp_games(chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, message_id, created_at)
+    VALUES(:cid,:challenger,:opponent,NULL,NULL,:mid,:ca)
+    RETURNING id;
+    """
+)
+_SQL_COMPLETE_RSP_GAME = text("UPDATE rsp_games SET completed_at=:ca, winner_id=:wid WHERE id=:gid;")
+_SQL_DELETE_RSP_GAME = text("DELETE FROM rsp_games WHERE id=:gid;")
+_SQL_RSP_TOTAL = text(
+    """
+    SELECT COUNT(*) FROM rsp_games
+    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid) AND completed_at IS NOT NULL;
+    """
+)
+_SQL_RSP_WINS = text(
+    """
+    SELECT COUNT(*) FROM rsp_games
+    WHERE chat_id=:cid AND winner_id=:uid AND completed_at IS NOT NULL;
+    """
+)
+_SQL_RSP_DRAWS = text(
+    """
+    SELECT COUNT(*) FROM rsp_games
+    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid)
+      AND winner_id IS NULL AND completed_at IS NOT NULL;
+    """
+)
+_SQL_RSP_TOTAL_GLOBAL = text(
+    """
+    SELECT COUNT(*) FROM rsp_games
+    WHERE (challenger_id=:uid OR opponent_id=:uid) AND completed_at IS NOT NULL;
+    """
+)
+_SQL_RSP_WINS_GLOBAL = text(
+    """
+    SELECT COUNT(*) FROM rsp_games
+    WHERE winner_id=:uid AND completed_at IS NOT NULL;
+    """
+)
+_SQL_RSP_DRAWS_GLOBAL = text(
+    """
+    SELECT COUNT(*) FROM rsp_games
+    WHERE (challenger_id=:uid OR opponent_id=:uid)
+      AND winner_id IS NULL AND completed_at IS NOT NULL;
+    """
+)
+
+
+# --- schema：建表/建索引语句按方言在模块级构造一次；init_db 里只保留需要判断的迁移 ---
+_PG_TABLES: tuple[TextClause, ...] = tuple(
+    text(sql)
+    for sql in (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+          user_id BIGINT PRIMARY KEY,
+          username TEXT,
+          first_name TEXT,
+          last_name TEXT,
+          updated_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+          chat_id BIGINT PRIMARY KEY,
+          title TEXT,
+          chat_type TEXT NOT NULL,
+          updated_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+          id BIGSERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          session_day TEXT,
+          check_in TIMESTAMPTZ NOT NULL,
+          check_out TIMESTAMPTZ
+        );
+        """,
+        # achievements
+        """
+        CREATE TABLE IF NOT EXISTS daily_earliest (
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          day TEXT NOT NULL,
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          session_id BIGINT NOT NULL REFERENCES sessions(id),
+          check_in TIMESTAMPTZ NOT NULL,
+          created_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY(chat_id, day)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS streaks (
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          key TEXT NOT NULL,
+          last_day TEXT NOT NULL,
+          streak INTEGER NOT NULL,
+          updated_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY(chat_id, user_id, key)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievement_events (
+          id BIGSERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          key TEXT NOT NULL,
+          day TEXT,
+          session_id BIGINT REFERENCES sessions(id),
+          created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievement_stats (
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          key TEXT NOT NULL,
+          count INTEGER NOT NULL,
+          last_awarded_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY(chat_id, user_id, key)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievement_stats_global (
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          key TEXT NOT NULL,
+          count INTEGER NOT NULL,
+          last_awarded_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY(user_id, key)
+        );
+        """,
+        # russian roulette
+        """
+        CREATE TABLE IF NOT EXISTS russian_roulette (
+          chat_id BIGINT PRIMARY KEY REFERENCES chats(chat_id),
+          chambers INT NOT NULL,
+          bullet_position INT NOT NULL,
+          current_position INT NOT NULL,
+          created_by BIGINT NOT NULL REFERENCES users(user_id),
+          created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS roulette_attempts (
+          id BIGSERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          position INT NOT NULL,
+          result TEXT NOT NULL,
+          created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        # wake reminders
+        """
+        CREATE TABLE IF NOT EXISTS wake_reminders (
+          id BIGSERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          user_id BIGINT NOT NULL REFERENCES users(user_id),
+          wake_time TEXT NOT NULL,
+          next_trigger TIMESTAMPTZ NOT NULL,
+          repeat BOOLEAN DEFAULT false,
+          enabled BOOLEAN DEFAULT true,
+          created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        # rock paper scissors
+        """
+        CREATE TABLE IF NOT EXISTS rsp_games (
+          id BIGSERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
+          challenger_id BIGINT NOT NULL REFERENCES users(user_id),
+          opponent_id BIGINT NOT NULL REFERENCES users(user_id),
+          challenger_choice TEXT,
+          opponent_choice TEXT,
+          completed_at TIMESTAMPTZ,
+          winner_id BIGINT REFERENCES users(user_id),
+          message_id BIGINT,
+          created_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+    )
+)
+_SQLITE_TABLES: tuple[TextClause, ...] = tuple(
+    text(sql)
+    for sql in (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+          user_id INTEGER PRIMARY KEY,
+          username TEXT,
+          first_name TEXT,
+          last_name TEXT,
+          updated_at TEXT NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+          chat_id INTEGER PRIMARY KEY,
+          title TEXT,
+          chat_type TEXT NOT NULL,
+          updated_at TEXT NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          session_day TEXT,
+          check_in TEXT NOT NULL,
+          check_out TEXT,
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+        """,
+        # achievements
+        """
+        CREATE TABLE IF NOT EXISTS daily_earliest (
+          chat_id INTEGER NOT NULL,
+          day TEXT NOT NULL,
+          user_id INTEGER NOT NULL,
+          session_id INTEGER NOT NULL,
+          check_in TEXT NOT NULL,
+          created_at TEXT NOT NULL,
+          PRIMARY KEY(chat_id, day),
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id),
+          FOREIGN KEY(session_id) REFERENCES sessions(id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS streaks (
+          chat_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          key TEXT NOT NULL,
+          last_day TEXT NOT NULL,
+          streak INTEGER NOT NULL,
+          updated_at TEXT NOT NULL,
+          PRIMARY KEY(chat_id, user_id, key),
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievement_events (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          key TEXT NOT NULL,
+          day TEXT,
+          session_id INTEGER,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id),
+          FOREIGN KEY(session_id) REFERENCES sessions(id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievement_stats (
+          chat_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          key TEXT NOT NULL,
+          count INTEGER NOT NULL,
+          last_awarded_at TEXT NOT NULL,
+          PRIMARY KEY(chat_id, user_id, key),
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS achievement_stats_global (
+          user_id INTEGER NOT NULL,
+          key TEXT NOT NULL,
+          count INTEGER NOT NULL,
+          last_awarded_at TEXT NOT NULL,
+          PRIMARY KEY(user_id, key),
+          FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+        """,
+        # russian roulette
+        """
+        CREATE TABLE IF NOT EXISTS russian_roulette (
+          chat_id INTEGER PRIMARY KEY,
+          chambers INTEGER NOT NULL,
+          bullet_position INTEGER NOT NULL,
+          current_position INTEGER NOT NULL,
+          created_by INTEGER NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(created_by) REFERENCES users(user_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS roulette_attempts (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          position INTEGER NOT NULL,
+          result TEXT NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+        """,
+        # wake reminders
+        """
+        CREATE TABLE IF NOT EXISTS wake_reminders (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          wake_time TEXT NOT NULL,
+          next_trigger TEXT NOT NULL,
+          repeat INTEGER DEFAULT 0,
+          enabled INTEGER DEFAULT 1,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+        """,
+        # rock paper scissors
+        """
+        CREATE TABLE IF NOT EXISTS rsp_games (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id INTEGER NOT NULL,
+          challenger_id INTEGER NOT NULL,
+          opponent_id INTEGER NOT NULL,
+          challenger_choice TEXT,
+          opponent_choice TEXT,
+          completed_at TEXT,
+          winner_id INTEGER,
+          message_id INTEGER,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+          FOREIGN KEY(challenger_id) REFERENCES users(user_id),
+          FOREIGN KEY(opponent_id) REFERENCES users(user_id),
+          FOREIGN KEY(winner_id) REFERENCES users(user_id)
+        );
+        """,
+    )
+)
+# 两种方言写法相同的索引
+_COMMON_INDEXES: tuple[TextClause, ...] = tuple(
+    text(sql)
+    for sql in (
+        "CREATE INDEX IF NOT EXISTS idx_sessions_chat_checkin ON sessions(chat_id, check_in);",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_chat_day ON sessions(chat_id, session_day);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_day ON sessions(chat_id, user_id, session_day);",
+        # 未签退的 session 很少：部分索引只收这些行，get_open_session 的点查更小更快
+        "CREATE INDEX IF NOT EXISTS idx_sessions_open ON sessions(chat_id, user_id, session_day) WHERE check_out IS NULL;",
+        "CREATE INDEX IF NOT EXISTS idx_roulette_attempts ON roulette_attempts(chat_id, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_wake_next_trigger ON wake_reminders(next_trigger, enabled);",
+        # 成就/连续签到排行：按 (chat_id, key) 定位后直接按索引顺序取前 N，免排序
+        "CREATE INDEX IF NOT EXISTS idx_ach_stats_chat_key_count ON achievement_stats(chat_id, key, count DESC, user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_ach_global_key_count ON achievement_stats_global(key, count DESC, user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_streaks_chat_key_streak ON streaks(chat_id, key, streak DESC, user_id);",
+        # 个人跨群最佳连续签到：按 (user_id, key) 定位后第一条就是答案
+        "CREATE INDEX IF NOT EXISTS idx_streaks_user_key_streak ON streaks(user_id, key, streak DESC, chat_id);",
+        # 成就去重（partial unique indexes）
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_ae_daily_unique ON achievement_events(chat_id, key, day) WHERE key='daily_earliest';",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_ae_streak7_unique
+        ON achievement_events(chat_id, user_id, key, day)
+        WHERE key='streak_earliest_7';
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_ae_session_unique
+        ON achievement_events(chat_id, user_id, key, session_id)
+        WHERE key IN ('ontime_8h','longday_12h');
+        """,
+    )
+) + (_SQL_RSP_OPEN_INDEX, _SQL_RSP_STATS_INDEX)
+# 榜单按 (chat_id, session_day, user_id) 聚合 duration_sec；SQLite 没有 INCLUDE，放进索引列
+_PG_INDEXES = _COMMON_INDEXES + (
+    text(
+        "CREATE INDEX IF NOT EXISTS idx_sessions_chat_day_user_dur ON sessions(chat_id, session_day, user_id) INCLUDE (duration_sec);"
+    ),
+)
+_SQLITE_INDEXES = _COMMON_INDEXES + (
+    text("CREATE INDEX IF NOT EXISTS idx_sessions_chat_day_user_dur ON sessions(chat_id, session_day, user_id, duration_sec);"),
+)
+
+
 @dataclass(frozen=True)
 class SQLAlchemyStorage(Storage):
     url: str
-
-    def _parse_dt(self, v: Any) -> datetime:
-        if isinstance(v, datetime):
+    # 方言与榜单 SQL 在构造时确定，热路径上不再每次查 engine.dialect.name、拼 SQL
+    _dialect: str = field(init=False, repr=False, compare=False)
+    _leaderboard_sql: dict[tuple[bool, bool, bool], TextClause] = field(init=False, repr=False, compare=False)
+    # datetime 参数的方言适配：Postgres 原样传给驱动，SQLite 存 isoformat 文本
+    _dt: Callable[[datetime], Any] = field(init=False, repr=False, compare=False)
+
+    @staticmethod
+    def _parse_dt(v: Any) -> datetime:
+        # SQLite 里是 isoformat 文本（最常见，先判断），Postgres 驱动直接给 datetime
+        cls = v.__class__
+        if cls is str:
+            return datetime.fromisoformat(v)
+        if cls is datetime:
             return v
         return datetime.fromisoformat(str(v))
 
     def __post_init__(self) -> None:
-        object.__setattr__(self, "_engine", self._make_engine(self.url))
+        engine = self._make_engine(self.url)
+        object.__setattr__(self, "_engine", engine)
+        object.__setattr__(self, "_dialect", engine.dialect.name)
+        object.__setattr__(self, "_dt", _identity if self._dialect == "postgresql" else datetime.isoformat)
+        object.__setattr__(
+            self,
+            "_leaderboard_sql",
+            {
+                (scoped, today, with_open): self._build_leaderboard_sql(scoped=scoped, today=today, with_open=with_open)
+                for scoped in (True, False)
+                for today in (True, False)
+                for with_open in (True, False)
+            },
+        )
 
     @property
     def engine(self) -> Engine:
         return getattr(self, "_engine")
 
+    @contextmanager
+    def _reader(self) -> Iterator[Connection]:
+        """
+        只读点查用的短连接：从连接池借一条、切到 AUTOCOMMIT（不发 BEGIN/ROLLBACK），用完立即归还。
+        连接复用交给连接池，断线/回收（pool_pre_ping、pool_recycle）也照常由 checkout 处理。
+        """
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            yield conn
+
     def _make_engine(self, url: str) -> Engine:
         if url.startswith("sqlite"):
+            # 本地文件库不会“断线”，不需要 pre_ping（每次 checkout 多一条 SELECT 1）；
+            # 保留默认的 QueuePool 复用连接，否则每次都要重新执行下面的 PRAGMA
             engine = create_engine(
                 url,
                 future=True,
-                pool_pre_ping=True,
+                query_cache_size=_QUERY_CACHE_SIZE,
                 connect_args={"check_same_thread": False},
             )
 
@@ -52,464 +974,187 @@ class SQLAlchemyStorage(Storage):
                     cur.execute(f"PRAGMA journal_mode={os.getenv('SQLITE_JOURNAL_MODE', 'WAL')};")
                     cur.execute(f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')};")
                     cur.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))};")
-                    cur.execute(f"PRAGMA wal_autocheckpoint={int(os.getenv('SQLITE_WAL_AUTOCHECKPOINT', '1000'))};")
+                    cur.execute(f"PRAGMA wal_autocheckpoint={int(os.getenv('SQLITE_WAL_AUTOCHECKPOINT', '2000'))};")
+                    cur.execute(f"PRAGMA journal_size_limit={int(os.getenv('SQLITE_JOURNAL_SIZE_LIMIT', '67108864'))};")
+                    # 读多写少：mmap 让读走内存映射，减少 read() 系统调用
+                    cur.execute(f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', '268435456'))};")
+                    # 页缓存按连接分配，默认只有 2MB；负数表示 KiB
+                    cur.execute(f"PRAGMA cache_size={int(os.getenv('SQLITE_CACHE_SIZE', '-65536'))};")
                     cur.execute("PRAGMA temp_store=MEMORY;")
                     cur.execute("PRAGMA foreign_keys=ON;")
                 finally:
                     cur.close()
+                # 事务由下面的 begin 钩子显式开启，不让 sqlite3 模块在 DML 前自己补一个 DEFERRED BEGIN
+                dbapi_conn.isolation_level = None
+
+            @event.listens_for(engine, "begin")
+            def _sqlite_begin_immediate(conn: Connection) -> None:  # type: ignore[no-redef]
+                # 写事务一开始就拿写锁：DEFERRED 事务读完再写时要中途升级锁，并发写入下可能直接 SQLITE_BUSY；
+                # IMMEDIATE 在 BEGIN 处按 busy_timeout 等锁。只读短连接（_reader）是 AUTOCOMMIT，不开事务
+                if conn.get_execution_options().get("isolation_level") != "AUTOCOMMIT":
+                    conn.exec_driver_sql("BEGIN IMMEDIATE")
 
             return engine
 
-        return create_engine(url, future=True, pool_pre_ping=True)
+        # psycopg3：同一连接上的语句默认执行 5 次后才服务端 prepare；热路径查询固定，直接从首次就 prepare
+        # 走 pgbouncer（transaction 模式）时把 PG_PREPARE_THRESHOLD 设为空以关闭
+        connect_args: dict[str, object] = {}
+        if url.startswith("postgresql+psycopg:"):
+            threshold = os.getenv("PG_PREPARE_THRESHOLD", "0").strip()
+            connect_args["prepare_threshold"] = int(threshold) if threshold else None
+        # 显式指定 psycopg2 驱动时：它的 executemany 是逐行执行，改为多行 VALUES / execute_batch 分页发送
+        # （psycopg3 的 executemany 本身走 pipeline，不需要）
+        driver_kwargs: dict[str, Any] = {}
+        if url.startswith("postgresql+psycopg2:"):
+            driver_kwargs = {
+                "executemany_mode": "values_plus_batch",
+                "executemany_batch_page_size": 500,
+                "insertmanyvalues_page_size": 1000,
+            }
+
+        # Postgres：按钮回调等并发场景下默认 QueuePool(5+10) 偏小；定期回收连接，避免被服务端/中间件悄悄断开
+        # 有 pool_recycle 兜底时默认不做 pre_ping（省掉每次 checkout 的一次往返）；库会重启/切主的环境可打开
+        return create_engine(
+            url,
+            future=True,
+            query_cache_size=_QUERY_CACHE_SIZE,
+            connect_args=connect_args,
+            pool_pre_ping=os.getenv("PG_POOL_PRE_PING", "0") == "1",
+            pool_size=int(os.getenv("PG_POOL_SIZE", "20")),
+            max_overflow=int(os.getenv("PG_MAX_OVERFLOW", "40")),
+            pool_recycle=int(os.getenv("PG_POOL_RECYCLE", "1800")),
+            pool_use_lifo=True,
+            **driver_kwargs,
+        )
 
-    # --- schema ---
-    def init_db(self) -> None:
-        dialect = self.engine.dialect.name
-        with self.engine.begin() as conn:
-            if dialect == "postgresql":
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS users (
-                          user_id BIGINT PRIMARY KEY,
-                          username TEXT,
-                          first_name TEXT,
-                          last_name TEXT,
-                          updated_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS chats (
-                          chat_id BIGINT PRIMARY KEY,
-                          title TEXT,
-                          chat_type TEXT NOT NULL,
-                          updated_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS sessions (
-                          id BIGSERIAL PRIMARY KEY,
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          session_day TEXT,
-                          check_in TIMESTAMPTZ NOT NULL,
-                          check_out TIMESTAMPTZ
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_sessions_chat_checkin ON sessions(chat_id, check_in);"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_sessions_chat_day ON sessions(chat_id, session_day);"))
-                # 迁移：旧版本使用“每人仅允许一条未签退记录”，会导致跨业务日无法再 /zao
-                conn.execute(text("DROP INDEX IF EXISTS idx_open_session;"))
-                # 新口径：每人每天（业务日）只允许一条 session；允许跨天存在历史未签退记录
-                conn.execute(
-                    text(
-                        """
-                        CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_day
-                        ON sessions(chat_id, user_id, session_day);
-                        """
-                    )
-                )
-            else:
-                # sqlite / others
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS users (
-                          user_id INTEGER PRIMARY KEY,
-                          username TEXT,
-                          first_name TEXT,
-                          last_name TEXT,
-                          updated_at TEXT NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS chats (
-                          chat_id INTEGER PRIMARY KEY,
-                          title TEXT,
-                          chat_type TEXT NOT NULL,
-                          updated_at TEXT NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS sessions (
-                          id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          chat_id INTEGER NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          session_day TEXT,
-                          check_in TEXT NOT NULL,
-                          check_out TEXT,
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
-                # 迁移：移除旧的“唯一未签退”索引，改为“每日唯一 session”
-                conn.execute(text("DROP INDEX IF EXISTS idx_open_session;"))
-                conn.execute(
-                    text(
-                        """
-                        CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_day
-                        ON sessions(chat_id, user_id, session_day);
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_sessions_chat_checkin ON sessions(chat_id, check_in);"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_sessions_chat_day ON sessions(chat_id, session_day);"))
+    # --- maintenance ---
+    def _sqlite_pragma(self, sql: str) -> None:
+        # checkpoint/optimize 不能放在事务里跑：用一条临时的 AUTOCOMMIT 连接（不触发 BEGIN IMMEDIATE）
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql(sql).fetchall()
 
-                # 旧库迁移：回填 session_day
-                cols = [r[1] for r in conn.execute(text("PRAGMA table_info(sessions);")).fetchall()]
-                if "session_day" not in cols:
-                    conn.execute(text("ALTER TABLE sessions ADD COLUMN session_day TEXT;"))
-                rows = conn.execute(
-                    text("SELECT id, check_in FROM sessions WHERE session_day IS NULL OR session_day='';")
-                ).fetchall()
-                for sid, check_in_s in rows:
-                    try:
-                        dt = datetime.fromisoformat(str(check_in_s))
-                        sday = business_day_key(dt, cutoff_hour=4)
-                    except Exception:
-                        sday = None
-                    if sday:
-                        conn.execute(text("UPDATE sessions SET session_day=:d WHERE id=:id;"), {"d": sday, "id": int(sid)})
-
-            # achievements schema (same for sqlite/pg, types differ but acceptable)
-            if dialect == "postgresql":
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS daily_earliest (
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          day TEXT NOT NULL,
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          session_id BIGINT NOT NULL REFERENCES sessions(id),
-                          check_in TIMESTAMPTZ NOT NULL,
-                          created_at TIMESTAMPTZ NOT NULL,
-                          PRIMARY KEY(chat_id, day)
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS streaks (
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          key TEXT NOT NULL,
-                          last_day TEXT NOT NULL,
-                          streak INTEGER NOT NULL,
-                          updated_at TIMESTAMPTZ NOT NULL,
-                          PRIMARY KEY(chat_id, user_id, key)
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS achievement_events (
-                          id BIGSERIAL PRIMARY KEY,
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          key TEXT NOT NULL,
-                          day TEXT,
-                          session_id BIGINT REFERENCES sessions(id),
-                          created_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS achievement_stats (
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          key TEXT NOT NULL,
-                          count INTEGER NOT NULL,
-                          last_awarded_at TIMESTAMPTZ NOT NULL,
-                          PRIMARY KEY(chat_id, user_id, key)
-                        );
-                        """
-                    )
-                )
-            else:
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS daily_earliest (
-                          chat_id INTEGER NOT NULL,
-                          day TEXT NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          session_id INTEGER NOT NULL,
-                          check_in TEXT NOT NULL,
-                          created_at TEXT NOT NULL,
-                          PRIMARY KEY(chat_id, day),
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id),
-                          FOREIGN KEY(session_id) REFERENCES sessions(id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS streaks (
-                          chat_id INTEGER NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          key TEXT NOT NULL,
-                          last_day TEXT NOT NULL,
-                          streak INTEGER NOT NULL,
-                          updated_at TEXT NOT NULL,
-                          PRIMARY KEY(chat_id, user_id, key),
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS achievement_events (
-                          id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          chat_id INTEGER NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          key TEXT NOT NULL,
-                          day TEXT,
-                          session_id INTEGER,
-                          created_at TEXT NOT NULL,
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id),
-                          FOREIGN KEY(session_id) REFERENCES sessions(id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS achievement_stats (
-                          chat_id INTEGER NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          key TEXT NOT NULL,
-                          count INTEGER NOT NULL,
-                          last_awarded_at TEXT NOT NULL,
-                          PRIMARY KEY(chat_id, user_id, key),
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
+    def wal_checkpoint(self) -> None:
+        # PASSIVE：不等读写方，能搬多少搬多少；/zao 等写入不会被卡住（Postgres 无需处理）
+        if self._dialect == "sqlite":
+            self._sqlite_pragma("PRAGMA wal_checkpoint(PASSIVE);")
 
-            # russian roulette tables
-            if dialect == "postgresql":
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS russian_roulette (
-                          chat_id BIGINT PRIMARY KEY REFERENCES chats(chat_id),
-                          chambers INT NOT NULL,
-                          bullet_position INT NOT NULL,
-                          current_position INT NOT NULL,
-                          created_by BIGINT NOT NULL REFERENCES users(user_id),
-                          created_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS roulette_attempts (
-                          id BIGSERIAL PRIMARY KEY,
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          position INT NOT NULL,
-                          result TEXT NOT NULL,
-                          created_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_roulette_attempts ON roulette_attempts(chat_id, created_at);"))
-            else:
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS russian_roulette (
-                          chat_id INTEGER PRIMARY KEY,
-                          chambers INTEGER NOT NULL,
-                          bullet_position INTEGER NOT NULL,
-                          current_position INTEGER NOT NULL,
-                          created_by INTEGER NOT NULL,
-                          created_at TEXT NOT NULL,
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(created_by) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS roulette_attempts (
-                          id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          chat_id INTEGER NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          position INTEGER NOT NULL,
-                          result TEXT NOT NULL,
-                          created_at TEXT NOT NULL,
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_roulette_attempts ON roulette_attempts(chat_id, created_at);"))
+    def optimize(self) -> None:
+        # 只对统计信息过期的表重新 ANALYZE，开销很小
+        if self._dialect == "sqlite":
+            self._sqlite_pragma("PRAGMA optimize;")
 
-            # wake reminders tables
-            if dialect == "postgresql":
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS wake_reminders (
-                          id BIGSERIAL PRIMARY KEY,
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          user_id BIGINT NOT NULL REFERENCES users(user_id),
-                          wake_time TEXT NOT NULL,
-                          next_trigger TIMESTAMPTZ NOT NULL,
-                          repeat BOOLEAN DEFAULT false,
-                          enabled BOOLEAN DEFAULT true,
-                          created_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_wake_next_trigger ON wake_reminders(next_trigger, enabled);"))
-            else:
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS wake_reminders (
-                          id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          chat_id INTEGER NOT NULL,
-                          user_id INTEGER NOT NULL,
-                          wake_time TEXT NOT NULL,
-                          next_trigger TEXT NOT NULL,
-                          repeat INTEGER DEFAULT 0,
-                          enabled INTEGER DEFAULT 1,
-                          created_at TEXT NOT NULL,
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(user_id) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_wake_next_trigger ON wake_reminders(next_trigger, enabled);"))
+    # --- schema ---
+    def _schema_version(self) -> int | None:
+        """当前库记录的 schema 版本；还没有 schema_version 表（新库/旧库）时返回 None。"""
+        if self._dialect == "postgresql":
+            probe = text("SELECT to_regclass('schema_version') IS NOT NULL;")
+        else:
+            probe = text("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_version');")
+        with self.engine.connect() as conn:
+            if not conn.execute(probe).scalar():
+                return None
+            return conn.execute(text("SELECT version FROM schema_version WHERE id=1;")).scalar()
 
-            # rock paper scissors tables
-            if dialect == "postgresql":
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS rsp_games (
-                          id BIGSERIAL PRIMARY KEY,
-                          chat_id BIGINT NOT NULL REFERENCES chats(chat_id),
-                          challenger_id BIGINT NOT NULL REFERENCES users(user_id),
-                          opponent_id BIGINT NOT NULL REFERENCES users(user_id),
-                          challenger_choice TEXT,
-                          opponent_choice TEXT,
-                          status TEXT NOT NULL,
-                          winner_id BIGINT REFERENCES users(user_id),
-                          message_id BIGINT,
-                          created_at TIMESTAMPTZ NOT NULL
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_rsp_pending ON rsp_games(chat_id, status);"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_rsp_stats ON rsp_games(chat_id, challenger_id, opponent_id, status);"))
+    def init_db(self) -> None:
+        if self._schema_version() == _SCHEMA_VERSION:
+            return
+        pg = self._dialect == "postgresql"
+        with self.engine.begin() as conn:
+            for stmt in _PG_TABLES if pg else _SQLITE_TABLES:
+                conn.execute(stmt)
+            # 迁移：旧版本使用“每人仅允许一条未签退记录”，会导致跨业务日无法再 /zao；
+            # 新口径（idx_sessions_user_day）：每人每天（业务日）只允许一条 session，允许跨天存在历史未签退记录
+            conn.execute(text("DROP INDEX IF EXISTS idx_open_session;"))
+            if pg:
+                self._migrate_pg(conn)
             else:
-                conn.execute(
-                    text(
-                        """
-                        CREATE TABLE IF NOT EXISTS rsp_games (
-                          id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          chat_id INTEGER NOT NULL,
-                          challenger_id INTEGER NOT NULL,
-                          opponent_id INTEGER NOT NULL,
-                          challenger_choice TEXT,
-                          opponent_choice TEXT,
-                          status TEXT NOT NULL,
-                          winner_id INTEGER,
-                          message_id INTEGER,
-                          created_at TEXT NOT NULL,
-                          FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
-                          FOREIGN KEY(challenger_id) REFERENCES users(user_id),
-                          FOREIGN KEY(opponent_id) REFERENCES users(user_id),
-                          FOREIGN KEY(winner_id) REFERENCES users(user_id)
-                        );
-                        """
-                    )
-                )
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_rsp_pending ON rsp_games(chat_id, status);"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS idx_rsp_stats ON rsp_games(chat_id, challenger_id, opponent_id, status);"))
-
-                # 迁移：添加 winner_id 列（如果不存在）
-                cols = [r[1] for r in conn.execute(text("PRAGMA table_info(rsp_games);")).fetchall()]
-                if "winner_id" not in cols:
-                    conn.execute(text("ALTER TABLE rsp_games ADD COLUMN winner_id INTEGER REFERENCES users(user_id);"))
-
-            # partial unique indexes
-            conn.execute(
-                text(
-                    """
-                    CREATE UNIQUE INDEX IF NOT EXISTS idx_ae_daily_unique
-                    ON achievement_events(chat_id, key, day)
-                    WHERE key='daily_earliest';
-                    """
-                )
+                self._migrate_sqlite(conn)
+
+            # 旧数据回填当日签到名次
+            conn.execute(_SQL_BACKFILL_DAILY_RANK)
+            # 跨群成就汇总表：新表/旧库升级时按已有的分群计数重算
+            conn.execute(_SQL_BACKFILL_ACHIEVEMENT_STATS_GLOBAL)
+
+            # 索引放在列迁移之后建（旧库的 session_day / completed_at 等列此时才保证存在）
+            for stmt in _PG_INDEXES if pg else _SQLITE_INDEXES:
+                conn.execute(stmt)
+
+            conn.execute(_SQL_SCHEMA_VERSION_TABLE)
+            conn.execute(_SQL_SET_SCHEMA_VERSION, {"v": _SCHEMA_VERSION})
+
+    @staticmethod
+    def _migrate_pg(conn: Connection) -> None:
+        # 签退时写入时长（秒），榜单直接 SUM，不再逐行 EXTRACT；旧数据一次性回填
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN IF NOT EXISTS duration_sec BIGINT;"))
+        conn.execute(
+            text(
+                """
+                UPDATE sessions
+                SET duration_sec = EXTRACT(EPOCH FROM (check_out - check_in))::bigint
+                WHERE check_out IS NOT NULL AND duration_sec IS NULL;
+                """
             )
-            conn.execute(
-                text(
-                    """
-                    CREATE UNIQUE INDEX IF NOT EXISTS idx_ae_streak7_unique
-                    ON achievement_events(chat_id, user_id, key, day)
-                    WHERE key='streak_earliest_7';
-                    """
-                )
+        )
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN IF NOT EXISTS daily_rank INTEGER;"))
+
+        # 迁移：旧版本用 status 文本列（'pending'/'completed'），改为 completed_at（NULL 即进行中）
+        conn.execute(text("ALTER TABLE rsp_games ADD COLUMN IF NOT EXISTS completed_at TIMESTAMPTZ;"))
+        has_status = conn.execute(
+            text("SELECT 1 FROM information_schema.columns WHERE table_name='rsp_games' AND column_name='status';")
+        ).fetchone()
+        if has_status:
+            # 旧数据没有结束时间，用创建时间近似
+            conn.execute(text("UPDATE rsp_games SET completed_at=created_at WHERE status='completed' AND completed_at IS NULL;"))
+            conn.execute(text("DROP INDEX IF EXISTS idx_rsp_pending;"))
+            conn.execute(text("DROP INDEX IF EXISTS idx_rsp_stats;"))
+            conn.execute(text("ALTER TABLE rsp_games DROP COLUMN status;"))
+
+    @staticmethod
+    def _migrate_sqlite(conn: Connection) -> None:
+        # 旧库迁移：回填 session_day
+        cols = [r[1] for r in conn.execute(text("PRAGMA table_info(sessions);")).fetchall()]
+        if "session_day" not in cols:
+            conn.execute(text("ALTER TABLE sessions ADD COLUMN session_day TEXT;"))
+        # check_in 存的是带时区偏移的 isoformat（本地墙钟时间在前 19 位），
+        # 业务日 = 墙钟时间减去 cutoff（4 点）后的日期，与 business_day_key 一致；一条 UPDATE 完成回填
+        conn.execute(
+            text(
+                """
+                UPDATE sessions
+                SET session_day = date(substr(check_in, 1, 19), '-4 hours')
+                WHERE (session_day IS NULL OR session_day='')
+                  AND date(substr(check_in, 1, 19), '-4 hours') IS NOT NULL;
+                """
             )
-            conn.execute(
-                text(
-                    """
-                    CREATE UNIQUE INDEX IF NOT EXISTS idx_ae_session_unique
-                    ON achievement_events(chat_id, user_id, key, session_id)
-                    WHERE key IN ('ontime_8h','longday_12h');
-                    """
-                )
+        )
+
+        # 签退时写入时长（秒），榜单直接 SUM；旧数据一次性回填
+        if "duration_sec" not in cols:
+            conn.execute(text("ALTER TABLE sessions ADD COLUMN duration_sec INTEGER;"))
+        conn.execute(
+            text(
+                f"""
+                UPDATE sessions
+                SET duration_sec = {_sqlite_seconds_between("check_in", "check_out")}
+                WHERE check_out IS NOT NULL AND duration_sec IS NULL;
+                """
             )
+        )
+        if "daily_rank" not in cols:
+            conn.execute(text("ALTER TABLE sessions ADD COLUMN daily_rank INTEGER;"))
+
+        # 迁移：添加 winner_id 列（如果不存在）
+        cols = [r[1] for r in conn.execute(text("PRAGMA table_info(rsp_games);")).fetchall()]
+        if "winner_id" not in cols:
+            conn.execute(text("ALTER TABLE rsp_games ADD COLUMN winner_id INTEGER REFERENCES users(user_id);"))
+        # 迁移：status 文本列改为 completed_at（NULL 即进行中）；DROP COLUMN 需要 SQLite 3.35+
+        if "completed_at" not in cols:
+            conn.execute(text("ALTER TABLE rsp_games ADD COLUMN completed_at TEXT;"))
+        if "status" in cols:
+            conn.execute(text("UPDATE rsp_games SET completed_at=created_at WHERE status='completed' AND completed_at IS NULL;"))
+            conn.execute(text("DROP INDEX IF EXISTS idx_rsp_pending;"))
+            conn.execute(text("DROP INDEX IF EXISTS idx_rsp_stats;"))
+            conn.execute(text("ALTER TABLE rsp_games DROP COLUMN status;"))
 
     # --- users/chats ---
     def upsert_user_and_chat(
@@ -524,365 +1169,307 @@ class SQLAlchemyStorage(Storage):
         chat_type: str,
         updated_at: datetime,
     ) -> None:
-        dialect = self.engine.dialect.name
-        if dialect != "postgresql":
-            updated_at_val: Any = updated_at.isoformat()
-        else:
-            updated_at_val = updated_at
-        with self.engine.begin() as conn:
-            if dialect == "postgresql":
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO users(user_id, username, first_name, last_name, updated_at)
-                        VALUES(:uid,:un,:fn,:ln,:ua)
-                        ON CONFLICT (user_id) DO UPDATE SET
-                          username=EXCLUDED.username,
-                          first_name=EXCLUDED.first_name,
-                          last_name=EXCLUDED.last_name,
-                          updated_at=EXCLUDED.updated_at;
-                        """
-                    ),
-                    {"uid": user_id, "un": username, "fn": first_name, "ln": last_name, "ua": updated_at_val},
-                )
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO chats(chat_id, title, chat_type, updated_at)
-                        VALUES(:cid,:t,:ct,:ua)
-                        ON CONFLICT (chat_id) DO UPDATE SET
-                          title=EXCLUDED.title,
-                          chat_type=EXCLUDED.chat_type,
-                          updated_at=EXCLUDED.updated_at;
-                        """
-                    ),
-                    {"cid": chat_id, "t": chat_title, "ct": chat_type, "ua": updated_at_val},
-                )
-            else:
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO users(user_id, username, first_name, last_name, updated_at)
-                        VALUES(:uid,:un,:fn,:ln,:ua)
-                        ON CONFLICT(user_id) DO UPDATE SET
-                          username=excluded.username,
-                          first_name=excluded.first_name,
-                          last_name=excluded.last_name,
-                          updated_at=excluded.updated_at;
-                        """
-                    ),
-                    {"uid": user_id, "un": username, "fn": first_name, "ln": last_name, "ua": updated_at_val},
-                )
+        if self._dialect == "postgresql":
+            with self.engine.begin() as conn:
                 conn.execute(
-                    text(
-                        """
-                        INSERT INTO chats(chat_id, title, chat_type, updated_at)
-                        VALUES(:cid,:t,:ct,:ua)
-                        ON CONFLICT(chat_id) DO UPDATE SET
-                          title=excluded.title,
-                          chat_type=excluded.chat_type,
-                          updated_at=excluded.updated_at;
-                        """
-                    ),
-                    {"cid": chat_id, "t": chat_title, "ct": chat_type, "ua": updated_at_val},
+                    _SQL_UPSERT_USER_AND_CHAT_PG,
+                    {
+                        "uid": user_id,
+                        "un": username,
+                        "fn": first_name,
+                        "ln": last_name,
+                        "cid": chat_id,
+                        "t": chat_title,
+                        "ct": chat_type,
+                        "ua": updated_at,
+                    },
                 )
+            return
+        # SQLite 不支持 CTE 里写 INSERT；嵌入式库没有网络往返，两条语句放在同一事务里即可
+        updated_at_val = updated_at.isoformat()
+        with self.engine.begin() as conn:
+            conn.execute(
+                _SQL_UPSERT_USER,
+                {"uid": user_id, "un": username, "fn": first_name, "ln": last_name, "ua": updated_at_val},
+            )
+            conn.execute(
+                _SQL_UPSERT_CHAT,
+                {"cid": chat_id, "t": chat_title, "ct": chat_type, "ua": updated_at_val},
+            )
 
     # --- sessions ---
     def get_open_session(self, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None:
-        with self.engine.connect() as conn:
-            r = conn.execute(
-                text(
-                    """
-                    SELECT id, check_in
-                    FROM sessions
-                    WHERE chat_id=:cid AND user_id=:uid AND check_out IS NULL
-                      AND (:day IS NULL OR session_day = :day)
-                    ORDER BY id DESC
-                    LIMIT 1;
-                    """
-                ),
-                {"cid": chat_id, "uid": user_id, "day": day},
-            ).fetchone()
+        with self._reader() as conn:
+            if day is not None:
+                r = conn.execute(_SQL_OPEN_SESSION_DAY, {"cid": chat_id, "uid": user_id, "day": day}).fetchone()
+            else:
+                r = conn.execute(_SQL_OPEN_SESSION_ANY, {"cid": chat_id, "uid": user_id}).fetchone()
         if not r:
             return None
         check_in_dt = self._parse_dt(r[1])
         return OpenSession(session_id=int(r[0]), check_in=check_in_dt)
 
+    def _lock_checkin_rank(self, conn: Connection, chat_id: int, day: str) -> None:
+        if self._dialect == "postgresql":
+            conn.execute(_SQL_CHECKIN_RANK_LOCK_PG, {"cid": chat_id, "day": day})
+
     def check_in(self, *, chat_id: int, user_id: int, ts: datetime) -> bool:
-        dialect = self.engine.dialect.name
         session_day = business_day_key(ts, cutoff_hour=4)
-        check_in_val: Any = ts if dialect == "postgresql" else ts.isoformat()
-        try:
-            with self.engine.begin() as conn:
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO sessions(chat_id, user_id, session_day, check_in, check_out)
-                        VALUES(:cid,:uid,:day,:ci,NULL);
-                        """
-                    ),
-                    {"cid": chat_id, "uid": user_id, "day": session_day, "ci": check_in_val},
+        check_in_val: Any = self._dt(ts)
+        with self.engine.begin() as conn:
+            self._lock_checkin_rank(conn, chat_id, session_day)
+            r = conn.execute(
+                _SQL_CHECK_IN,
+                {"cid": chat_id, "uid": user_id, "day": session_day, "ci": check_in_val},
+            ).fetchone()
+        return r is not None
+
+    def record_checkin(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        ts: datetime,
+        created_at: datetime,
+        earliest_key: str,
+        streak_key: str,
+        streak_award_key: str,
+        streak_award_every: int = 7,
+    ) -> CheckInRecord | None:
+        # 签到 + 名次 + 今日最早及其成就放进同一个事务：一次提交（SQLite 一次刷盘），不再是 4~6 个各自提交的调用
+        # 名次即插入时算好的 daily_rank；不是今日最早时 daily_earliest 冲突即止，后面的成就语句都不会执行
+        session_day = business_day_key(ts, cutoff_hour=4)
+        ci_val: Any = self._dt(ts)
+        ca_val: Any = self._dt(created_at)
+        unlocked: list[str] = []
+        earliest_streak: int | None = None
+        with self.engine.begin() as conn:
+            self._lock_checkin_rank(conn, chat_id, session_day)
+            row = conn.execute(
+                _SQL_CHECK_IN,
+                {"cid": chat_id, "uid": user_id, "day": session_day, "ci": ci_val},
+            ).fetchone()
+            if row is None:
+                return None
+            session_id, position = int(row[0]), int(row[1] or 1)
+            earliest = conn.execute(
+                _SQL_INSERT_DAILY_EARLIEST,
+                {"cid": chat_id, "d": session_day, "uid": user_id, "sid": session_id, "ci": ci_val, "ca": ca_val},
+            ).fetchone()
+            if earliest is not None:
+                award = {"cid": chat_id, "uid": user_id, "d": session_day, "sid": None, "ca": ca_val}
+                if self._award(conn, {**award, "k": earliest_key}):
+                    unlocked.append(earliest_key)
+                earliest_streak = self._bump_streak(
+                    conn, chat_id=chat_id, user_id=user_id, key=streak_key, day=session_day, ca_val=ca_val
                 )
-            return True
-        except IntegrityError:
-            # 失败的典型原因：同一业务日重复签到（idx_sessions_user_day）
-            return False
+                if earliest_streak % streak_award_every == 0 and self._award(conn, {**award, "k": streak_award_key}):
+                    unlocked.append(streak_award_key)
+        return CheckInRecord(session_id=session_id, position=position, unlocked=unlocked, earliest_streak=earliest_streak)
+
+    def bulk_insert_sessions(self, *, sessions: list[tuple[int, int, datetime, datetime | None]]) -> None:
+        """
+        批量导入历史 session：每项为 (chat_id, user_id, check_in, check_out)，check_out 可为 None（未签退）。
+        session_day / duration_sec 与 check_in/check_out 同口径计算；同一业务日已有 session 的行跳过。
+        导入行的 daily_rank 在同一批事务里按 (check_in, id) 补齐，之后的签到 MAX+1 不会和它们撞号。
+        users/chats 需先写入（外键）。
+        """
+        dt = self._dt
+        params: list[dict[str, Any]] = []
+        for chat_id, user_id, check_in, check_out in sessions:
+            if check_out is not None and check_out < check_in:
+                check_out = check_in
+            params.append(
+                {
+                    "cid": chat_id,
+                    "uid": user_id,
+                    "day": business_day_key(check_in, cutoff_hour=4),
+                    "ci": dt(check_in),
+                    "co": dt(check_out) if check_out is not None else None,
+                    "dur": int((check_out - check_in).total_seconds()) if check_out is not None else None,
+                }
+            )
+        batch = _SESSION_IMPORT_BATCH.get(self._dialect, 1_000)
+        for i in range(0, len(params), batch):
+            with self.engine.begin() as conn:
+                conn.execute(_SQL_IMPORT_SESSION, params[i : i + batch])
+                conn.execute(_SQL_BACKFILL_DAILY_RANK)
 
     def check_out(self, *, chat_id: int, user_id: int, ts: datetime) -> tuple[bool, timedelta | None, datetime | None, int | None]:
         # 只允许签退“当前业务日”的 open session，避免跨日续接旧 /zao
         day = business_day_key(ts, cutoff_hour=4)
-        osess = self.get_open_session(chat_id=chat_id, user_id=user_id, day=day)
-        if not osess:
+        if self._dialect == "postgresql":
+            stmt, co_val = _SQL_CHECK_OUT_PG, ts
+        else:
+            stmt, co_val = _SQL_CHECK_OUT_SQLITE, ts.isoformat()
+        with self.engine.begin() as conn:
+            r = conn.execute(stmt, {"co": co_val, "cid": chat_id, "uid": user_id, "d": day}).fetchone()
+        if not r:
             return False, None, None, None
-        check_in_ts = osess.check_in
+        check_in_ts = self._parse_dt(r[1])
+        # 与 SQL 中的夹取一致
         if ts < check_in_ts:
             ts = check_in_ts
-        dialect = self.engine.dialect.name
-        check_out_val: Any = ts if dialect == "postgresql" else ts.isoformat()
-        with self.engine.begin() as conn:
-            conn.execute(text("UPDATE sessions SET check_out=:co WHERE id=:id;"), {"co": check_out_val, "id": osess.session_id})
-        return True, ts - check_in_ts, check_in_ts, osess.session_id
+        return True, ts - check_in_ts, check_in_ts, int(r[0])
 
-    def session_today_exists(self, *, chat_id: int, user_id: int, day: str) -> bool:
-        with self.engine.connect() as conn:
+    def session_today_status(self, *, chat_id: int, user_id: int, day: str) -> tuple[bool, bool]:
+        with self._reader() as conn:
             r = conn.execute(
-                text("SELECT 1 FROM sessions WHERE chat_id=:cid AND user_id=:uid AND session_day=:d LIMIT 1;"),
+                _SQL_SESSION_DAY_STATUS,
                 {"cid": chat_id, "uid": user_id, "d": day},
             ).fetchone()
-        return r is not None
+        return bool(r and r[0]), bool(r and r[1])
+
+    def session_today_exists(self, *, chat_id: int, user_id: int, day: str) -> bool:
+        return self.session_today_status(chat_id=chat_id, user_id=user_id, day=day)[0]
 
     def session_today_completed(self, *, chat_id: int, user_id: int, day: str) -> bool:
-        with self.engine.connect() as conn:
-            r = conn.execute(
-                text(
-                    "SELECT 1 FROM sessions WHERE chat_id=:cid AND user_id=:uid AND session_day=:d AND check_out IS NOT NULL LIMIT 1;"
-                ),
-                {"cid": chat_id, "uid": user_id, "d": day},
-            ).fetchone()
-        return r is not None
+        return self.session_today_status(chat_id=chat_id, user_id=user_id, day=day)[1]
 
     def today_checkin_position(self, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
-        dialect = self.engine.dialect.name
-        ci_val: Any = check_in if dialect == "postgresql" else check_in.isoformat()
-        with self.engine.connect() as conn:
-            r = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(1) AS n
-                    FROM sessions
-                    WHERE chat_id=:cid
-                      AND session_day=:d
-                      AND (check_in < :ci OR (check_in=:ci AND id <= :id));
-                    """
-                ),
-                {"cid": chat_id, "d": day, "ci": ci_val, "id": session_id},
-            ).fetchone()
+        with self._reader() as conn:
+            r = conn.execute(_SQL_CHECKIN_POSITION, {"id": session_id}).fetchone()
         n = int(r[0]) if r else 0
         return n if n > 0 else 1
 
     def get_user_checkin_days(self, *, user_id: int, start_date: str, end_date: str) -> set[str]:
-        with self.engine.connect() as conn:
-            rows = conn.execute(
-                text(
-                    """
-                    SELECT DISTINCT session_day
-                    FROM sessions
-                    WHERE user_id=:uid
-                      AND session_day IS NOT NULL
-                      AND session_day BETWEEN :start AND :end
-                    ORDER BY session_day;
-                    """
-                ),
+        # 结果直接装进 set：不需要 ORDER BY；BETWEEN 已排除 NULL/空串
+        with self._reader() as conn:
+            days = conn.execute(
+                _SQL_USER_CHECKIN_DAYS,
                 {"uid": user_id, "start": start_date, "end": end_date},
-            ).fetchall()
-        return {str(r[0]) for r in rows if r[0]}
+            ).scalars()
+            return set(days)
 
     # --- leaderboard ---
-    def leaderboard(self, *, chat_id: int, mode: str, now: datetime) -> list[tuple[int, str, int]]:
-        dialect = self.engine.dialect.name
-        if dialect == "postgresql":
-            if mode == "today":
-                params: dict[str, Any] = {"now": now, "cid": chat_id, "d": business_day_key(now, cutoff_hour=4)}
-                where = "AND s.session_day = :d"
-                seconds_expr = "EXTRACT(EPOCH FROM (COALESCE(s.check_out, :now) - s.check_in))"
-                extra_where = ""
-            else:
-                # 总榜：不把历史未签退记录按 now 无限累加（仅统计已签退的 session）
-                params = {"cid": chat_id}
-                where = ""
-                seconds_expr = "EXTRACT(EPOCH FROM (s.check_out - s.check_in))"
-                extra_where = "AND s.check_out IS NOT NULL"
-            with self.engine.connect() as conn:
-                rows = conn.execute(
-                    text(
-                        f"""
-                        SELECT
-                          u.user_id AS user_id,
-                          COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
-                          SUM({seconds_expr})::bigint AS seconds
-                        FROM sessions s
-                        JOIN users u ON u.user_id = s.user_id
-                        WHERE s.chat_id = :cid
-                        {extra_where}
-                        {where}
-                        GROUP BY u.user_id
-                        ORDER BY seconds DESC;
-                        """
-                    ),
-                    params,
-                ).fetchall()
+    def _build_leaderboard_sql(self, *, scoped: bool, today: bool, with_open: bool) -> TextClause:
+        """
+        拼出一种榜单 SQL：scoped=本群（:cid）/全局，today=今日（:d、:now）/总榜，with_open=是否带 is_open（:od）。
+        组合只有 8 种，构造时按方言全部建好（见 __post_init__）。
+        先在 sessions 上聚合并取前 :lim 名（带 LIMIT 的 ORDER BY 只保留前 N 行，不做全量排序），
+        再只给这 N 个人关联 users、判断 is_open。
+        """
+        conds = ["s.chat_id = :cid"] if scoped else []
+        open_scope = "AND o.chat_id = :cid" if scoped else ""
+        # 已签退的 session 直接累加 duration_sec；今日榜里未签退的按 now 现算
+        if self._dialect == "postgresql":
+            running_expr = "EXTRACT(EPOCH FROM (:now - s.check_in))::bigint"
+            sum_cast = "::bigint"
+            # LIMIT NULL 即不限
+            limit_expr = ":lim"
         else:
-            if mode == "today":
-                now_val = now.isoformat()
-                params2: dict[str, Any] = {"now": now_val, "cid": chat_id, "d": business_day_key(now, cutoff_hour=4)}
-                where2 = "AND s.session_day = :d"
-                seconds_expr2 = """
-                          SUM(
-                            CASE
-                              WHEN s.check_out IS NULL THEN
-                                CAST((julianday(:now) - julianday(s.check_in)) * 86400 AS INTEGER)
-                              ELSE
-                                CAST((julianday(s.check_out) - julianday(s.check_in)) * 86400 AS INTEGER)
-                            END
-                          ) AS seconds
-                """
-                extra_where2 = ""
-            else:
-                # 总榜：仅统计已签退的 session，避免未签退记录无限增长
-                params2 = {"cid": chat_id}
-                where2 = ""
-                seconds_expr2 = "SUM(CAST((julianday(s.check_out) - julianday(s.check_in)) * 86400 AS INTEGER)) AS seconds"
-                extra_where2 = "AND s.check_out IS NOT NULL"
-            with self.engine.connect() as conn:
-                rows = conn.execute(
-                    text(
-                        f"""
-                        SELECT
-                          u.user_id AS user_id,
-                          COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-                          {seconds_expr2}
-                        FROM sessions s
-                        JOIN users u ON u.user_id = s.user_id
-                        WHERE s.chat_id = :cid
-                        {extra_where2}
-                        {where2}
-                        GROUP BY u.user_id
-                        ORDER BY seconds DESC;
-                        """
-                    ),
-                    params2,
-                ).fetchall()
-        out: list[tuple[int, str, int]] = []
-        for r in rows:
-            out.append((int(r[0]), _display_name(r[1], int(r[0])), int(r[2] or 0)))
-        return out
-
-    def leaderboard_global(self, *, mode: str, now: datetime) -> list[tuple[int, str, int]]:
-        dialect = self.engine.dialect.name
-        if dialect == "postgresql":
-            if mode == "today":
-                params: dict[str, Any] = {"now": now, "d": business_day_key(now, cutoff_hour=4)}
-                where = "AND s.session_day = :d"
-                seconds_expr = "EXTRACT(EPOCH FROM (COALESCE(s.check_out, :now) - s.check_in))"
-                extra_where = ""
-            else:
-                params = {}
-                where = ""
-                seconds_expr = "EXTRACT(EPOCH FROM (s.check_out - s.check_in))"
-                extra_where = "AND s.check_out IS NOT NULL"
-            with self.engine.connect() as conn:
-                rows = conn.execute(
-                    text(
-                        f"""
-                        SELECT
-                          u.user_id AS user_id,
-                          COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
-                          SUM({seconds_expr})::bigint AS seconds
-                        FROM sessions s
-                        JOIN users u ON u.user_id = s.user_id
-                        WHERE 1=1
-                        {extra_where}
-                        {where}
-                        GROUP BY u.user_id
-                        ORDER BY seconds DESC;
-                        """
-                    ),
-                    params,
-                ).fetchall()
+            running_expr = _sqlite_seconds_between("s.check_in", ":now")
+            sum_cast = ""
+            # SQLite 的 LIMIT 不接受 NULL，负数表示不限
+            limit_expr = "COALESCE(:lim, -1)"
+        if today:
+            conds.append("s.session_day = :d")
+            seconds_expr = f"SUM(COALESCE(s.duration_sec, {running_expr})){sum_cast} AS seconds"
         else:
-            if mode == "today":
-                now_val = now.isoformat()
-                params2: dict[str, Any] = {"now": now_val, "d": business_day_key(now, cutoff_hour=4)}
-                where2 = "AND s.session_day = :d"
-                seconds_expr2 = """
-                          SUM(
-                            CASE
-                              WHEN s.check_out IS NULL THEN
-                                CAST((julianday(:now) - julianday(s.check_in)) * 86400 AS INTEGER)
-                              ELSE
-                                CAST((julianday(s.check_out) - julianday(s.check_in)) * 86400 AS INTEGER)
-                            END
-                          ) AS seconds
-                """
-                extra_where2 = ""
-            else:
-                params2 = {}
-                where2 = ""
-                seconds_expr2 = "SUM(CAST((julianday(s.check_out) - julianday(s.check_in)) * 86400 AS INTEGER)) AS seconds"
-                extra_where2 = "AND s.check_out IS NOT NULL"
-            with self.engine.connect() as conn:
-                rows = conn.execute(
-                    text(
-                        f"""
-                        SELECT
-                          u.user_id AS user_id,
-                          COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-                          {seconds_expr2}
-                        FROM sessions s
-                        JOIN users u ON u.user_id = s.user_id
-                        WHERE 1=1
-                        {extra_where2}
-                        {where2}
-                        GROUP BY u.user_id
-                        ORDER BY seconds DESC;
-                        """
-                    ),
-                    params2,
-                ).fetchall()
-        out: list[tuple[int, str, int]] = []
-        for r in rows:
-            out.append((int(r[0]), _display_name(r[1], int(r[0])), int(r[2] or 0)))
-        return out
+            # 总榜：仅统计已签退的 session（duration_sec 非空），避免历史未签退记录按 now 无限累加
+            conds.append("s.duration_sec IS NOT NULL")
+            seconds_expr = f"SUM(s.duration_sec){sum_cast} AS seconds"
+        open_expr = ""
+        if with_open:
+            open_expr = f""",
+                          EXISTS (
+                            SELECT 1 FROM sessions o
+                            WHERE o.user_id = r.user_id {open_scope}
+                              AND o.check_out IS NULL AND o.session_day = :od
+                          ) AS is_open"""
+        return text(
+            f"""
+            WITH ranked AS (
+              SELECT s.user_id AS user_id, {seconds_expr}
+              FROM sessions s
+              WHERE {" AND ".join(conds)}
+              GROUP BY s.user_id
+              ORDER BY seconds DESC
+              LIMIT {limit_expr}
+            )
+            SELECT
+              u.user_id AS user_id,
+              u.username, u.first_name, u.last_name,
+              r.seconds{open_expr}
+            FROM ranked r
+            JOIN users u ON u.user_id = r.user_id
+            ORDER BY r.seconds DESC;
+            """
+        )
+
+    def _leaderboard_rows(
+        self,
+        *,
+        chat_id: int | None,
+        mode: str,
+        now: datetime,
+        open_day: str | None = None,
+        limit: int | None = None,
+    ) -> list[tuple[int, str, int, bool]]:
+        """
+        榜单公共查询：chat_id=None 表示全局（跨群）。
+        open_day 非空时，在同一条 SQL 里顺带标记该业务日是否“未签退”（用于 🔥/💤）。
+        limit 为 None 时返回全部。
+        """
+        today = mode == "today"
+        params: dict[str, Any] = {"lim": limit}
+        if chat_id is not None:
+            params["cid"] = chat_id
+        if today:
+            params["now"] = self._dt(now)
+            params["d"] = business_day_key(now, cutoff_hour=4)
+        if open_day:
+            params["od"] = open_day
+        stmt = self._leaderboard_sql[(chat_id is not None, today, bool(open_day))]
+        with self._reader() as conn:
+            rows = conn.execute(stmt, params).fetchall()
+        if open_day:
+            return [
+                (uid, _display_name(uid, un, fn, ln), int(sec or 0), bool(is_open)) for uid, un, fn, ln, sec, is_open in rows
+            ]
+        return [(uid, _display_name(uid, un, fn, ln), int(sec or 0), False) for uid, un, fn, ln, sec in rows]
+
+    def leaderboard(self, *, chat_id: int, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
+        rows = self._leaderboard_rows(chat_id=chat_id, mode=mode, now=now, limit=limit)
+        return [(uid, name, sec) for uid, name, sec, _ in rows]
+
+    def leaderboard_global(self, *, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
+        rows = self._leaderboard_rows(chat_id=None, mode=mode, now=now, limit=limit)
+        return [(uid, name, sec) for uid, name, sec, _ in rows]
+
+    def leaderboard_with_open(
+        self, *, chat_id: int, mode: str, now: datetime, day: str, limit: int | None = None
+    ) -> list[tuple[int, str, int, bool]]:
+        return self._leaderboard_rows(chat_id=chat_id, mode=mode, now=now, open_day=day, limit=limit)
+
+    def leaderboard_global_with_open(
+        self, *, mode: str, now: datetime, day: str, limit: int | None = None
+    ) -> list[tuple[int, str, int, bool]]:
+        return self._leaderboard_rows(chat_id=None, mode=mode, now=now, open_day=day, limit=limit)
 
     def open_user_ids(self, *, chat_id: int, day: str | None = None) -> set[int]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             if day:
                 rows = conn.execute(
-                    text(
-                        """
-                        SELECT DISTINCT user_id
-                        FROM sessions
-                        WHERE chat_id=:cid AND check_out IS NULL AND session_day=:d;
-                        """
-                    ),
+                    _SQL_OPEN_USERS_DAY,
                     {"cid": chat_id, "d": day},
                 ).fetchall()
             else:
                 rows = conn.execute(
-                    text("SELECT DISTINCT user_id FROM sessions WHERE chat_id=:cid AND check_out IS NULL;"),
+                    _SQL_OPEN_USERS,
                     {"cid": chat_id},
                 ).fetchall()
         return {int(r[0]) for r in rows}
 
     def open_user_ids_global(self, day: str | None = None) -> set[int]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             if day:
                 rows = conn.execute(
-                    text("SELECT DISTINCT user_id FROM sessions WHERE check_out IS NULL AND session_day=:d;"),
+                    _SQL_OPEN_USERS_GLOBAL_DAY,
                     {"d": day},
                 ).fetchall()
             else:
-                rows = conn.execute(text("SELECT DISTINCT user_id FROM sessions WHERE check_out IS NULL;")).fetchall()
+                rows = conn.execute(_SQL_OPEN_USERS_GLOBAL).fetchall()
         return {int(r[0]) for r in rows}
 
     # --- achievements ---
@@ -896,81 +1483,44 @@ class SQLAlchemyStorage(Storage):
         check_in: datetime,
         created_at: datetime,
     ) -> bool:
-        dialect = self.engine.dialect.name
-        ci_val: Any = check_in if dialect == "postgresql" else check_in.isoformat()
-        ca_val: Any = created_at if dialect == "postgresql" else created_at.isoformat()
+        ci_val: Any = self._dt(check_in)
+        ca_val: Any = self._dt(created_at)
         try:
             with self.engine.begin() as conn:
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO daily_earliest(chat_id, day, user_id, session_id, check_in, created_at)
-                        VALUES(:cid,:d,:uid,:sid,:ci,:ca);
-                        """
-                    ),
+                row = conn.execute(
+                    _SQL_INSERT_DAILY_EARLIEST,
                     {"cid": chat_id, "d": day, "uid": user_id, "sid": session_id, "ci": ci_val, "ca": ca_val},
-                )
-            return True
+                ).fetchone()
+            return row is not None
         except IntegrityError:
+            # 外键等其它约束失败，与原来一样按“未写入”处理
             return False
 
     def update_streak(self, *, chat_id: int, user_id: int, key: str, day: str, created_at: datetime) -> int:
-        ca_val: Any = created_at if self.engine.dialect.name == "postgresql" else created_at.isoformat()
         with self.engine.begin() as conn:
-            row = conn.execute(
-                text("SELECT last_day, streak FROM streaks WHERE chat_id=:cid AND user_id=:uid AND key=:k;"),
-                {"cid": chat_id, "uid": user_id, "k": key},
-            ).fetchone()
-            if row:
-                last_day, prev = str(row[0]), int(row[1])
-                try:
-                    new_streak = prev + 1 if (date.fromisoformat(day) - date.fromisoformat(last_day)).days == 1 else 1
-                except Exception:
-                    new_streak = 1
-                conn.execute(
-                    text(
-                        """
-                        UPDATE streaks
-                        SET last_day=:d, streak=:s, updated_at=:ua
-                        WHERE chat_id=:cid AND user_id=:uid AND key=:k;
-                        """
-                    ),
-                    {"d": day, "s": new_streak, "ua": ca_val, "cid": chat_id, "uid": user_id, "k": key},
-                )
-                return new_streak
+            return self._bump_streak(conn, chat_id=chat_id, user_id=user_id, key=key, day=day, ca_val=self._dt(created_at))
 
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO streaks(chat_id, user_id, key, last_day, streak, updated_at)
-                    VALUES(:cid,:uid,:k,:d,1,:ua);
-                    """
-                ),
-                {"cid": chat_id, "uid": user_id, "k": key, "d": day, "ua": ca_val},
-            )
-            return 1
+    @staticmethod
+    def _bump_streak(conn: Connection, *, chat_id: int, user_id: int, key: str, day: str, ca_val: Any) -> int:
+        prev_day = (date.fromisoformat(day) - timedelta(days=1)).isoformat()
+        streak = conn.execute(
+            _SQL_UPSERT_STREAK,
+            {"cid": chat_id, "uid": user_id, "k": key, "d": day, "prev": prev_day, "ua": ca_val},
+        ).scalar()
+        return int(streak) if streak is not None else 1
 
     def get_streak(self, *, chat_id: int, user_id: int, key: str) -> int:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             row = conn.execute(
-                text("SELECT streak FROM streaks WHERE chat_id=:cid AND user_id=:uid AND key=:k;"),
+                _SQL_GET_STREAK,
                 {"cid": chat_id, "uid": user_id, "k": key},
             ).fetchone()
         return int(row[0]) if row else 0
 
     def get_streak_best_global(self, *, user_id: int, key: str) -> tuple[int, int | None, str | None]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             row = conn.execute(
-                text(
-                    """
-                    SELECT st.streak AS streak, st.chat_id AS chat_id, c.title AS chat_title
-                    FROM streaks st
-                    LEFT JOIN chats c ON c.chat_id = st.chat_id
-                    WHERE st.user_id=:uid AND st.key=:k
-                    ORDER BY st.streak DESC, st.chat_id ASC
-                    LIMIT 1;
-                    """
-                ),
+                _SQL_STREAK_BEST_GLOBAL,
                 {"uid": user_id, "k": key},
             ).fetchone()
         if not row:
@@ -987,228 +1537,124 @@ class SQLAlchemyStorage(Storage):
         day: str | None = None,
         session_id: int | None = None,
     ) -> bool:
-        dialect = self.engine.dialect.name
-        ca_val: Any = created_at if dialect == "postgresql" else created_at.isoformat()
+        params = {"cid": chat_id, "uid": user_id, "k": key, "d": day, "sid": session_id, "ca": self._dt(created_at)}
         try:
             with self.engine.begin() as conn:
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO achievement_events(chat_id, user_id, key, day, session_id, created_at)
-                        VALUES(:cid,:uid,:k,:d,:sid,:ca);
-                        """
-                    ),
-                    {"cid": chat_id, "uid": user_id, "k": key, "d": day, "sid": session_id, "ca": ca_val},
-                )
-                if dialect == "postgresql":
-                    conn.execute(
-                        text(
-                            """
-                            INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
-                            VALUES(:cid,:uid,:k,1,:ca)
-                            ON CONFLICT (chat_id, user_id, key) DO UPDATE SET
-                              count = achievement_stats.count + 1,
-                              last_awarded_at = EXCLUDED.last_awarded_at;
-                            """
-                        ),
-                        {"cid": chat_id, "uid": user_id, "k": key, "ca": ca_val},
-                    )
-                else:
-                    conn.execute(
-                        text(
-                            """
-                            INSERT INTO achievement_stats(chat_id, user_id, key, count, last_awarded_at)
-                            VALUES(:cid,:uid,:k,1,:ca)
-                            ON CONFLICT(chat_id, user_id, key) DO UPDATE SET
-                              count = count + 1,
-                              last_awarded_at = excluded.last_awarded_at;
-                            """
-                        ),
-                        {"cid": chat_id, "uid": user_id, "k": key, "ca": ca_val},
-                    )
-            return True
+                return self._award(conn, params)
         except IntegrityError:
             return False
 
+    def award_achievements_bulk(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        keys: list[str],
+        created_at: datetime,
+        day: str | None = None,
+        session_id: int | None = None,
+    ) -> list[str]:
+        # 签退后的候选成就在一个事务里写完：一次提交，而不是每个 key 各开一个事务
+        params = {"cid": chat_id, "uid": user_id, "d": day, "sid": session_id, "ca": self._dt(created_at)}
+        try:
+            with self.engine.begin() as conn:
+                return [key for key in keys if self._award(conn, {**params, "k": key})]
+        except IntegrityError:
+            return []
+
+    @staticmethod
+    def _award(conn: Connection, params: dict[str, Any]) -> bool:
+        # 事件去重冲突时什么都不写；写入了才给计数 +1
+        if conn.execute(_SQL_INSERT_ACHIEVEMENT_EVENT, params).fetchone() is None:
+            return False
+        conn.execute(_SQL_BUMP_ACHIEVEMENT_STATS, params)
+        conn.execute(_SQL_BUMP_ACHIEVEMENT_STATS_GLOBAL, params)
+        return True
+
     def get_achievement_stats(self, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT key, count, last_awarded_at
-                    FROM achievement_stats
-                    WHERE chat_id=:cid AND user_id=:uid
-                    ORDER BY count DESC, key ASC;
-                    """
-                ),
+                _SQL_ACHIEVEMENT_STATS,
                 {"cid": chat_id, "uid": user_id},
             ).fetchall()
         return [(str(k), int(c), str(t)) for (k, c, t) in rows]
 
     def get_achievement_stats_global(self, *, user_id: int) -> list[tuple[str, int, str]]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT key, SUM(count) AS count, MAX(last_awarded_at) AS last_awarded_at
-                    FROM achievement_stats
-                    WHERE user_id=:uid
-                    GROUP BY key
-                    ORDER BY count DESC, key ASC;
-                    """
-                ),
+                _SQL_ACHIEVEMENT_STATS_GLOBAL,
                 {"uid": user_id},
             ).fetchall()
         return [(str(k), int(c), str(t)) for (k, c, t) in rows]
 
     def get_achievement_count(self, *, chat_id: int, user_id: int, key: str) -> int:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             row = conn.execute(
-                text("SELECT count FROM achievement_stats WHERE chat_id=:cid AND user_id=:uid AND key=:k;"),
+                _SQL_ACHIEVEMENT_COUNT,
                 {"cid": chat_id, "uid": user_id, "k": key},
             ).fetchone()
         return int(row[0]) if row else 0
 
     def get_achievement_count_global(self, *, user_id: int, key: str) -> int:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             row = conn.execute(
-                text("SELECT COALESCE(SUM(count),0) FROM achievement_stats WHERE user_id=:uid AND key=:k;"),
+                _SQL_ACHIEVEMENT_COUNT_GLOBAL,
                 {"uid": user_id, "k": key},
             ).fetchone()
         return int(row[0]) if row else 0
 
     def achievement_rank_by_count(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT
-                      u.user_id AS user_id,
-                      COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-                      s.count AS count
-                    FROM achievement_stats s
-                    JOIN users u ON u.user_id = s.user_id
-                    WHERE s.chat_id=:cid AND s.key=:k
-                    ORDER BY s.count DESC, u.user_id ASC
-                    LIMIT :lim;
-                    """
-                ),
+                _SQL_ACHIEVEMENT_RANK,
                 {"cid": chat_id, "k": key, "lim": limit},
             ).fetchall()
-        return [(int(uid), _display_name(name, int(uid)), int(cnt)) for (uid, name, cnt) in rows]
+        return [(uid, _display_name(uid, un, fn, ln), int(cnt)) for (uid, un, fn, ln, cnt) in rows]
 
     def achievement_rank_by_count_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT
-                      u.user_id AS user_id,
-                      COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-                      SUM(s.count) AS count
-                    FROM achievement_stats s
-                    JOIN users u ON u.user_id = s.user_id
-                    WHERE s.key=:k
-                    GROUP BY u.user_id
-                    ORDER BY count DESC, u.user_id ASC
-                    LIMIT :lim;
-                    """
-                ),
+                _SQL_ACHIEVEMENT_RANK_GLOBAL,
                 {"k": key, "lim": limit},
             ).fetchall()
-        return [(int(uid), _display_name(name, int(uid)), int(cnt)) for (uid, name, cnt) in rows]
+        return [(uid, _display_name(uid, un, fn, ln), int(cnt)) for (uid, un, fn, ln, cnt) in rows]
 
     def streak_rank(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT
-                      u.user_id AS user_id,
-                      COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-                      st.streak AS streak
-                    FROM streaks st
-                    JOIN users u ON u.user_id = st.user_id
-                    WHERE st.chat_id=:cid AND st.key=:k
-                    ORDER BY st.streak DESC, u.user_id ASC
-                    LIMIT :lim;
-                    """
-                ),
+                _SQL_STREAK_RANK,
                 {"cid": chat_id, "k": key, "lim": limit},
             ).fetchall()
-        return [(int(uid), _display_name(name, int(uid)), int(st)) for (uid, name, st) in rows]
+        return [(uid, _display_name(uid, un, fn, ln), int(st)) for (uid, un, fn, ln, st) in rows]
 
     def streak_rank_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int, int | None, str | None]]:
         # sqlite <3.25 lacks window functions; our app supports modern sqlite generally, but keep query compatible by using window function only on pg
-        if self.engine.dialect.name != "postgresql":
+        if self._dialect != "postgresql":
             # best-effort: take max streak per user but without chat title
-            with self.engine.connect() as conn:
+            with self._reader() as conn:
                 rows = conn.execute(
-                    text(
-                        """
-                        SELECT
-                          u.user_id AS user_id,
-                          COALESCE(u.username, (u.first_name || ' ' || COALESCE(u.last_name,''))) AS name,
-                          MAX(st.streak) AS streak
-                        FROM streaks st
-                        JOIN users u ON u.user_id = st.user_id
-                        WHERE st.key=:k
-                        GROUP BY u.user_id
-                        ORDER BY streak DESC, u.user_id ASC
-                        LIMIT :lim;
-                        """
-                    ),
+                    _SQL_STREAK_RANK_GLOBAL_SQLITE,
                     {"k": key, "lim": limit},
                 ).fetchall()
-            return [(int(uid), _display_name(name, int(uid)), int(st), None, None) for (uid, name, st) in rows]
+            return [(uid, _display_name(uid, un, fn, ln), int(st), None, None) for (uid, un, fn, ln, st) in rows]
 
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    WITH ranked AS (
-                      SELECT
-                        st.user_id,
-                        st.chat_id,
-                        st.streak,
-                        ROW_NUMBER() OVER (PARTITION BY st.user_id ORDER BY st.streak DESC, st.chat_id ASC) AS rn
-                      FROM streaks st
-                      WHERE st.key=:k
-                    )
-                    SELECT
-                      u.user_id AS user_id,
-                      COALESCE(u.username, CONCAT_WS(' ', u.first_name, u.last_name)) AS name,
-                      r.streak AS streak,
-                      r.chat_id AS chat_id,
-                      c.title AS chat_title
-                    FROM ranked r
-                    JOIN users u ON u.user_id = r.user_id
-                    LEFT JOIN chats c ON c.chat_id = r.chat_id
-                    WHERE r.rn=1
-                    ORDER BY r.streak DESC, u.user_id ASC
-                    LIMIT :lim;
-                    """
-                ),
+                _SQL_STREAK_RANK_GLOBAL_PG,
                 {"k": key, "lim": limit},
             ).fetchall()
         return [
-            (int(uid), _display_name(str(name), int(uid)), int(streak), int(cid) if cid is not None else None, str(ctitle) if ctitle is not None else None)
-            for (uid, name, streak, cid, ctitle) in rows
+            (uid, _display_name(uid, un, fn, ln), int(streak), int(cid) if cid is not None else None, str(ctitle) if ctitle is not None else None)
+            for (uid, un, fn, ln, streak, cid, ctitle) in rows
         ]
 
     # --- russian roulette ---
     def get_active_roulette(self, *, chat_id: int) -> RouletteGame | None:
         from zao_bot.storage.base import RouletteGame
 
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             row = conn.execute(
-                text(
-                    """
-                    SELECT chat_id, chambers, bullet_position, current_position, created_by, created_at
-                    FROM russian_roulette
-                    WHERE chat_id=:cid;
-                    """
-                ),
+                _SQL_ACTIVE_ROULETTE,
                 {"cid": chat_id},
             ).fetchone()
         if not row:
@@ -1225,148 +1671,144 @@ class SQLAlchemyStorage(Storage):
     def create_roulette(
         self, *, chat_id: int, chambers: int, bullet_position: int, created_by: int, created_at: datetime
     ) -> None:
-        dialect = self.engine.dialect.name
-        ca_val: Any = created_at if dialect == "postgresql" else created_at.isoformat()
+        ca_val: Any = self._dt(created_at)
         with self.engine.begin() as conn:
             conn.execute(
-                text(
-                    """
-                    INSERT INTO russian_roulette(chat_id, chambers, bullet_position, current_position, created_by, created_at)
-                    VALUES(:cid,:ch,:bp,0,:cb,:ca);
-                    """
-                ),
+                _SQL_CREATE_ROULETTE,
                 {"cid": chat_id, "ch": chambers, "bp": bullet_position, "cb": created_by, "ca": ca_val},
             )
 
     def update_roulette_position(self, *, chat_id: int, position: int) -> None:
         with self.engine.begin() as conn:
             conn.execute(
-                text("UPDATE russian_roulette SET current_position=:pos WHERE chat_id=:cid;"),
+                _SQL_UPDATE_ROULETTE_POSITION,
                 {"pos": position, "cid": chat_id},
             )
 
     def delete_roulette(self, *, chat_id: int) -> None:
         with self.engine.begin() as conn:
-            conn.execute(text("DELETE FROM russian_roulette WHERE chat_id=:cid;"), {"cid": chat_id})
+            conn.execute(_SQL_DELETE_ROULETTE, {"cid": chat_id})
 
     def record_roulette_attempt(
         self, *, chat_id: int, user_id: int, position: int, result: str, created_at: datetime
     ) -> None:
-        dialect = self.engine.dialect.name
-        ca_val: Any = created_at if dialect == "postgresql" else created_at.isoformat()
+        ca_val: Any = self._dt(created_at)
         with self.engine.begin() as conn:
             conn.execute(
-                text(
-                    """
-                    INSERT INTO roulette_attempts(chat_id, user_id, position, result, created_at)
-                    VALUES(:cid,:uid,:pos,:res,:ca);
-                    """
-                ),
+                _SQL_RECORD_ROULETTE_ATTEMPT,
                 {"cid": chat_id, "uid": user_id, "pos": position, "res": result, "ca": ca_val},
             )
 
+    def pull_roulette_trigger(
+        self, *, chat_id: int, user_id: int, position: int, shot: bool, created_at: datetime
+    ) -> None:
+        ca_val: Any = self._dt(created_at)
+        with self.engine.begin() as conn:
+            conn.execute(
+                _SQL_RECORD_ROULETTE_ATTEMPT,
+                {"cid": chat_id, "uid": user_id, "pos": position, "res": "shot" if shot else "safe", "ca": ca_val},
+            )
+            if shot:
+                conn.execute(_SQL_DELETE_ROULETTE, {"cid": chat_id})
+            else:
+                conn.execute(_SQL_UPDATE_ROULETTE_POSITION, {"pos": position, "cid": chat_id})
+
     # --- wake reminders ---
     def create_reminder(
         self, *, chat_id: int, user_id: int, wake_time: str, next_trigger: datetime, repeat: bool, created_at: datetime
     ) -> int:
-        dialect = self.engine.dialect.name
-        nt_val: Any = next_trigger if dialect == "postgresql" else next_trigger.isoformat()
-        ca_val: Any = created_at if dialect == "postgresql" else created_at.isoformat()
-        repeat_val: Any = repeat if dialect == "postgresql" else (1 if repeat else 0)
+        nt_val: Any = self._dt(next_trigger)
+        ca_val: Any = self._dt(created_at)
         with self.engine.begin() as conn:
-            result = conn.execute(
-                text(
-                    """
-                    INSERT INTO wake_reminders(chat_id, user_id, wake_time, next_trigger, repeat, enabled, created_at)
-                    VALUES(:cid,:uid,:wt,:nt,:rep,true,:ca)
-                    RETURNING id;
-                    """ if dialect == "postgresql" else """
-                    INSERT INTO wake_reminders(chat_id, user_id, wake_time, next_trigger, repeat, enabled, created_at)
-                    VALUES(:cid,:uid,:wt,:nt,:rep,1,:ca);
-                    """
-                ),
-                {"cid": chat_id, "uid": user_id, "wt": wake_time, "nt": nt_val, "rep": repeat_val, "ca": ca_val},
+            return int(
+                conn.execute(
+                    _SQL_CREATE_REMINDER,
+                    {"cid": chat_id, "uid": user_id, "wt": wake_time, "nt": nt_val, "rep": repeat, "en": True, "ca": ca_val},
+                ).scalar_one()
             )
-            if dialect == "postgresql":
-                return int(result.fetchone()[0])  # type: ignore
-            return int(result.lastrowid)  # type: ignore
 
-    def get_pending_reminders(self, *, now: datetime) -> list[WakeReminder]:
-        from zao_bot.storage.base import WakeReminder
+    def _reminder_from_row(self, row: Any) -> WakeReminder:
+        # repeat/enabled：Postgres 是 boolean，SQLite 是 INTEGER 0/1，bool() 两边通用
+        return WakeReminder(
+            id=int(row[0]),
+            chat_id=int(row[1]),
+            user_id=int(row[2]),
+            wake_time=str(row[3]),
+            next_trigger=self._parse_dt(row[4]),
+            repeat=bool(row[5]),
+            enabled=bool(row[6]),
+        )
 
-        dialect = self.engine.dialect.name
-        now_val: Any = now if dialect == "postgresql" else now.isoformat()
-        with self.engine.connect() as conn:
+    def get_pending_reminders(self, *, now: datetime) -> list[WakeReminder]:
+        now_val: Any = self._dt(now)
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT id, chat_id, user_id, wake_time, next_trigger, repeat, enabled
-                    FROM wake_reminders
-                    WHERE enabled=:enabled AND next_trigger <= :now
-                    ORDER BY next_trigger;
-                    """
-                ),
-                {"enabled": True if dialect == "postgresql" else 1, "now": now_val},
+                _SQL_PENDING_REMINDERS,
+                {"enabled": True, "now": now_val},
             ).fetchall()
-        return [
-            WakeReminder(
-                id=int(r[0]),
-                chat_id=int(r[1]),
-                user_id=int(r[2]),
-                wake_time=str(r[3]),
-                next_trigger=self._parse_dt(r[4]),
-                repeat=bool(r[5]) if dialect == "postgresql" else bool(int(r[5])),
-                enabled=bool(r[6]) if dialect == "postgresql" else bool(int(r[6])),
-            )
-            for r in rows
-        ]
+        return [self._reminder_from_row(r) for r in rows]
+
+    def claim_pending_reminders(self, *, now: datetime, lease_until: datetime, limit: int = 100) -> list[WakeReminder]:
+        """
+        领取到期提醒：把 next_trigger 推到 lease_until（租约），返回领取前的记录。
+        领到的提醒在租约内不会再被领取；处理完后照旧 update/delete，失败或中途重启则租约到期后重试。
+        """
+        dialect = self._dialect
+        now_val: Any = self._dt(now)
+        lease_val: Any = self._dt(lease_until)
+        with self.engine.begin() as conn:
+            if dialect == "postgresql":
+                # 行锁 + SKIP LOCKED：别的事务正在领取的行直接跳过，不会阻塞也不会重复领取
+                rows = conn.execute(
+                    _SQL_CLAIM_REMINDERS_PG,
+                    {"now": now_val, "lim": limit},
+                ).fetchall()
+                if rows:
+                    conn.execute(
+                        _SQL_LEASE_REMINDERS_PG,
+                        {"lease": lease_val, "ids": [int(r[0]) for r in rows]},
+                    )
+            else:
+                # SQLite 没有行锁：逐行按原 next_trigger 做条件更新，只保留真正改到的行
+                candidates = conn.execute(
+                    _SQL_CLAIM_REMINDERS_SQLITE,
+                    {"now": now_val, "lim": limit},
+                ).fetchall()
+                rows = [
+                    r
+                    for r in candidates
+                    if conn.execute(
+                        _SQL_LEASE_REMINDER_SQLITE,
+                        {"lease": lease_val, "id": int(r[0]), "old": r[4]},
+                    ).rowcount
+                    == 1
+                ]
+        return [self._reminder_from_row(r) for r in rows]
 
     def get_user_reminders(self, *, chat_id: int, user_id: int) -> list[WakeReminder]:
-        from zao_bot.storage.base import WakeReminder
-
-        dialect = self.engine.dialect.name
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             rows = conn.execute(
-                text(
-                    """
-                    SELECT id, chat_id, user_id, wake_time, next_trigger, repeat, enabled
-                    FROM wake_reminders
-                    WHERE chat_id=:cid AND user_id=:uid AND enabled=:enabled
-                    ORDER BY wake_time;
-                    """
-                ),
-                {"cid": chat_id, "uid": user_id, "enabled": True if dialect == "postgresql" else 1},
+                _SQL_USER_REMINDERS,
+                {"cid": chat_id, "uid": user_id, "enabled": True},
             ).fetchall()
-        return [
-            WakeReminder(
-                id=int(r[0]),
-                chat_id=int(r[1]),
-                user_id=int(r[2]),
-                wake_time=str(r[3]),
-                next_trigger=self._parse_dt(r[4]),
-                repeat=bool(r[5]) if dialect == "postgresql" else bool(int(r[5])),
-                enabled=bool(r[6]) if dialect == "postgresql" else bool(int(r[6])),
-            )
-            for r in rows
-        ]
+        return [self._reminder_from_row(r) for r in rows]
 
     def update_reminder_next_trigger(self, *, reminder_id: int, next_trigger: datetime) -> None:
-        dialect = self.engine.dialect.name
-        nt_val: Any = next_trigger if dialect == "postgresql" else next_trigger.isoformat()
+        nt_val: Any = self._dt(next_trigger)
         with self.engine.begin() as conn:
             conn.execute(
-                text("UPDATE wake_reminders SET next_trigger=:nt WHERE id=:id;"),
+                _SQL_UPDATE_REMINDER_TRIGGER,
                 {"nt": nt_val, "id": reminder_id},
             )
 
     def delete_reminder(self, *, reminder_id: int) -> None:
         with self.engine.begin() as conn:
-            conn.execute(text("DELETE FROM wake_reminders WHERE id=:id;"), {"id": reminder_id})
+            conn.execute(_SQL_DELETE_REMINDER, {"id": reminder_id})
 
     def delete_user_reminders(self, *, chat_id: int, user_id: int) -> None:
         with self.engine.begin() as conn:
             conn.execute(
-                text("DELETE FROM wake_reminders WHERE chat_id=:cid AND user_id=:uid;"),
+                _SQL_DELETE_USER_REMINDERS,
                 {"cid": chat_id, "uid": user_id},
             )
 
@@ -1374,42 +1816,18 @@ class SQLAlchemyStorage(Storage):
     def create_rsp_game(
         self, *, chat_id: int, challenger_id: int, opponent_id: int, message_id: int | None, created_at: datetime
     ) -> int:
-        dialect = self.engine.dialect.name
-        ca_val: Any = created_at if dialect == "postgresql" else created_at.isoformat()
+        ca_val: Any = self._dt(created_at)
         with self.engine.begin() as conn:
-            result = conn.execute(
-                text(
-                    """
-                    INSERT INTO rsp_games(chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, status, message_id, created_at)
-                    VALUES(:cid,:challenger,:opponent,NULL,NULL,'pending',:mid,:ca)
-                    RETURNING id;
-                    """ if dialect == "postgresql" else """
-                    INSERT INTO rsp_games(chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, status, message_id, created_at)
-                    VALUES(:cid,:challenger,:opponent,NULL,NULL,'pending',:mid,:ca);
-                    """
-                ),
-                {"cid": chat_id, "challenger": challenger_id, "opponent": opponent_id, "mid": message_id, "ca": ca_val},
+            return int(
+                conn.execute(
+                    _SQL_CREATE_RSP_GAME,
+                    {"cid": chat_id, "challenger": challenger_id, "opponent": opponent_id, "mid": message_id, "ca": ca_val},
+                ).scalar_one()
             )
-            if dialect == "postgresql":
-                return int(result.fetchone()[0])  # type: ignore
-            return int(result.lastrowid)  # type: ignore
 
-    def get_rsp_game(self, *, game_id: int) -> RSPGame | None:
+    def _rsp_game_from_row(self, row: Any) -> RSPGame:
         from zao_bot.storage.base import RSPGame
 
-        with self.engine.connect() as conn:
-            row = conn.execute(
-                text(
-                    """
-                    SELECT id, chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, status, winner_id, message_id, created_at
-                    FROM rsp_games
-                    WHERE id=:gid;
-                    """
-                ),
-                {"gid": game_id},
-            ).fetchone()
-        if not row:
-            return None
         return RSPGame(
             id=int(row[0]),
             chat_id=int(row[1]),
@@ -1417,167 +1835,127 @@ class SQLAlchemyStorage(Storage):
             opponent_id=int(row[3]),
             challenger_choice=str(row[4]) if row[4] else None,
             opponent_choice=str(row[5]) if row[5] else None,
-            status=str(row[6]),
+            completed_at=self._parse_dt(row[6]) if row[6] else None,
             winner_id=int(row[7]) if row[7] else None,
             message_id=int(row[8]) if row[8] else None,
             created_at=self._parse_dt(row[9]),
         )
 
-    def get_pending_rsp_game(self, *, chat_id: int, user_id: int) -> RSPGame | None:
-        from zao_bot.storage.base import RSPGame
+    def get_rsp_game(self, game_id: int) -> RSPGame | None:
+        with self._reader() as conn:
+            row = conn.execute(
+                _SQL_RSP_GAME_BY_ID,
+                {"gid": game_id},
+            ).fetchone()
+        return self._rsp_game_from_row(row) if row else None
 
-        with self.engine.connect() as conn:
+    def get_pending_rsp_game(self, chat_id: int, user_id: int) -> RSPGame | None:
+        with self._reader() as conn:
             row = conn.execute(
-                text(
-                    """
-                    SELECT id, chat_id, challenger_id, opponent_id, challenger_choice, opponent_choice, status, winner_id, message_id, created_at
-                    FROM rsp_games
-                    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid) AND status='pending'
-                    ORDER BY created_at DESC
-                    LIMIT 1;
-                    """
-                ),
+                _SQL_PENDING_RSP_GAME,
                 {"cid": chat_id, "uid": user_id},
             ).fetchone()
-        if not row:
-            return None
-        return RSPGame(
-            id=int(row[0]),
-            chat_id=int(row[1]),
-            challenger_id=int(row[2]),
-            opponent_id=int(row[3]),
-            challenger_choice=str(row[4]) if row[4] else None,
-            opponent_choice=str(row[5]) if row[5] else None,
-            status=str(row[6]),
-            winner_id=int(row[7]) if row[7] else None,
-            message_id=int(row[8]) if row[8] else None,
-            created_at=self._parse_dt(row[9]),
-        )
-
-    def update_rsp_choice(self, *, game_id: int, user_id: int, choice: str) -> None:
+        return self._rsp_game_from_row(row) if row else None
+
+    def apply_rsp_choice(self, chat_id: int, user_id: int, choice: str) -> tuple[RSPChoiceReason, RSPGame | None]:
+        """
+        条件更新（compare-and-set）：只有该用户在进行中的对局里还没选择时才写入，
+        避免同一用户连点两次都通过“未选择”检查。
+        """
+        dialect = self._dialect
+        params = {"cid": chat_id, "uid": user_id, "choice": choice}
         with self.engine.begin() as conn:
-            # 先查询用户是挑战者还是对手
+            if dialect == "postgresql":
+                row = conn.execute(_SQL_RSP_APPLY_CHOICE_PG, params).fetchone()
+                if row:
+                    return "ok", self._rsp_game_from_row(row)
+                exists = conn.execute(_SQL_RSP_PENDING_ID, params).fetchone()
+                return ("already_chosen" if exists else "no_game"), None
+
+            r = conn.execute(_SQL_RSP_PENDING_ID, params).fetchone()
+            if not r:
+                return "no_game", None
+            gid = int(r[0])
+            res = conn.execute(_SQL_RSP_APPLY_CHOICE_SQLITE, {**params, "gid": gid})
+            if res.rowcount == 0:
+                return "already_chosen", None
             row = conn.execute(
-                text("SELECT challenger_id, opponent_id FROM rsp_games WHERE id=:gid;"),
-                {"gid": game_id},
+                _SQL_RSP_GAME_BY_ID,
+                {"gid": gid},
             ).fetchone()
-            if not row:
-                return
+        return "ok", (self._rsp_game_from_row(row) if row else None)
 
-            challenger_id, opponent_id = int(row[0]), int(row[1])
-            if user_id == challenger_id:
-                conn.execute(
-                    text("UPDATE rsp_games SET challenger_choice=:choice WHERE id=:gid;"),
-                    {"choice": choice, "gid": game_id},
-                )
-            elif user_id == opponent_id:
-                conn.execute(
-                    text("UPDATE rsp_games SET opponent_choice=:choice WHERE id=:gid;"),
-                    {"choice": choice, "gid": game_id},
-                )
-
-    def complete_rsp_game(self, *, game_id: int, winner_id: int | None) -> None:
+    def complete_rsp_game(self, *, game_id: int, winner_id: int | None, completed_at: datetime) -> None:
+        ca_val: Any = self._dt(completed_at)
         with self.engine.begin() as conn:
             conn.execute(
-                text("UPDATE rsp_games SET status='completed', winner_id=:wid WHERE id=:gid;"),
-                {"wid": winner_id, "gid": game_id},
+                _SQL_COMPLETE_RSP_GAME,
+                {"ca": ca_val, "wid": winner_id, "gid": game_id},
             )
 
     def delete_rsp_game(self, *, game_id: int) -> None:
         with self.engine.begin() as conn:
             conn.execute(
-                text("DELETE FROM rsp_games WHERE id=:gid;"),
+                _SQL_DELETE_RSP_GAME,
                 {"gid": game_id},
             )
 
     def get_rsp_stats(self, *, chat_id: int, user_id: int) -> tuple[int, int, int, int]:
         """返回 (总场次, 胜场, 负场, 平局)"""
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             # 总场次
             total_row = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(*) FROM rsp_games
-                    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid) AND status='completed';
-                    """
-                ),
+                _SQL_RSP_TOTAL,
                 {"cid": chat_id, "uid": user_id},
             ).fetchone()
             total = int(total_row[0]) if total_row else 0
 
             # 胜场
             wins_row = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(*) FROM rsp_games
-                    WHERE chat_id=:cid AND winner_id=:uid AND status='completed';
-                    """
-                ),
+                _SQL_RSP_WINS,
                 {"cid": chat_id, "uid": user_id},
             ).fetchone()
             wins = int(wins_row[0]) if wins_row else 0
 
             # 平局
             draws_row = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(*) FROM rsp_games
-                    WHERE chat_id=:cid AND (challenger_id=:uid OR opponent_id=:uid)
-                      AND winner_id IS NULL AND status='completed';
-                    """
-                ),
+                _SQL_RSP_DRAWS,
                 {"cid": chat_id, "uid": user_id},
             ).fetchone()
             draws = int(draws_row[0]) if draws_row else 0
 
-            # 负场 = 总场次 - 胜场 - 平局
-            losses = total - wins - draws
+        # 负场 = 总场次 - 胜场 - 平局
+        losses = total - wins - draws
 
-            return (total, wins, losses, draws)
+        return (total, wins, losses, draws)
 
     def get_rsp_stats_global(self, *, user_id: int) -> tuple[int, int, int, int]:
         """返回 (总场次, 胜场, 负场, 平局)"""
-        with self.engine.connect() as conn:
+        with self._reader() as conn:
             # 总场次
             total_row = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(*) FROM rsp_games
-                    WHERE (challenger_id=:uid OR opponent_id=:uid) AND status='completed';
-                    """
-                ),
+                _SQL_RSP_TOTAL_GLOBAL,
                 {"uid": user_id},
             ).fetchone()
             total = int(total_row[0]) if total_row else 0
 
             # 胜场
             wins_row = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(*) FROM rsp_games
-                    WHERE winner_id=:uid AND status='completed';
-                    """
-                ),
+                _SQL_RSP_WINS_GLOBAL,
                 {"uid": user_id},
             ).fetchone()
             wins = int(wins_row[0]) if wins_row else 0
 
             # 平局
             draws_row = conn.execute(
-                text(
-                    """
-                    SELECT COUNT(*) FROM rsp_games
-                    WHERE (challenger_id=:uid OR opponent_id=:uid)
-                      AND winner_id IS NULL AND status='completed';
-                    """
-                ),
+                _SQL_RSP_DRAWS_GLOBAL,
                 {"uid": user_id},
             ).fetchone()
             draws = int(draws_row[0]) if draws_row else 0
 
-            # 负场 = 总场次 - 胜场 - 平局
-            losses = total - wins - draws
+        # 负场 = 总场次 - 胜场 - 平局
+        losses = total - wins - draws
 
-            return (total, wins, losses, draws)
+        return (total, wins, losses, draws)
 
 
@@ -1,17 +1,52 @@
 from __future__ import annotations
 
+import sqlite3
+import threading
 from datetime import datetime, timedelta
 
 from zao_bot import db as sqlite_db
-from zao_bot.storage.base import OpenSession, Storage
+from zao_bot.storage.base import CheckInRecord, OpenSession, Storage
 
 
 class SQLiteStorage(Storage):
     def __init__(self, *, db_path: str):
         self._db_path = db_path
+        self._local = threading.local()
+        # :memory: 每个连接各是一个独立的库，只能所有线程共用同一条连接
+        self._shared: sqlite3.Connection | None = sqlite_db.connect(db_path) if db_path == ":memory:" else None
+
+    def _conn(self) -> sqlite3.Connection:
+        """
+        当前线程的常驻写连接：PRAGMA 只在打开时执行一次，页缓存在调用之间保持热。
+        sqlite3 连接不宜跨线程并发使用，所以按线程各持一条（WAL 下互不阻塞读）。
+        """
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite_db.connect(self._db_path)
+            self._local.conn = conn
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """当前线程的常驻只读连接（mode=ro）：纯查询走这里，不占写连接。"""
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            conn = sqlite_db.connect(self._db_path, read_only=True)
+            self._local.reader = conn
+        return conn
 
     def init_db(self) -> None:
-        sqlite_db.init_db(self._db_path)
+        sqlite_db.init_db(self._conn())
+        sqlite_db.optimize(self._conn())
+
+    def wal_checkpoint(self) -> None:
+        sqlite_db.wal_checkpoint(self._conn(), mode="PASSIVE")
+
+    def optimize(self) -> None:
+        sqlite_db.optimize(self._conn())
 
     def upsert_user_and_chat(
         self,
@@ -26,7 +61,7 @@ class SQLiteStorage(Storage):
         updated_at: datetime,
     ) -> None:
         sqlite_db.upsert_user_and_chat(
-            self._db_path,
+            self._conn(),
             user_id=user_id,
             username=username,
             first_name=first_name,
@@ -38,37 +73,69 @@ class SQLiteStorage(Storage):
         )
 
     def get_open_session(self, *, chat_id: int, user_id: int, day: str | None = None) -> OpenSession | None:
-        osess = sqlite_db.get_open_session(self._db_path, chat_id=chat_id, user_id=user_id, day=day)
+        osess = sqlite_db.get_open_session(self._reader(), chat_id=chat_id, user_id=user_id, day=day)
         if not osess:
             return None
         return OpenSession(session_id=osess.session_id, check_in=osess.check_in)
 
     def check_in(self, *, chat_id: int, user_id: int, ts: datetime) -> bool:
-        return sqlite_db.check_in(self._db_path, chat_id=chat_id, user_id=user_id, ts=ts)
+        return sqlite_db.check_in(self._conn(), chat_id=chat_id, user_id=user_id, ts=ts)
+
+    def record_checkin(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        ts: datetime,
+        created_at: datetime,
+        earliest_key: str,
+        streak_key: str,
+        streak_award_key: str,
+        streak_award_every: int = 7,
+    ) -> CheckInRecord | None:
+        rec = sqlite_db.record_checkin(
+            self._conn(),
+            chat_id=chat_id,
+            user_id=user_id,
+            ts=ts,
+            created_at=created_at,
+            earliest_key=earliest_key,
+            streak_key=streak_key,
+            streak_award_key=streak_award_key,
+            streak_award_every=streak_award_every,
+        )
+        if not rec:
+            return None
+        return CheckInRecord(
+            session_id=rec.session_id, position=rec.position, unlocked=rec.unlocked, earliest_streak=rec.earliest_streak
+        )
 
     def check_out(self, *, chat_id: int, user_id: int, ts: datetime) -> tuple[bool, timedelta | None, datetime | None, int | None]:
-        return sqlite_db.check_out(self._db_path, chat_id=chat_id, user_id=user_id, ts=ts)
+        return sqlite_db.check_out(self._conn(), chat_id=chat_id, user_id=user_id, ts=ts)
 
     def session_today_exists(self, *, chat_id: int, user_id: int, day: str) -> bool:
-        return sqlite_db.session_today_exists(self._db_path, chat_id=chat_id, user_id=user_id, day=day)
+        return sqlite_db.session_today_exists(self._reader(), chat_id=chat_id, user_id=user_id, day=day)
 
     def session_today_completed(self, *, chat_id: int, user_id: int, day: str) -> bool:
-        return sqlite_db.session_today_completed(self._db_path, chat_id=chat_id, user_id=user_id, day=day)
+        return sqlite_db.session_today_completed(self._reader(), chat_id=chat_id, user_id=user_id, day=day)
+
+    def session_today_status(self, *, chat_id: int, user_id: int, day: str) -> tuple[bool, bool]:
+        return sqlite_db.session_today_status(self._reader(), chat_id=chat_id, user_id=user_id, day=day)
 
     def today_checkin_position(self, *, chat_id: int, session_id: int, check_in: datetime, day: str) -> int:
-        return sqlite_db.today_checkin_position(self._db_path, chat_id=chat_id, session_id=session_id, check_in=check_in, day=day)
+        return sqlite_db.today_checkin_position(self._reader(), chat_id=chat_id, session_id=session_id, check_in=check_in, day=day)
 
-    def leaderboard(self, *, chat_id: int, mode: str, now: datetime) -> list[tuple[int, str, int]]:
-        return sqlite_db.leaderboard(self._db_path, chat_id=chat_id, mode=mode, now=now)
+    def leaderboard(self, *, chat_id: int, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
+        return sqlite_db.leaderboard(self._reader(), chat_id=chat_id, mode=mode, now=now, limit=limit)
 
-    def leaderboard_global(self, *, mode: str, now: datetime) -> list[tuple[int, str, int]]:
-        return sqlite_db.leaderboard_global(self._db_path, mode=mode, now=now)
+    def leaderboard_global(self, *, mode: str, now: datetime, limit: int | None = None) -> list[tuple[int, str, int]]:
+        return sqlite_db.leaderboard_global(self._reader(), mode=mode, now=now, limit=limit)
 
     def open_user_ids(self, *, chat_id: int, day: str | None = None) -> set[int]:
-        return sqlite_db.open_user_ids(self._db_path, chat_id=chat_id, day=day)
+        return sqlite_db.open_user_ids(self._reader(), chat_id=chat_id, day=day)
 
     def open_user_ids_global(self, day: str | None = None) -> set[int]:
-        return sqlite_db.open_user_ids_global(self._db_path, day=day)
+        return sqlite_db.open_user_ids_global(self._reader(), day=day)
 
     def set_daily_earliest(
         self,
@@ -81,7 +148,7 @@ class SQLiteStorage(Storage):
         created_at: datetime,
     ) -> bool:
         return sqlite_db.set_daily_earliest(
-            self._db_path,
+            self._conn(),
             chat_id=chat_id,
             day=day,
             user_id=user_id,
@@ -91,13 +158,13 @@ class SQLiteStorage(Storage):
         )
 
     def update_streak(self, *, chat_id: int, user_id: int, key: str, day: str, created_at: datetime) -> int:
-        return sqlite_db.update_streak(self._db_path, chat_id=chat_id, user_id=user_id, key=key, day=day, created_at=created_at)
+        return sqlite_db.update_streak(self._conn(), chat_id=chat_id, user_id=user_id, key=key, day=day, created_at=created_at)
 
     def get_streak(self, *, chat_id: int, user_id: int, key: str) -> int:
-        return sqlite_db.get_streak(self._db_path, chat_id=chat_id, user_id=user_id, key=key)
+        return sqlite_db.get_streak(self._reader(), chat_id=chat_id, user_id=user_id, key=key)
 
     def get_streak_best_global(self, *, user_id: int, key: str) -> tuple[int, int | None, str | None]:
-        return sqlite_db.get_streak_best_global(self._db_path, user_id=user_id, key=key)
+        return sqlite_db.get_streak_best_global(self._reader(), user_id=user_id, key=key)
 
     def award_achievement(
         self,
@@ -110,7 +177,7 @@ class SQLiteStorage(Storage):
         session_id: int | None = None,
     ) -> bool:
         return sqlite_db.award_achievement(
-            self._db_path,
+            self._conn(),
             chat_id=chat_id,
             user_id=user_id,
             key=key,
@@ -119,28 +186,48 @@ class SQLiteStorage(Storage):
             session_id=session_id,
         )
 
+    def award_achievements_bulk(
+        self,
+        *,
+        chat_id: int,
+        user_id: int,
+        keys: list[str],
+        created_at: datetime,
+        day: str | None = None,
+        session_id: int | None = None,
+    ) -> list[str]:
+        return sqlite_db.award_achievements_bulk(
+            self._conn(),
+            chat_id=chat_id,
+            user_id=user_id,
+            keys=keys,
+            created_at=created_at,
+            day=day,
+            session_id=session_id,
+        )
+
     def get_achievement_stats(self, *, chat_id: int, user_id: int) -> list[tuple[str, int, str]]:
-        return sqlite_db.get_achievement_stats(self._db_path, chat_id=chat_id, user_id=user_id)
+        return sqlite_db.get_achievement_stats(self._reader(), chat_id=chat_id, user_id=user_id)
 
     def get_achievement_stats_global(self, *, user_id: int) -> list[tuple[str, int, str]]:
-        return sqlite_db.get_achievement_stats_global(self._db_path, user_id=user_id)
+        return sqlite_db.get_achievement_stats_global(self._reader(), user_id=user_id)
 
     def get_achievement_count(self, *, chat_id: int, user_id: int, key: str) -> int:
-        return sqlite_db.get_achievement_count(self._db_path, chat_id=chat_id, user_id=user_id, key=key)
+        return sqlite_db.get_achievement_count(self._reader(), chat_id=chat_id, user_id=user_id, key=key)
 
     def get_achievement_count_global(self, *, user_id: int, key: str) -> int:
-        return sqlite_db.get_achievement_count_global(self._db_path, user_id=user_id, key=key)
+        return sqlite_db.get_achievement_count_global(self._reader(), user_id=user_id, key=key)
 
     def achievement_rank_by_count(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        return sqlite_db.achievement_rank_by_count(self._db_path, chat_id=chat_id, key=key, limit=limit)
+        return sqlite_db.achievement_rank_by_count(self._reader(), chat_id=chat_id, key=key, limit=limit)
 
     def achievement_rank_by_count_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        return sqlite_db.achievement_rank_by_count_global(self._db_path, key=key, limit=limit)
+        return sqlite_db.achievement_rank_by_count_global(self._reader(), key=key, limit=limit)
 
     def streak_rank(self, *, chat_id: int, key: str, limit: int = 20) -> list[tuple[int, str, int]]:
-        return sqlite_db.streak_rank(self._db_path, chat_id=chat_id, key=key, limit=limit)
+        return sqlite_db.streak_rank(self._reader(), chat_id=chat_id, key=key, limit=limit)
 
     def streak_rank_global(self, *, key: str, limit: int = 20) -> list[tuple[int, str, int, int | None, str | None]]:
-        return sqlite_db.streak_rank_global(self._db_path, key=key, limit=limit)
+        return sqlite_db.streak_rank_global(self._reader(), key=key, limit=limit)
 
 
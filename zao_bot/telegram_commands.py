@@ -3,7 +3,25 @@ from __future__ import annotations
 from telegram import BotCommand
 
 
-def default_bot_commands() -> list[BotCommand]:
+# 启动时构造一次；BotCommand 是不可变对象，元组也不会被调用方改动，可以直接共享
+_DEFAULT_COMMANDS: tuple[BotCommand, ...] = (
+    BotCommand("start", "显示帮助/指令说明"),
+    BotCommand("help", "显示帮助/指令说明"),
+    BotCommand("zao", "开始新的一天~"),
+    BotCommand("wan", "准备休息吧~"),
+    BotCommand("awake", "我还醒着吗?（可回复某人）"),
+    BotCommand("year", "今年进度条（按当前日期）"),
+    BotCommand("rank", "让我看看!（可加 all/global）"),
+    BotCommand("ach", "应该得记下些什么（可加 global/可回复某人）"),
+    BotCommand("achrank", "你们都咋样了（daily/streak/ontime/longday，可加 global）"),
+    BotCommand("heatmap", "查看签到热力图（可回复某人）"),
+    BotCommand("gun", "俄罗斯轮盘游戏（/gun n 创建）"),
+    BotCommand("wake", "设置叫醒提醒（/wake HH:MM）"),
+    BotCommand("rsp", "石头剪刀布游戏（回复某人或@某人）"),
+)
+
+
+def default_bot_commands() -> tuple[BotCommand, ...]:
     """
     用于 Telegram 的 setMyCommands（等同 BotFather 的 /setcommands）。
 
@@ -11,20 +29,5 @@ def default_bot_commands() -> list[BotCommand]:
     - 这里只注册“主要命令”（会显示在客户端命令菜单里）。
     - 代码里仍然可以继续支持别名（例如 /achievements），但不一定要展示出来。
     """
-    return [
-        BotCommand("start", "显示帮助/指令说明"),
-        BotCommand("help", "显示帮助/指令说明"),
-        BotCommand("zao", "开始新的一天~"),
-        BotCommand("wan", "准备休息吧~"),
-        BotCommand("awake", "我还醒着吗?（可回复某人）"),
-        BotCommand("year", "今年进度条（按当前日期）"),
-        BotCommand("rank", "让我看看!（可加 all/global）"),
-        BotCommand("ach", "应该得记下些什么（可加 global/可回复某人）"),
-        BotCommand("achrank", "你们都咋样了（daily/streak/ontime/longday，可加 global）"),
-        BotCommand("heatmap", "查看签到热力图（可回复某人）"),
-        BotCommand("gun", "俄罗斯轮盘游戏（/gun n 创建）"),
-        BotCommand("wake", "设置叫醒提醒（/wake HH:MM）"),
-        BotCommand("rsp", "石头剪刀布游戏（回复某人或@某人）"),
-    ]
-
+    return _DEFAULT_COMMANDS
 
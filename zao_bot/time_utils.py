@@ -1,20 +1,33 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, tzinfo
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 
+@lru_cache(maxsize=8)
+def get_tz(name: str) -> ZoneInfo:
+    # 按名字缓存 ZoneInfo，避免重复查找/解析 tzdata；调用方应复用同一个实例（例如 HandlerDeps.tz）
+    return ZoneInfo(name)
+
+
 def now(tzinfo: ZoneInfo) -> datetime:
     # 统一用带时区的时间，存储 ISO-8601 字符串（含 offset）
     return datetime.now(tz=tzinfo)
 
 
 def fmt_dt(dt: datetime) -> str:
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
+    # 直接拼整数，不走 strftime 的格式串解析（每条签到/签退/榜单回复都会调用）
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
 
 
 def fmt_td(td: timedelta) -> str:
-    sec = int(td.total_seconds())
+    return fmt_secs(int(td.total_seconds()))
+
+
+@lru_cache(maxsize=4096)
+def fmt_secs(sec: int) -> str:
+    # 榜单每行、每次签退都要格式化；同样的秒数反复出现（缓存的榜单重复渲染），直接查表
     if sec < 0:
         sec = 0
     h, rem = divmod(sec, 3600)
@@ -26,10 +39,19 @@ def fmt_td(td: timedelta) -> str:
     return f"{s}秒"
 
 
+_ONE_DAY = timedelta(days=1)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+@lru_cache(maxsize=1024)
+def _day_window(year: int, month: int, day: int, hour: int, tz: tzinfo | None) -> tuple[datetime, datetime]:
+    # 每条消息都要判断日界；同一天内结果不变，按 (日期, 切换小时, 时区) 缓存，省去 replace/timedelta 的分配
+    start = datetime(year, month, day, hour, tzinfo=tz)
+    return start, start + _ONE_DAY
+
+
 def day_range(now: datetime) -> tuple[datetime, datetime]:
-    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start + timedelta(days=1)
-    return start, end
+    return _day_window(now.year, now.month, now.day, 0, now.tzinfo)
 
 
 def day_key(dt: datetime) -> str:
@@ -42,17 +64,23 @@ def business_day_range(now: datetime, *, cutoff_hour: int = 4) -> tuple[datetime
     业务日范围：默认以凌晨 4 点作为一天的边界。
     例如：2025-01-02 03:59 仍属于 2025-01-01 的业务日。
     """
-    cutoff = now.replace(hour=cutoff_hour, minute=0, second=0, microsecond=0)
-    if now < cutoff:
-        cutoff = cutoff - timedelta(days=1)
-    return cutoff, cutoff + timedelta(days=1)
+    start, end = _day_window(now.year, now.month, now.day, cutoff_hour, now.tzinfo)
+    if now < start:
+        return start - _ONE_DAY, start
+    return start, end
 
 
 def business_day_key(dt: datetime, *, cutoff_hour: int = 4) -> str:
     """
     业务日 key（YYYY-MM-DD）：默认以凌晨 4 点作为一天的边界。
     """
-    start, _end = business_day_range(dt, cutoff_hour=cutoff_hour)
-    return start.date().isoformat()
+    # dt 的墙上时间已经是本地时间：日期序号直接相减，凌晨 cutoff 前退一天；不做带时区的 datetime 比较
+    return day_iso(dt.toordinal() - _EPOCH_ORDINAL - (dt.hour < cutoff_hour))
+
+
+@lru_cache(maxsize=1024)
+def day_iso(day_epoch: int) -> str:
+    # 业务日编号 -> YYYY-MM-DD（同一天反复出现，查表即可）
+    return date.fromordinal(day_epoch + _EPOCH_ORDINAL).isoformat()
 
 